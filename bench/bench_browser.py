@@ -0,0 +1,120 @@
+"""用户浏览器启动方式对比
+
+对比两种 browser.mode 启动到“聊天界面已打开、Agent 完成第一次页面跳转”所需的时间，以及之后整个进程树的常驻内存：
+
+- launcher: npx playwright cr 打开界面，@playwright/mcp 另外启动自己的浏览器（旧的方式）
+- inprocess: 守护进程内用 Playwright 启动一个浏览器，@playwright/mcp 通过 CDP 连接它
+
+需要已安装的浏览器（npx playwright install / install chrome）和 Node.js，使用与守护进程相同的 MCP 缓存（.everbrowser/mcp）。
+
+用法:
+    python bench/bench_browser.py --rounds 3
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psutil
+from langchain_mcp_adapters.client import MultiServerMCPClient
+
+from daemon import BrowserSupervisor, InProcessBrowser, MCPServerCache
+
+
+class PageServer:
+    """本地页面：代替聊天界面，界面和 Agent 都打开过它之后 loaded 被设置"""
+
+    def __init__(self, expected: int = 2):
+        self.hits = 0
+        self.expected = expected
+        self.loaded = asyncio.Event()
+        self.server = None
+
+    async def start(self) -> str:
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return f"http://127.0.0.1:{self.server.sockets[0].getsockname()[1]}/"
+
+    async def _handle(self, reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        body = b"<html><body><a href='#'>everBrowser</a></body></html>"
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nConnection: close\r\n"
+                     b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+        await writer.drain()
+        writer.close()
+        self.hits += 1
+        if self.hits >= self.expected:
+            self.loaded.set()
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+def tree_rss() -> tuple:
+    """本进程及所有子进程的 RSS（字节）和进程数"""
+    me = psutil.Process()
+    total, count = me.memory_info().rss, 1
+    for child in me.children(recursive=True):
+        try:
+            total += child.memory_info().rss
+            count += 1
+        except psutil.Error:
+            pass
+    return total, count
+
+
+async def run(mode: str, args, mcp_server: dict) -> dict:
+    pages = PageServer()
+    url = await pages.start()
+    started = time.perf_counter()
+
+    if mode == "inprocess":
+        browser = InProcessBrowser(user_data_dir=tempfile.mkdtemp(prefix="everbrowser-profile-"),
+                                   channel=args.channel)
+        await browser.launch()
+        await browser.open(url)
+        mcp_server = {**mcp_server, "args": [*mcp_server["args"], *browser.mcp_args()]}
+    else:
+        browser = BrowserSupervisor(url)
+        await browser.start()
+
+    client = MultiServerMCPClient({"everbrowser": mcp_server})
+    try:
+        async with client.session("everbrowser") as session:
+            await session.call_tool("browser_navigate", {"url": url})
+            await asyncio.wait_for(pages.loaded.wait(), args.timeout)
+            ready = time.perf_counter() - started
+            await asyncio.sleep(args.settle)
+            rss, processes = tree_rss()
+    finally:
+        await browser.stop()
+        await pages.stop()
+    return {"startup": ready, "rss": rss, "processes": processes}
+
+
+async def main(args):
+    mcp_server = await MCPServerCache(cache_dir=args.mcp_cache).server_config()
+    results = {}
+    for mode in ("launcher", "inprocess"):
+        results[mode] = [await run(mode, args, mcp_server) for _ in range(args.rounds)]
+
+    print(f"{'mode':<12}{'startup s':>11}{'RSS MB':>10}{'processes':>11}")
+    for mode, runs in results.items():
+        print(f"{mode:<12}{statistics.median(r['startup'] for r in runs):>11.2f}"
+              f"{statistics.median(r['rss'] for r in runs) / 1024 / 1024:>10.0f}"
+              f"{statistics.median(r['processes'] for r in runs):>11.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="用户浏览器启动方式对比")
+    parser.add_argument("--rounds", type=int, default=3, help="每种方式的测试次数")
+    parser.add_argument("--channel", default="chrome", help="inprocess 模式使用的浏览器（chrome / chromium）")
+    parser.add_argument("--mcp-cache", default=".everbrowser/mcp", help="MCP 服务器缓存目录")
+    parser.add_argument("--settle", type=float, default=2.0, help="测量内存前等待的秒数")
+    parser.add_argument("--timeout", type=float, default=60, help="等待页面打开的超时（秒）")
+    asyncio.run(main(parser.parse_args()))
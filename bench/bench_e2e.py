@@ -0,0 +1,276 @@
+"""离线端到端基准测试
+
+在本进程中启动 bench/mock_llm.py 模拟后端，以 --headless 模式启动守护进程（MCP 使用 bench/mock_mcp.py），
+然后用 N 个并发会话驱动 /chat/stream，报告：
+
+- 首 token 时间（TTFT）的 p50 / p95
+- 每个会话的输出速度（token/s，按守护进程的 token 估算方法计算）
+- 守护进程在每次模型调用上增加的开销：会话总耗时减去模拟后端的服务时间和模拟工具的延迟
+- 守护进程的 RSS 增长
+- 每个会话发送给模型的提示 token 数
+
+不需要网络、真实模型或浏览器。指定 --baseline 时与基线比较，超过容差时退出码为 1（用于 CI）。
+
+用法:
+    python bench/bench_e2e.py --sessions 8 --turns 3
+    python bench/bench_e2e.py --save-baseline /tmp/e2e_baseline.json
+    python bench/bench_e2e.py --baseline /tmp/e2e_baseline.json --tolerance 0.25
+"""
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+import httpx
+import psutil
+import uvicorn
+
+from mock_llm import MockLLM, create_app, estimate_tokens
+from daemon import READ_ONLY_TOOLS
+
+# 越小越好的指标及其绝对容差（避免数值很小时相对容差过于敏感）
+LOWER_IS_BETTER = {
+    "ttft_p50_ms": 20.0,
+    "ttft_p95_ms": 40.0,
+    "overhead_ms_per_call": 5.0,
+    "rss_growth_mb": 10.0,
+    "prompt_tokens_per_session": 0.0,
+}
+HIGHER_IS_BETTER = {
+    "tokens_per_second": 0.0,
+}
+
+
+def write_config(workdir: str, args) -> str:
+    config = {
+        "model": {"name": "mock", "api_key": "mock", "base_url": f"http://127.0.0.1:{args.llm_port}/v1"},
+        "mcp": {
+            "command": sys.executable,
+            "args": [os.path.join(BENCH_DIR, "mock_mcp.py"), "--latency", str(args.tool_latency),
+                     "--snapshot-size", str(args.snapshot_size)],
+        },
+        "server": {"host": "127.0.0.1", "port": args.port},
+        # 预先启动所有浏览器会话，避免把 MCP 进程的启动时间算进首 token 时间
+        "mcp_pool": {"max_size": args.sessions, "min_size": args.sessions},
+        "completion_check": {"mode": args.check_mode},
+        "session_store": {"path": os.path.join(workdir, "sessions.db")},
+        "jobs": {"path": os.path.join(workdir, "jobs.db")},
+    }
+    if args.trace:
+        config["telemetry"] = {"trace_file": os.path.join(workdir, "trace.jsonl")}
+    if args.record:
+        config["recording"] = {"dir": os.path.join(workdir, "recordings"), "sessions": ["*"]}
+    path = os.path.join(workdir, "config.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    return path
+
+
+async def wait_ready(client: httpx.AsyncClient, base_url: str, process: subprocess.Popen, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"daemon exited with code {process.returncode}")
+        try:
+            response = await client.get(f"{base_url}/health")
+            if response.status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("daemon did not become ready in time")
+
+
+async def run_session(client: httpx.AsyncClient, base_url: str, session_id: str, message: str) -> dict:
+    started = time.perf_counter()
+    first_token = None
+    last_token = None
+    text = ""
+    error = None
+    async with client.stream("POST", f"{base_url}/chat/stream",
+                             json={"message": message, "session_id": session_id}) as response:
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            data = json.loads(line[6:])
+            if data["type"] == "token":
+                now = time.perf_counter()
+                if first_token is None:
+                    first_token = now
+                last_token = now
+                text += data["content"]
+            elif data["type"] == "error":
+                error = data["error"]
+    ended = time.perf_counter()
+    return {
+        "message": message,
+        "wall": ended - started,
+        "ttft": (first_token - started) if first_token else None,
+        "tokens": estimate_tokens(text),
+        "stream_seconds": (last_token - first_token) if first_token and last_token > first_token else 0.0,
+        "error": error,
+    }
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q * (len(values) - 1))))
+    return values[index]
+
+
+def tool_seconds(names: list, latency: float) -> float:
+    """一条消息中工具调用的最短执行时间：相邻的只读调用并发执行，修改类调用依次执行
+    （fetch_tool_output 由守护进程直接返回，不计延迟）"""
+    groups = 0
+    previous_read = False
+    for name in names:
+        if name == "fetch_tool_output":
+            continue
+        read = name in READ_ONLY_TOOLS
+        if not (read and previous_read):
+            groups += 1
+        previous_read = read
+    return groups * latency
+
+
+def summarise(results: list, mock: MockLLM, args, rss_before: int, rss_after: int) -> dict:
+    overheads = []
+    rates = []
+    for result in results:
+        requests = [r for r in mock.requests if r["conversation"] == result["message"][:80]]
+        llm_seconds = sum(r["service_seconds"] for r in requests)
+        tools = sum(tool_seconds(r["tool_names"], args.tool_latency) for r in requests)
+        if requests:
+            overheads.append((result["wall"] - llm_seconds - tools) / len(requests) * 1000)
+        if result["stream_seconds"]:
+            rates.append(result["tokens"] / result["stream_seconds"])
+    ttfts = [r["ttft"] * 1000 for r in results if r["ttft"] is not None]
+    return {
+        "sessions": len(results),
+        "errors": sum(1 for r in results if r["error"] or r["ttft"] is None),
+        "model_calls": len(mock.requests),
+        "ttft_p50_ms": round(percentile(ttfts, 0.5), 1),
+        "ttft_p95_ms": round(percentile(ttfts, 0.95), 1),
+        "tokens_per_second": round(statistics.mean(rates), 1) if rates else 0.0,
+        "overhead_ms_per_call": round(statistics.median(overheads), 2) if overheads else 0.0,
+        "rss_growth_mb": round((rss_after - rss_before) / 1024 / 1024, 1),
+        "prompt_tokens_per_session": round(sum(r["prompt_tokens"] for r in mock.requests) / max(1, len(results))),
+    }
+
+
+def compare(summary: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for metric, slack in LOWER_IS_BETTER.items():
+        if metric in baseline and summary[metric] > baseline[metric] * (1 + tolerance) + slack:
+            regressions.append(f"{metric}: {summary[metric]} > baseline {baseline[metric]}")
+    for metric, slack in HIGHER_IS_BETTER.items():
+        if metric in baseline and summary[metric] < baseline[metric] * (1 - tolerance) - slack:
+            regressions.append(f"{metric}: {summary[metric]} < baseline {baseline[metric]}")
+    return regressions
+
+
+async def main(args) -> int:
+    workdir = tempfile.mkdtemp(prefix="everbrowser-bench-")
+    config_path = write_config(workdir, args)
+    base_url = f"http://127.0.0.1:{args.port}"
+
+    mock = MockLLM(turns=args.turns, min_cache_tokens=0, latency=args.llm_latency,
+                   token_delay=args.token_delay, tool_calls=args.tool_calls)
+    llm_server = uvicorn.Server(uvicorn.Config(create_app(mock), host="127.0.0.1", port=args.llm_port, log_level="warning"))
+    llm_task = asyncio.create_task(llm_server.serve())
+    while not llm_server.started:
+        await asyncio.sleep(0.01)
+
+    log = open(os.path.join(workdir, "daemon.log"), "w", encoding="utf-8")
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT_DIR, "daemon.py"), "--headless", "--config", config_path],
+        cwd=workdir, stdout=log, stderr=subprocess.STDOUT,
+    )
+    try:
+        async with httpx.AsyncClient(timeout=httpx.Timeout(args.timeout)) as client:
+            startup = time.perf_counter()
+            await wait_ready(client, base_url, process, args.timeout)
+            print(f"daemon ready in {time.perf_counter() - startup:.2f}s (logs and metrics: {workdir})")
+
+            # 预热一次，之后的内存增长才不包含首次导入和初始化
+            await run_session(client, base_url, "warmup", "预热：打开示例网站")
+            mock.reset()
+            rss_before = psutil.Process(process.pid).memory_info().rss
+
+            results = []
+            for round_index in range(args.rounds):
+                results += await asyncio.gather(*(
+                    run_session(client, base_url, f"bench_{round_index}_{i}",
+                                f"任务 {round_index}-{i}: 打开示例网站并整理页面上的信息")
+                    for i in range(args.sessions)
+                ))
+            rss_after = psutil.Process(process.pid).memory_info().rss
+            with open(os.path.join(workdir, "metrics.txt"), "w", encoding="utf-8") as f:
+                f.write((await client.get(f"{base_url}/metrics")).text)
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        log.close()
+        llm_server.should_exit = True
+        await llm_task
+
+    summary = summarise(results, mock, args, rss_before, rss_after)
+    if args.trace:
+        with open(os.path.join(workdir, "trace.jsonl"), "r", encoding="utf-8") as f:
+            summary["spans"] = sum(len(scope["spans"]) for line in f
+                                   for resource in json.loads(line)["resourceSpans"] for scope in resource["scopeSpans"])
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"baseline saved to {args.save_baseline}")
+
+    if summary["errors"]:
+        print(f"FAILED: {summary['errors']} sessions failed (see {workdir}/daemon.log)")
+        return 1
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(summary, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="离线端到端基准测试")
+    parser.add_argument("--sessions", type=int, default=8, help="并发会话数")
+    parser.add_argument("--rounds", type=int, default=2, help="重复轮数（用于观察内存增长）")
+    parser.add_argument("--turns", type=int, default=3, help="每个会话自动继续的轮数")
+    parser.add_argument("--tool-calls", type=int, default=1, help="每轮的工具调用数")
+    parser.add_argument("--check-mode", default="agent", help="任务完成检查模式")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="模拟后端的首包延迟（秒）")
+    parser.add_argument("--token-delay", type=float, default=0.005, help="模拟后端每个 chunk 的间隔（秒）")
+    parser.add_argument("--tool-latency", type=float, default=0.05, help="模拟工具的延迟（秒）")
+    parser.add_argument("--snapshot-size", type=int, default=2000, help="模拟页面快照的字符数")
+    parser.add_argument("--trace", action="store_true", help="打开追踪（span 写入临时目录中的 trace.jsonl），用于比较追踪的开销")
+    parser.add_argument("--record", action="store_true", help="录制所有会话（写入临时目录中的 recordings/），可用 bench/bench_replay.py 回放")
+    parser.add_argument("--port", type=int, default=41565, help="守护进程端口")
+    parser.add_argument("--llm-port", type=int, default=18080, help="模拟后端端口")
+    parser.add_argument("--timeout", type=float, default=120, help="单个请求和启动的超时（秒）")
+    parser.add_argument("--baseline", help="与该基线文件比较，出现回归时退出码为 1")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="相对基线允许的变化比例")
+    parser.add_argument("--save-baseline", help="把本次结果保存为基线文件")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,147 @@
+"""提示前缀稳定性与前缀缓存命中测试
+
+在本进程中启动 bench/mock_llm.py 模拟后端，用守护进程的 SessionHistory、TaskCompletionChecker 和
+Agent 中间件按 stream_agent_response 的顺序跑完多段自动继续的对话，然后检查：
+
+- 同一类请求（对话轮次 / 任务完成检查）的前缀是否在相邻两次请求之间保持不变（历史压缩导致的变化除外）
+- 后端返回的命中缓存 token 数，以及守护进程 PromptCacheStats 统计到的数值
+
+前缀不稳定时退出码为 1。
+
+用法:
+    python bench/bench_prompt_cache.py --conversations 3 --turns 5
+    python bench/bench_prompt_cache.py --check-mode model
+"""
+import os
+import sys
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uvicorn
+from langchain.agents import create_agent
+from langchain_openai import ChatOpenAI
+from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
+
+import daemon
+from daemon import SessionHistory, TaskCompletionChecker, PromptCacheMiddleware, prompt_cache_stats
+from mock_llm import MockLLM, create_app
+
+
+async def run_conversation(agent, checker, history: SessionHistory, task: str, max_turns: int, compactions: list):
+    """按 stream_agent_response 的顺序构建请求：一轮对话、一次完成检查、追加"继续"……"""
+    history.append(SystemMessage(content=daemon.system_msg_content))
+    history.append(HumanMessage(content=task))
+    for _ in range(max_turns):
+        compactions.append(history.compactions)
+        text = ""
+        async for chunk in agent.astream({"messages": history.messages()}, stream_mode=["messages"]):
+            if chunk[0] == "messages" and chunk[1][0].content:
+                text += str(chunk[1][0].content)
+        history.append(AIMessage(content=text))
+
+        compactions.append(history.compactions)
+        status = await checker.check(history.messages(), agent, text, [])
+        if status != "continue":
+            return
+        history.append(HumanMessage(content="继续"))
+
+
+def common_prefix(a: list, b: list) -> int:
+    count = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        count += 1
+    return count
+
+
+def analyse(requests: list, compactions: list, conversation_sizes: list) -> int:
+    """逐条打印请求，返回前缀不稳定的请求数"""
+    print(f"{'#':>3} {'kind':<6}{'msgs':>6}{'prompt':>9}{'cached':>9}{'prefix':>8}  note")
+    unstable = 0
+    offset = 0
+    for size in conversation_sizes:
+        previous = {}
+        for index in range(offset, offset + size):
+            request = requests[index]
+            kind = request["kind"]
+            note = ""
+            prefix = ""
+            if kind in previous:
+                prev_index = previous[kind]
+                prev = requests[prev_index]
+                shared = common_prefix(prev["hashes"], request["hashes"])
+                prefix = str(shared)
+                # 上一次请求中除了末尾的判定提示之外都应该原样出现在这次请求的开头
+                expected = len(prev["hashes"]) - (1 if prev["kind"] == "check" else 0)
+                if shared < expected:
+                    if compactions[index] != compactions[prev_index]:
+                        note = "history compacted"
+                    elif kind == "check" and args.check_mode == "model":
+                        note = "check window moved"
+                    else:
+                        note = "PREFIX CHANGED"
+                        unstable += 1
+            previous[kind] = index
+            print(f"{index:>3} {kind:<6}{len(request['hashes']):>6}{request['prompt_tokens']:>9}"
+                  f"{request['cached_tokens']:>9}{prefix:>8}  {note}")
+        offset += size
+    return unstable
+
+
+async def main():
+    mock = MockLLM(turns=args.turns, min_cache_tokens=args.min_cache_tokens)
+    server = uvicorn.Server(uvicorn.Config(create_app(mock), host="127.0.0.1", port=args.port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    try:
+        model = ChatOpenAI(
+            model="mock",
+            api_key="mock",
+            base_url=f"http://127.0.0.1:{args.port}/v1",
+            streaming=True,
+            stream_usage=True,
+            temperature=0.7,
+        )
+        agent = create_agent(model, tools=[], middleware=[PromptCacheMiddleware()])
+        checker = TaskCompletionChecker(mode=args.check_mode, model=model, context_messages=args.context_messages)
+
+        compactions = []
+        conversation_sizes = []
+        for index in range(args.conversations):
+            before = len(mock.requests)
+            history = SessionHistory(token_budget=args.token_budget)
+            await run_conversation(agent, checker, history, f"任务 {index}: 打开示例网站并整理页面上的信息",
+                                   args.turns + 1, compactions)
+            conversation_sizes.append(len(mock.requests) - before)
+
+        unstable = analyse(mock.requests, compactions, conversation_sizes)
+        total_prompt = sum(r["prompt_tokens"] for r in mock.requests)
+        total_cached = sum(r["cached_tokens"] for r in mock.requests)
+        print(f"\nbackend: {len(mock.requests)} requests, {total_prompt} prompt tokens, "
+              f"{total_cached} cached ({total_cached / total_prompt:.1%})")
+        for kind, entry in prompt_cache_stats.snapshot()["calls"].items():
+            print(f"daemon stats [{kind}]: {entry}")
+        print(f"unstable prefixes: {unstable}")
+        return 1 if unstable else 0
+    finally:
+        server.should_exit = True
+        await server_task
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="提示前缀稳定性与前缀缓存命中测试")
+    parser.add_argument("--conversations", type=int, default=3, help="对话数量")
+    parser.add_argument("--turns", type=int, default=5, help="每段对话自动继续的轮数")
+    parser.add_argument("--check-mode", default="agent", choices=["agent", "model"], help="任务完成检查模式")
+    parser.add_argument("--context-messages", type=int, default=12, help="model 模式下判定使用的最近消息数")
+    parser.add_argument("--token-budget", type=int, default=24000, help="历史 token 预算，调小可以观察压缩的影响")
+    parser.add_argument("--min-cache-tokens", type=int, default=0,
+                        help="前缀缓存生效的最小 token 数（OpenAI 为 1024，默认 0 以便观察较短对话的命中情况）")
+    parser.add_argument("--port", type=int, default=18080, help="模拟后端端口")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main()))
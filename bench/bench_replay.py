@@ -0,0 +1,82 @@
+"""会话回放基准测试
+
+以 --headless --replay 模式启动守护进程，把会话记录（recording 配置录制的 .jsonl.gz）中的模型输出和工具结果
+按原来的时间（或按 --speed 加速）回放，报告回放的总耗时、其中模型输出和工具调用占用的时间，以及守护进程本身的开销。
+回放不需要模型服务和浏览器，MCP 使用 bench/mock_mcp.py（工具不会被真正调用）。
+
+任务完成判定等配置需要与录制时相同，否则回放的模型调用顺序会与记录不一致（报告中的 mismatches）。
+
+用法:
+    python bench/bench_e2e.py --sessions 1 --rounds 1 --record     # 生成一份会话记录
+    python bench/bench_replay.py /tmp/everbrowser-bench-xxx/recordings/bench_0_0.jsonl.gz --speed 0 --repeat 5
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+SUMMARY_MARKER = "Replay finished: "
+
+
+def write_config(workdir: str, args) -> str:
+    config = {
+        "model": {"name": "replay", "api_key": "replay", "base_url": "http://127.0.0.1:9/v1"},
+        "mcp": {"command": sys.executable, "args": [os.path.join(BENCH_DIR, "mock_mcp.py")]},
+        "server": {"host": "127.0.0.1", "port": args.port},
+        "mcp_pool": {"max_size": 1, "min_size": 1},
+        "completion_check": {"mode": args.check_mode},
+        "session_store": {"path": os.path.join(workdir, "sessions.db")},
+        "jobs": {"path": os.path.join(workdir, "jobs.db")},
+    }
+    path = os.path.join(workdir, "config.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    return path
+
+
+def replay_once(workdir: str, config_path: str, args, index: int) -> dict:
+    log_path = os.path.join(workdir, f"daemon_{index}.log")
+    with open(log_path, "w", encoding="utf-8") as log:
+        subprocess.run(
+            [sys.executable, os.path.join(ROOT_DIR, "daemon.py"), "--headless", "--config", config_path,
+             "--replay", os.path.abspath(args.recording), "--replay-speed", str(args.speed)],
+            cwd=workdir, stdout=log, stderr=subprocess.STDOUT, timeout=args.timeout,
+        )
+    with open(log_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if SUMMARY_MARKER in line:
+                return json.loads(line.split(SUMMARY_MARKER, 1)[1])
+    raise RuntimeError(f"replay did not finish (see {log_path})")
+
+
+def main(args) -> int:
+    workdir = tempfile.mkdtemp(prefix="everbrowser-replay-")
+    config_path = write_config(workdir, args)
+    runs = [replay_once(workdir, config_path, args, index) for index in range(args.repeat)]
+    summary = dict(runs[-1])
+    summary["repeat"] = args.repeat
+    summary["wall_seconds"] = round(statistics.median(run["wall_seconds"] for run in runs), 3)
+    summary["overhead_seconds"] = round(statistics.median(run["overhead_seconds"] for run in runs), 3)
+    summary["overhead_ms_per_call"] = round(statistics.median(run["overhead_ms_per_call"] for run in runs), 2)
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    if any(run["mismatches"] for run in runs):
+        print(f"FAILED: replay diverged from the recording (see {workdir})")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="会话回放基准测试")
+    parser.add_argument("recording", help="会话记录文件（.jsonl.gz）")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放的时间倍速，0 表示不等待（只测量守护进程的开销）")
+    parser.add_argument("--repeat", type=int, default=3, help="重复回放的次数，报告中位数")
+    parser.add_argument("--check-mode", default="agent", help="任务完成检查模式（需要与录制时相同）")
+    parser.add_argument("--port", type=int, default=41566, help="守护进程端口")
+    parser.add_argument("--timeout", type=float, default=300, help="单次回放的超时（秒）")
+    sys.exit(main(parser.parse_args()))
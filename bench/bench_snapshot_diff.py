@@ -0,0 +1,145 @@
+"""页面快照增量的 token 对比
+
+把一次浏览任务中各次工具调用返回的页面快照按顺序送入守护进程的工具输出处理（与 Agent 中的中间件顺序相同），
+模拟同一轮中每次模型调用都重新发送之前所有工具输出的上下文，统计整个任务发送给模型的 token 数：
+
+- raw: 原始工具输出
+- truncate: ToolOutputMiddleware（截断与去重）
+- diff: SnapshotDiffMiddleware + ToolOutputMiddleware
+
+默认使用内置的录制页面（搜索、翻页、展开、进入文章等 10 步），也可以用 --recording 指定 JSONL 文件，
+每行一个 {"tool": "browser_click", "output": "..."}。
+
+用法:
+    python bench/bench_snapshot_diff.py
+    python bench/bench_snapshot_diff.py --recording task.jsonl --max-ratio 0.3
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain.messages import ToolMessage
+
+from daemon import ToolOutputStore, ToolOutputMiddleware, SnapshotDiffMiddleware, estimate_tokens
+
+
+def page_output(code: str, url: str, title: str, nodes: list) -> str:
+    """按 @playwright/mcp 的格式生成一次工具调用的输出"""
+    return "\n".join([
+        "### Ran Playwright code", "```js", code, "```", "",
+        "### Page state", f"- Page URL: {url}", f"- Page Title: {title}", "- Page Snapshot:", "```yaml",
+        *nodes, "```",
+    ])
+
+
+def search_page(query: str, results: list, expanded: int = None, value: str = "") -> list:
+    nodes = ["- banner [ref=e1]:"]
+    nodes += [f'  - link "导航 {i}" [ref=e{10 + i}]:\n    - /url: /section/{i}' for i in range(30)]
+    nodes += [f'- search [ref=e2]:', f'  - textbox "搜索" [ref=e3]: {value}', '  - button "搜索" [ref=e4]']
+    nodes += ["- main [ref=e5]:", f'  - heading "“{query}” 的搜索结果" [level=1] [ref=e6]' if query else '  - heading "热门" [level=1] [ref=e6]']
+    for index in results:
+        nodes += [f'  - article [ref=e{100 + index}]:',
+                  f'    - link "结果 {index}：关于{query or "热门"}的一篇文章" [ref=e{200 + index}]:',
+                  f'      - /url: /article/{index}',
+                  f'    - paragraph [ref=e{300 + index}]: 这是第 {index} 条结果的摘要，包含一些说明文字和发布时间。']
+        if index == expanded:
+            nodes += [f'    - paragraph [ref=e{1000 + index * 10 + line}]: 展开后的全文预览，第 {line} 行。' for line in range(5)]
+    nodes += [f'  - button "加载更多" [ref=e7]', "- contentinfo [ref=e8]:"]
+    nodes += [f'  - link "页脚链接 {i}" [ref=e{50 + i}]' for i in range(15)]
+    return nodes
+
+
+def article_page(liked: bool) -> list:
+    nodes = ["- main [ref=e5]:", '  - heading "结果 3：关于浏览器的一篇文章" [level=1] [ref=e6]']
+    nodes += [f'  - paragraph [ref=e{600 + i}]: 正文第 {i} 段，介绍浏览器自动化的一些细节。' for i in range(40)]
+    nodes += [f'  - button "{"已赞" if liked else "点赞"}" [ref=e9]']
+    return nodes
+
+
+def builtin_recording() -> list:
+    base = "https://example.com"
+    steps = [
+        ("browser_navigate", "await page.goto('https://example.com');", base, search_page("", range(10))),
+        ("browser_type", "await page.getByRole('textbox', { name: '搜索' }).fill('浏览器');", base,
+         search_page("", range(10), value="浏览器")),
+        ("browser_click", "await page.getByRole('button', { name: '搜索' }).click();", f"{base}/search?q=浏览器",
+         search_page("浏览器", range(10), value="浏览器")),
+        ("browser_click", "await page.getByRole('button', { name: '加载更多' }).click();", f"{base}/search?q=浏览器",
+         search_page("浏览器", range(14), value="浏览器")),
+        ("browser_click", "await page.getByRole('article').nth(3).click();", f"{base}/search?q=浏览器",
+         search_page("浏览器", range(14), expanded=3, value="浏览器")),
+        ("browser_snapshot", "", f"{base}/search?q=浏览器", search_page("浏览器", range(14), expanded=3, value="浏览器")),
+        ("browser_click", "await page.getByRole('article').nth(5).click();", f"{base}/search?q=浏览器",
+         search_page("浏览器", range(14), expanded=5, value="浏览器")),
+        ("browser_click", "await page.getByRole('link', { name: '结果 3' }).click();", f"{base}/article/3",
+         article_page(False)),
+        ("browser_click", "await page.getByRole('button', { name: '点赞' }).click();", f"{base}/article/3",
+         article_page(True)),
+        ("browser_snapshot", "", f"{base}/article/3", article_page(True)),
+    ]
+    return [{"tool": tool, "output": page_output(code, url, "示例站点", nodes)} for tool, code, url, nodes in steps]
+
+
+class Request:
+    def __init__(self, name: str, messages: list):
+        self.tool_call = {"name": name, "id": f"call_{len(messages)}", "args": {}}
+        self.state = {"messages": messages}
+
+
+async def run(recording: list, middlewares: list) -> dict:
+    """依次执行工具调用，返回整个任务发送的 token 数（每次模型调用都包含之前所有工具输出）"""
+    messages = []
+    total = 0
+    for step in recording:
+        async def handler(request, output=step["output"]):
+            return ToolMessage(content=output, tool_call_id=request.tool_call["id"])
+
+        call = handler
+        for middleware in reversed(middlewares):
+            call = (lambda m, inner: (lambda request: m.awrap_tool_call(request, inner)))(middleware, call)
+        message = await call(Request(step["tool"], messages))
+        messages.append(message)
+        total += sum(estimate_tokens(m.content) for m in messages)
+    return {"context_tokens": total, "last_call_tokens": sum(estimate_tokens(m.content) for m in messages)}
+
+
+async def main(args):
+    if args.recording:
+        with open(args.recording, "r", encoding="utf-8") as f:
+            recording = [json.loads(line) for line in f if line.strip()]
+    else:
+        recording = builtin_recording()
+
+    def store():
+        return ToolOutputStore(max_tokens=args.max_tokens)
+
+    truncate_store, diff_store = store(), store()
+    modes = {
+        "raw": [],
+        "truncate": [ToolOutputMiddleware(truncate_store)],
+        "diff": [ToolOutputMiddleware(diff_store),
+                 SnapshotDiffMiddleware(diff_store, max_ratio=args.max_ratio, max_chain=args.max_chain)],
+    }
+    print(f"{len(recording)} tool calls, {sum(estimate_tokens(s['output']) for s in recording)} tokens of raw output")
+    print(f"{'mode':<10}{'task tokens':>13}{'final ctx':>11}{'saved':>8}")
+    baseline = None
+    for mode, middlewares in modes.items():
+        result = await run(recording, middlewares)
+        baseline = baseline or result["context_tokens"]
+        print(f"{mode:<10}{result['context_tokens']:>13}{result['last_call_tokens']:>11}"
+              f"{1 - result['context_tokens'] / baseline:>8.0%}")
+    diff = modes["diff"][1].stats()
+    print(f"diff: {diff['diffs']}/{diff['snapshots']} snapshots sent as diffs")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="页面快照增量的 token 对比")
+    parser.add_argument("--recording", help="录制的工具输出（JSONL）")
+    parser.add_argument("--max-tokens", type=int, default=4000, help="单个工具输出的截断阈值")
+    parser.add_argument("--max-ratio", type=float, default=0.3, help="差异节点数超过快照节点数的该比例时发送完整快照")
+    parser.add_argument("--max-chain", type=int, default=5, help="连续发送增量的最大次数")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,125 @@
+"""SSE 帧输出基准测试
+
+模拟多个会话以固定速率产生 token，对比旧版逐 token 输出（每个 chunk 一个 ping 帧 + 一个 token 帧）
+与 SSEWriter 合并输出的帧数、每秒帧数、字节数和每个会话的 CPU 时间。
+每一帧都和 StreamingResponse 一样编码后经过一次 await 发送，以计入逐帧发送的开销。
+
+用法:
+    python bench/bench_sse.py --sessions 20 --tokens 1000 --interval 0.002
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from daemon import SSEWriter, SSE_TICK
+
+TOKENS = ["我", "正在", "打开", "页面", "，", "The ", "page ", "has ", "loaded", "。\n"]
+
+
+async def produce(queue: asyncio.Queue, tokens: int, interval: float):
+    for i in range(tokens):
+        await asyncio.sleep(interval)
+        queue.put_nowait(TOKENS[i % len(TOKENS)])
+    queue.put_nowait(None)
+
+
+class FrameSink:
+    """模拟 StreamingResponse：每帧编码后 await 一次 send"""
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+
+    async def send(self, frame: str):
+        body = frame.encode('utf-8')
+        self.frames += 1
+        self.bytes += len(body)
+        await asyncio.sleep(0)
+
+
+async def legacy_consumer(queue: asyncio.Queue, session_id: str, sink: FrameSink):
+    """旧版 stream_agent_response 的帧输出方式"""
+    while True:
+        content = await queue.get()
+        if content is None:
+            break
+        await sink.send(f"data: {json.dumps({'type': 'ping', 'timestamp': time.time()})}\n\n")
+        chunk_data = {'type': 'token', 'content': content, 'session_id': session_id, 'timestamp': time.time()}
+        await sink.send(f"data: {json.dumps(chunk_data, ensure_ascii=False)}\n\n")
+
+
+async def writer_consumer(queue: asyncio.Queue, session_id: str, sink: FrameSink, flush_interval: float, flush_bytes: int):
+    """与 stream_agent_response 相同的 SSEWriter 消费循环"""
+    writer = SSEWriter(session_id, flush_interval=flush_interval, flush_bytes=flush_bytes)
+    while True:
+        writer.arm(queue)
+        content = await queue.get()
+        if content is SSE_TICK:
+            frame = writer.due()
+            if frame:
+                await sink.send(frame)
+            continue
+        if content is None:
+            break
+        frame = writer.token(content)
+        if frame:
+            await sink.send(frame)
+    writer.disarm()
+    frame = writer.flush()
+    if frame:
+        await sink.send(frame)
+
+
+async def run(mode: str, args) -> dict:
+    sinks = [FrameSink() for _ in range(args.sessions)]
+    tasks = []
+    cpu_started = time.process_time()
+    wall_started = time.perf_counter()
+    for index, sink in enumerate(sinks):
+        queue = asyncio.Queue()
+        session_id = f"session_{index}"
+        tasks.append(produce(queue, args.tokens, args.interval))
+        if mode == "legacy":
+            tasks.append(legacy_consumer(queue, session_id, sink))
+        else:
+            tasks.append(writer_consumer(queue, session_id, sink, args.flush_interval, args.flush_bytes))
+    await asyncio.gather(*tasks)
+    wall = time.perf_counter() - wall_started
+    cpu = time.process_time() - cpu_started
+
+    frames = sum(sink.frames for sink in sinks)
+    return {
+        "frames": frames,
+        "frames_per_second": frames / wall,
+        "bytes": sum(sink.bytes for sink in sinks),
+        "cpu_ms_per_session": cpu / args.sessions * 1000,
+        "wall_seconds": wall,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SSE 帧输出基准测试")
+    parser.add_argument("--sessions", type=int, default=20, help="并发会话数")
+    parser.add_argument("--tokens", type=int, default=1000, help="每个会话的 token 数")
+    parser.add_argument("--interval", type=float, default=0.002, help="token 间隔（秒）")
+    parser.add_argument("--flush-interval", type=float, default=0.05, help="SSEWriter 合并间隔（秒）")
+    parser.add_argument("--flush-bytes", type=int, default=1024, help="SSEWriter 合并字节阈值")
+    args = parser.parse_args()
+
+    print(f"{args.sessions} sessions x {args.tokens} tokens, one token every {args.interval * 1000:.1f} ms")
+    print(f"{'mode':<10}{'frames':>10}{'frames/s':>12}{'KB':>10}{'CPU ms/session':>16}{'wall s':>9}")
+    for mode in ("legacy", "writer"):
+        result = asyncio.run(run(mode, args))
+        print(
+            f"{mode:<10}{result['frames']:>10}{result['frames_per_second']:>12.0f}{result['bytes'] / 1024:>10.1f}"
+            f"{result['cpu_ms_per_session']:>16.2f}{result['wall_seconds']:>9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
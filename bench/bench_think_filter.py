@@ -0,0 +1,143 @@
+"""think 标签流式过滤基准测试
+
+对比旧版基于 find 的逐 chunk 过滤与 ThinkTagFilter 状态机的耗时和输出正确性。
+
+用法:
+    python bench/bench_think_filter.py
+    python bench/bench_think_filter.py --recording chunks.jsonl   # 每行一个 JSON 数组，为一次回复的 chunk 序列
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from daemon import ThinkTagFilter
+
+
+def legacy_filter(chunks: list) -> str:
+    """旧版 stream_agent_response 中的过滤逻辑（逐 chunk find，strip 后追加空格）"""
+    in_think_block = False
+    result = ""
+    for content in chunks:
+        if content.strip().startswith('```') or content.strip().startswith('</'):
+            continue
+        if in_think_block:
+            if '</think>' in content:
+                content = content[content.find('</think>') + 8:]
+                in_think_block = False
+            else:
+                content = ""
+        else:
+            if '<think>' in content and '</think>' in content:
+                content = content[:content.find('<think>')] + content[content.find('</think>') + 8:]
+            elif '<think>' in content:
+                content = content[:content.find('<think>')]
+                in_think_block = True
+            elif '</think>' in content:
+                content = content[content.find('</think>') + 8:]
+        if not content.strip():
+            continue
+        result += content.strip() + " "
+    return result
+
+
+def state_machine_filter(chunks: list) -> str:
+    think_filter = ThinkTagFilter()
+    result = []
+    for chunk in chunks:
+        content = think_filter.feed(chunk)
+        if content:
+            result.append(content)
+    result.append(think_filter.flush())
+    return "".join(result)
+
+
+def expected_output(chunks: list) -> str:
+    text = "".join(chunks)
+    return re.sub(r'<think>.*?(?:</think>|\Z)|</think>', '', text, flags=re.DOTALL).lstrip()
+
+
+def split_randomly(text: str, rng: random.Random, min_size: int, max_size: int) -> list:
+    chunks = []
+    pos = 0
+    while pos < len(text):
+        size = rng.randint(min_size, max_size)
+        chunks.append(text[pos:pos + size])
+        pos += size
+    return chunks
+
+
+def synthetic_streams(seed: int = 42) -> dict:
+    """生成可复现的 chunk 流，模拟常见模型的输出形态"""
+    rng = random.Random(seed)
+    sentence = "我已经打开了页面，正在查找搜索框并输入关键词。The page has loaded.\n"
+    answer = "".join(sentence for _ in range(40))
+    reasoning = "".join(f"步骤 {i}: 分析当前页面结构，考虑下一步应该点击哪个元素。\n" for i in range(4000))
+
+    return {
+        # 普通模型：没有推理内容，每个 chunk 几个字符
+        "plain_answer": split_randomly(answer, rng, 2, 6),
+        # 推理模型：大段 think 内容（约 150K 字符），标签会被拆分在 chunk 边界上
+        "reasoning_small_chunks": split_randomly(f"<think>\n{reasoning}</think>\n\n{answer}", rng, 1, 8),
+        # 推理模型：后端按较大的块返回
+        "reasoning_large_chunks": split_randomly(f"<think>\n{reasoning}</think>\n\n{answer}", rng, 256, 4096),
+        # 多段推理与正文交替
+        "interleaved": split_randomly(
+            "".join(f"<think>第 {i} 段推理。</think>第 {i} 段回答。\n" for i in range(2000)), rng, 1, 12
+        ),
+    }
+
+
+def load_recording(path: str) -> dict:
+    streams = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for index, line in enumerate(f):
+            line = line.strip()
+            if line:
+                streams[f"recording_{index}"] = json.loads(line)
+    return streams
+
+
+def measure(func, chunks: list, repeat: int) -> tuple:
+    best = float("inf")
+    output = ""
+    for _ in range(repeat):
+        started = time.perf_counter()
+        output = func(chunks)
+        best = min(best, time.perf_counter() - started)
+    return best, output
+
+
+def main():
+    parser = argparse.ArgumentParser(description="think 标签流式过滤基准测试")
+    parser.add_argument("--recording", help="录制的 chunk 流（JSONL，每行一个 chunk 数组）")
+    parser.add_argument("--repeat", type=int, default=5, help="每个流重复次数，取最快一次")
+    args = parser.parse_args()
+
+    streams = load_recording(args.recording) if args.recording else synthetic_streams()
+
+    print(f"{'stream':<26}{'chunks':>8}{'chars':>10}{'legacy ms':>12}{'new ms':>10}{'new MB/s':>10}  legacy ok / new ok")
+    failed = False
+    for name, chunks in streams.items():
+        chars = sum(len(c) for c in chunks)
+        expected = expected_output(chunks)
+        legacy_time, legacy_output = measure(legacy_filter, chunks, args.repeat)
+        new_time, new_output = measure(state_machine_filter, chunks, args.repeat)
+        new_ok = new_output == expected
+        failed = failed or not new_ok
+        mb_per_second = len("".join(chunks).encode('utf-8')) / new_time / 1e6 if new_time else 0
+        print(
+            f"{name:<26}{len(chunks):>8}{chars:>10}{legacy_time * 1000:>12.2f}{new_time * 1000:>10.2f}"
+            f"{mb_per_second:>10.1f}  {str(legacy_output == expected):>9} / {new_ok}"
+        )
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
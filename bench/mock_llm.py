@@ -0,0 +1,254 @@
+"""OpenAI 兼容的本地模拟后端
+
+- POST /v1/chat/completions：支持流式和非流式，按请求内容返回确定的回复
+- 模拟前缀缓存：以消息为粒度记录见过的前缀，在 usage.prompt_tokens_details.cached_tokens 中返回命中的 token 数
+- GET /mock/requests：记录的请求（每条消息的前缀哈希），供测试检查请求前缀是否稳定
+- POST /mock/reset：清空缓存和请求记录
+- --rate-limit N：每秒超过 N 个请求时返回 429（带 Retry-After），用于测试多模型服务路由的限流处理
+
+回复规则：
+- 任务完成检查（最后一条消息是判定提示）在对话中的助手文字回复少于 --turns 条时回答 False，之后回答 True
+- 请求带有工具且最后一条消息不是工具结果时，先调用 --tool-calls 个工具（按工具列表轮流选择）
+- 其他情况返回一段固定的文字
+
+用法:
+    python bench/mock_llm.py --port 18080 --turns 3
+"""
+import re
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import argparse
+from collections import deque
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+CHECK_PROMPT_MARKER = "当前任务是否完成"
+_CJK_PATTERN = re.compile(r'[\u2e80-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+
+def estimate_tokens(text: str) -> int:
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def message_key(message: dict) -> str:
+    """消息的规范化表示：只包含会发送给模型的字段"""
+    fields = {k: message.get(k) for k in ("role", "content", "name", "tool_calls", "tool_call_id") if message.get(k)}
+    return json.dumps(fields, ensure_ascii=False, sort_keys=True)
+
+
+def content_text(message: dict) -> str:
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content
+
+
+class MockLLM:
+    """模拟后端的状态：前缀缓存、请求记录和回复规则"""
+
+    def __init__(self, turns: int = 3, min_cache_tokens: int = 1024, cache_block: int = 128,
+                 latency: float = 0.0, token_delay: float = 0.0, tool_calls: int = 0, rate_limit: int = 0):
+        self.turns = turns
+        self.rate_limit = rate_limit
+        self.recent = deque()
+        self.rate_limited = 0
+        self.tool_calls = tool_calls
+        self.min_cache_tokens = min_cache_tokens
+        self.cache_block = cache_block
+        self.latency = latency
+        self.token_delay = token_delay
+        self.reset()
+
+    def reset(self):
+        self.cache = set()
+        self.requests = []
+
+    def over_limit(self) -> bool:
+        """最近一秒内的请求数是否已经达到 rate_limit"""
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        while self.recent and now - self.recent[0] > 1.0:
+            self.recent.popleft()
+        if len(self.recent) >= self.rate_limit:
+            self.rate_limited += 1
+            return True
+        self.recent.append(now)
+        return False
+
+    def prefix_hashes(self, body: dict) -> tuple:
+        """每条消息结束处的前缀哈希，以及对应的累计 token 数；工具定义位于消息之前，也是前缀的一部分"""
+        head = json.dumps({"model": body.get("model"), "tools": body.get("tools")}, ensure_ascii=False, sort_keys=True)
+        digest = hashlib.sha1(head.encode("utf-8"))
+        total = estimate_tokens(head) if body.get("tools") else 0
+        hashes, tokens = [], []
+        for message in body.get("messages", []):
+            key = message_key(message)
+            digest.update(key.encode("utf-8"))
+            total += estimate_tokens(key)
+            hashes.append(digest.hexdigest()[:16])
+            tokens.append(total)
+        return hashes, tokens
+
+    def cached_tokens(self, hashes: list, tokens: list) -> int:
+        cached = 0
+        for prefix_hash, prefix_tokens in zip(hashes, tokens):
+            if prefix_hash not in self.cache:
+                break
+            cached = prefix_tokens
+        if cached < self.min_cache_tokens:
+            return 0
+        return cached // self.cache_block * self.cache_block if self.cache_block else cached
+
+    @staticmethod
+    def tool_arguments(tool: dict) -> str:
+        """按工具参数的名称填入固定的参数值"""
+        values = {"url": "https://example.com", "ref": "e1", "element": "示例链接 1", "text": "everBrowser"}
+        parameters = tool.get("function", {}).get("parameters") or {}
+        required = parameters.get("required") or list((parameters.get("properties") or {}).keys())
+        return json.dumps({name: values.get(name, "x") for name in required}, ensure_ascii=False)
+
+    def reply(self, messages: list, tools: list) -> tuple:
+        """返回 (文字回复, 工具调用列表)"""
+        text_turns = sum(1 for m in messages if m.get("role") == "assistant" and m.get("content"))
+        if messages and CHECK_PROMPT_MARKER in content_text(messages[-1]):
+            return ("False" if text_turns < self.turns else "True"), []
+        if tools and self.tool_calls and messages and messages[-1].get("role") != "tool":
+            calls = []
+            for index in range(self.tool_calls):
+                tool = tools[(len(messages) + index) % len(tools)]
+                calls.append({
+                    "id": f"call_{uuid.uuid4().hex[:12]}",
+                    "type": "function",
+                    "function": {"name": tool["function"]["name"], "arguments": self.tool_arguments(tool)},
+                })
+            return None, calls
+        return f"第 {text_turns + 1} 步：已经在页面上完成了这一步操作。", []
+
+    def handle(self, body: dict) -> tuple:
+        """返回 (文字回复, 工具调用列表, usage, 请求记录)"""
+        messages = body.get("messages", [])
+        hashes, tokens = self.prefix_hashes(body)
+        prompt_tokens = tokens[-1] if tokens else 0
+        cached = self.cached_tokens(hashes, tokens)
+        self.cache.update(hashes)
+
+        content, tool_calls = self.reply(messages, body.get("tools") or [])
+        completion_tokens = estimate_tokens(content or json.dumps(tool_calls))
+        first_user = next((content_text(m) for m in messages if m.get("role") == "user"), "")
+        record = {
+            "kind": "check" if messages and CHECK_PROMPT_MARKER in content_text(messages[-1]) else "agent",
+            "conversation": first_user[:80],
+            "stream": bool(body.get("stream")),
+            "roles": [m.get("role") for m in messages],
+            "hashes": hashes,
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached,
+            "tool_calls": len(tool_calls),
+            "tool_names": [call["function"]["name"] for call in tool_calls],
+            "service_seconds": 0.0,
+        }
+        self.requests.append(record)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached},
+        }
+        return content, tool_calls, usage, record
+
+
+def create_app(mock: MockLLM) -> FastAPI:
+    app = FastAPI(title="mock llm")
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        started = time.perf_counter()
+        body = await request.json()
+        if mock.over_limit():
+            return JSONResponse({"error": {"message": "Rate limit exceeded", "type": "rate_limit_error"}},
+                                status_code=429, headers={"Retry-After": "1"})
+        content, tool_calls, usage, record = mock.handle(body)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        model = body.get("model", "mock")
+        finish_reason = "tool_calls" if tool_calls else "stop"
+        if mock.latency:
+            await asyncio.sleep(mock.latency)
+
+        if not body.get("stream"):
+            message = {"role": "assistant", "content": content}
+            if tool_calls:
+                message["tool_calls"] = tool_calls
+            record["service_seconds"] = time.perf_counter() - started
+            return JSONResponse({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+                "usage": usage,
+            })
+
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+        async def stream():
+            def frame(choices, **extra):
+                data = {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                        "model": model, "choices": choices, **extra}
+                return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+            yield frame([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+            for index, call in enumerate(tool_calls):
+                yield frame([{"index": 0, "delta": {"tool_calls": [{"index": index, **call}]}, "finish_reason": None}])
+            for start in range(0, len(content or ""), 4):
+                if mock.token_delay:
+                    await asyncio.sleep(mock.token_delay)
+                yield frame([{"index": 0, "delta": {"content": content[start:start + 4]}, "finish_reason": None}])
+            yield frame([{"index": 0, "delta": {}, "finish_reason": finish_reason}])
+            if include_usage:
+                yield frame([], usage=usage)
+            yield "data: [DONE]\n\n"
+            record["service_seconds"] = time.perf_counter() - started
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    @app.get("/mock/requests")
+    async def requests():
+        return mock.requests
+
+    @app.post("/mock/reset")
+    async def reset():
+        mock.reset()
+        return {"success": True}
+
+    return app
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="OpenAI 兼容的本地模拟后端")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--turns", type=int, default=3, help="任务完成检查回答 True 之前的助手回复条数")
+    parser.add_argument("--min-cache-tokens", type=int, default=1024, help="前缀缓存生效的最小 token 数")
+    parser.add_argument("--latency", type=float, default=0.0, help="每次请求的首包延迟（秒）")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="流式输出每个 chunk 的间隔（秒）")
+    parser.add_argument("--tool-calls", type=int, default=0, help="每轮先调用的工具数量")
+    parser.add_argument("--rate-limit", type=int, default=0, help="每秒超过该请求数时返回 429，0 表示不限流")
+    args = parser.parse_args()
+
+    mock = MockLLM(turns=args.turns, min_cache_tokens=args.min_cache_tokens,
+                   latency=args.latency, token_delay=args.token_delay, tool_calls=args.tool_calls,
+                   rate_limit=args.rate_limit)
+    uvicorn.run(create_app(mock), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""模拟 @playwright/mcp 的 stdio MCP 服务器
+
+提供与 Playwright MCP 同名的几个浏览器工具，不启动真实浏览器，按配置的延迟返回确定的结果，
+用于离线的端到端测试。
+
+用法（在 config.json 中）:
+    "mcp": {"command": "python", "args": ["bench/mock_mcp.py", "--latency", "0.05"]}
+"""
+import asyncio
+import argparse
+
+from mcp.server.fastmcp import FastMCP
+
+parser = argparse.ArgumentParser(description="模拟 Playwright MCP 服务器")
+parser.add_argument("--latency", type=float, default=0.05, help="每次工具调用的延迟（秒）")
+parser.add_argument("--snapshot-size", type=int, default=2000, help="页面快照的字符数")
+parser.add_argument("--hang", action="append", default=[], help="调用后永不返回的工具（模拟卡住的页面跳转，可重复）")
+args = parser.parse_args()
+
+mcp = FastMCP("mock-playwright")
+state = {"url": "about:blank", "typed": ""}
+
+
+async def work(name: str):
+    if name in args.hang:
+        await asyncio.Event().wait()
+    await asyncio.sleep(args.latency)
+
+
+def snapshot() -> str:
+    lines = [f"- Page URL: {state['url']}", "- Page Snapshot:", "```yaml"]
+    index = 0
+    while sum(len(line) + 1 for line in lines) < args.snapshot_size:
+        lines.append(f'- link "示例链接 {index}" [ref=e{index}]')
+        index += 1
+    lines.append("```")
+    return "\n".join(lines)
+
+
+@mcp.tool()
+async def browser_navigate(url: str) -> str:
+    """Navigate to a URL"""
+    await work("browser_navigate")
+    state["url"] = url
+    return snapshot()
+
+
+@mcp.tool()
+async def browser_snapshot() -> str:
+    """Capture accessibility snapshot of the current page"""
+    await work("browser_snapshot")
+    return snapshot()
+
+
+@mcp.tool()
+async def browser_click(element: str, ref: str) -> str:
+    """Perform click on a web page"""
+    await work("browser_click")
+    return f"Clicked {element} ({ref})\n" + snapshot()
+
+
+@mcp.tool()
+async def browser_type(element: str, ref: str, text: str) -> str:
+    """Type text into editable element"""
+    await work("browser_type")
+    state["typed"] = text
+    return f"Typed into {element} ({ref})"
+
+
+if __name__ == "__main__":
+    mcp.run()
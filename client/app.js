@@ -220,6 +220,9 @@ async function streamChat(conversationHistory, messageId) {
     // 设置placeholder为思考状态
     input.placeholder = 'everBrowser AI 正在思考...';
 
+    // 订阅会话状态变化，显示当前正在做什么
+    const stateEvents = subscribeSessionState(currentSessionId);
+
     try {
         const response = await fetch(`${API_BASE_URL}/chat/stream`, {
             method: 'POST',
@@ -239,13 +242,17 @@ async function streamChat(conversationHistory, messageId) {
 
         const reader = response.body.getReader();
         const decoder = new TextDecoder();
+        // 服务端会把多个 token 合并成一帧，一帧也可能被拆分在多次读取中，
+        // 所以按行缓存，只处理已经完整接收的行
+        let buffer = '';
 
         while (true) {
             const { done, value } = await reader.read();
             if (done) break;
 
-            const chunk = decoder.decode(value);
-            const lines = chunk.split('\n');
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
 
             for (const line of lines) {
                 if (line.startsWith('data: ')) {
@@ -281,6 +288,7 @@ async function streamChat(conversationHistory, messageId) {
             }
         }
     } finally {
+        stateEvents.close();
         isStreaming = false;
         currentAbortController = null;
         // 确保按钮状态恢复为发送状态
@@ -290,6 +298,31 @@ async function streamChat(conversationHistory, messageId) {
     }
 }
 
+// 会话状态对应的状态栏文字
+const SESSION_STATE_LABELS = {
+    'streaming': ['思考中...', 'warning'],
+    'tool-running': ['正在操作浏览器...', 'warning'],
+    'checking': ['检查任务进度...', 'warning'],
+    'paused': ['已暂停', 'warning']
+};
+
+// 订阅服务端推送的会话状态（streaming / tool-running / checking / paused / idle）
+function subscribeSessionState(sessionId) {
+    const source = new EventSource(`${API_BASE_URL}/chat/events?session_id=${encodeURIComponent(sessionId)}`);
+    source.onmessage = (event) => {
+        try {
+            const data = JSON.parse(event.data);
+            const label = SESSION_STATE_LABELS[data.state];
+            if (data.type === 'state' && label && isStreaming) {
+                updateStatus(label[0], label[1]);
+            }
+        } catch (e) {
+            console.error('State parse error:', e);
+        }
+    };
+    return source;
+}
+
 // Add Message
 function addMessage(role, content, id = null) {
     const welcome = messagesContainer.querySelector('.welcome');
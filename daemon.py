@@ -1,20 +1,37 @@
 # Core and Utils
 import os
+import re
 import sys
 import json
 import time
+import uuid
+import socket
 import asyncio
 import platform
-import threading
-import traceback
 import subprocess
+import sqlite3
+import bisect
+import random
+import hashlib
+import gzip
+import weakref
+import contextvars
+import importlib.metadata
+import logging
+import logging.handlers
+import queue
+import urllib.parse
+import urllib.request
+import httpx
 import psutil
+from collections import deque, OrderedDict
+from contextlib import asynccontextmanager, contextmanager
 from playwright.async_api import async_playwright
-from typing import AsyncGenerator
+from typing import Any, AsyncGenerator, Optional
 
 # FastAPI
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse, FileResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 import uvicorn
@@ -24,8 +41,14 @@ from pydantic import BaseModel
 from langchain_mcp_adapters.client import MultiServerMCPClient
 from langchain_mcp_adapters.tools import load_mcp_tools
 from langchain.agents import create_agent
+from langchain.agents.middleware import AgentMiddleware
 from langchain_openai import ChatOpenAI
-from langchain.messages import HumanMessage, AIMessage, SystemMessage
+from langchain.messages import HumanMessage, AIMessage, AIMessageChunk, SystemMessage, ToolMessage
+from langchain.chat_models import BaseChatModel
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.language_models.chat_models import agenerate_from_stream
+from langchain_core.outputs import ChatGenerationChunk
+from langchain.tools import tool
 
 # Show Image
 import tkinter
@@ -33,7 +56,132 @@ from PIL import Image, ImageTk
 
 # Constants
 LOCK_FILE = "everbrowser.lock"
-CHECK_INTERVAL = 3  # seconds
+
+# ===== 日志 =====
+
+log = logging.getLogger("everbrowser")
+log_session = contextvars.ContextVar("log_session", default=None)
+
+# LogRecord 自带的属性，其余属性来自 extra={...}，JSON 格式下原样输出
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "session_id", "sample_rate"}
+
+
+class LogContextFilter(logging.Filter):
+    """在调用方线程上运行：补上当前会话 ID，并按消息模板对 DEBUG 记录抽样（每个模板保留第 1、N+1、2N+1... 条）"""
+
+    def __init__(self, sample_every: int = 1):
+        super().__init__()
+        self.sample_every = max(1, sample_every)
+        self._seen = {}
+        self.sampled_out = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "session_id", None) is None:
+            record.session_id = log_session.get()
+        if record.levelno <= logging.DEBUG and self.sample_every > 1:
+            if len(self._seen) > 1000:
+                self._seen.clear()
+            count = self._seen.get(record.msg, 0)
+            self._seen[record.msg] = count + 1
+            if count % self.sample_every:
+                self.sampled_out += 1
+                return False
+            record.sample_rate = self.sample_every
+        return True
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """在调用方线程上只合并消息参数、展开异常，格式化和写出都留给后台线程"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonLogFormatter(logging.Formatter):
+    """每条记录输出一行 JSON：ts、level、logger、message，以及 session_id、sample_rate、exception 和 extra 字段"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "session_id", None) is not None:
+            entry["session_id"] = record.session_id
+        if getattr(record, "sample_rate", None):
+            entry["sample_rate"] = record.sample_rate
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogPipeline:
+    """异步日志：记录放入无锁队列后立即返回，由 QueueListener 的后台线程格式化并写到标准输出和 file
+
+    DEBUG 关闭时 log.debug() 只做一次有缓存的级别判断；代价较高的参数（例如整个 tool_calls 结构）
+    在调用前用 log.isEnabledFor(logging.DEBUG) 判断，关闭时完全不会计算。
+    """
+
+    def __init__(self, level: str = "INFO", fmt: str = "text", path: str = None, debug_sample_every: int = 1):
+        self.level = logging.getLevelName(str(level).upper())
+        if not isinstance(self.level, int):
+            self.level = logging.INFO
+        self.format = fmt
+        self.path = path
+        self.filter = LogContextFilter(debug_sample_every)
+        self._queue = queue.SimpleQueue()
+        self._listener = None
+
+    @classmethod
+    def from_config(cls, config: dict):
+        logging_config = config.get("logging", {})
+        return cls(
+            level=logging_config.get("level", "INFO"),
+            fmt=logging_config.get("format", "text"),
+            path=logging_config.get("file"),
+            debug_sample_every=logging_config.get("debug_sample_every", 10),
+        )
+
+    def start(self):
+        formatter = JsonLogFormatter() if self.format == "json" else logging.Formatter("[%(levelname)s] %(message)s")
+        handlers = [logging.StreamHandler(sys.stdout)]
+        if self.path:
+            handlers.append(logging.FileHandler(self.path, encoding="utf-8"))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        queue_handler = LogQueueHandler(self._queue)
+        queue_handler.addFilter(self.filter)
+        for handler in list(log.handlers):
+            log.removeHandler(handler)
+        log.addHandler(queue_handler)
+        log.setLevel(self.level)
+        log.propagate = False
+        self._listener = logging.handlers.QueueListener(self._queue, *handlers)
+        self._listener.start()
+
+    def stop(self):
+        """等待队列中的记录全部写出后停止后台线程"""
+        if self._listener is not None:
+            self._listener.stop()
+            for handler in self._listener.handlers:
+                handler.close()
+            self._listener = None
+
+    def stats(self) -> dict:
+        return {"level": logging.getLevelName(self.level), "format": self.format, "file": self.path,
+                "queued": self._queue.qsize(), "debug_sampled_out": self.filter.sampled_out}
+
+log_pipeline = LogPipeline()
 
 def check_single_instance():
     """检查是否已有守护进程在运行"""
@@ -47,7 +195,7 @@ def check_single_instance():
                 try:
                     proc = psutil.Process(pid)
                     if proc.is_running() and 'python' in proc.name().lower():
-                        print(f"❌ 守护进程已在运行 (PID: {pid})")
+                        log.error(f"❌ 守护进程已在运行 (PID: {pid})")
                         return False
                 except (psutil.NoSuchProcess, psutil.AccessDenied):
                     pass
@@ -68,55 +216,166 @@ def cleanup_lock_file():
         if os.path.exists(LOCK_FILE):
             os.remove(LOCK_FILE)
     except Exception as e:
-        print(f"⚠️ 清理锁文件失败: {e}")
+        log.warning(f"⚠️ 清理锁文件失败: {e}")
 
-def find_playwright_browser():
-    """查找最新启动的 Playwright 浏览器进程"""
-    playwright_processes = []
+class BrowserSupervisor:
+    """监督 npx playwright cr 启动的浏览器
 
-    for proc in psutil.process_iter(['pid', 'name', 'cmdline', 'create_time', 'exe']):
-        try:
-            cmdline = proc.info.get('cmdline', [])
-            exe_path = proc.info.get('exe', '')
-            
-            # 检查可执行文件路径是否包含 playwright
-            if exe_path and 'playwright' in exe_path.lower():
-                # 检查是否是浏览器进程（chrome, chromium, firefox, webkit）
-                name = proc.info.get('name', '').lower()
-                if any(browser in name for browser in ['chrome', 'chromium']):
-                    playwright_processes.append({
-                        'pid': proc.info['pid'],
-                        'name': proc.info['name'],
-                        'exe': exe_path,
-                        'create_time': proc.info['create_time']
-                    })
-        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-            continue
+    直接持有启动的子进程并等待它退出（由 asyncio 的子进程监视器通知），不扫描系统进程表，也不阻塞事件循环。
+    浏览器窗口关闭后 playwright cr 随之退出，exited 事件立即被设置。
+    """
 
-    # 按创建时间排序，返回最新的
-    if playwright_processes:
-        playwright_processes.sort(key=lambda x: x['create_time'], reverse=True)
-        return playwright_processes[0]['pid']
+    def __init__(self, url: str):
+        self.url = url
+        self.process = None
+        self.returncode = None
+        self.started_at = None
+        self.exited = asyncio.Event()
+        self._task = None
 
-    return None
+    async def start(self):
+        if os.name == 'nt':  # Windows
+            self.process = await asyncio.create_subprocess_shell(
+                f"npx playwright cr {self.url}",
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+        else:  # Unix / Linux / macOS
+            self.process = await asyncio.create_subprocess_exec(
+                "npx", "playwright", "cr", self.url,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+        self.started_at = time.time()
+        log.info(f"✅ 浏览器已启动 (PID: {self.process.pid})")
+        self._task = asyncio.create_task(self._wait())
+
+    async def _wait(self):
+        self.returncode = await self.process.wait()
+        log.info(f"🛑 浏览器进程已关闭 (PID: {self.process.pid}, 退出码: {self.returncode})")
+        self.exited.set()
+
+    async def stop(self, timeout: float = 5):
+        """关闭浏览器及其子进程"""
+        if self.process is None or self.exited.is_set():
+            return
+        try:
+            children = psutil.Process(self.process.pid).children(recursive=True)
+        except psutil.Error:
+            children = []
+        for proc in [*children, psutil.Process(self.process.pid)]:
+            try:
+                proc.terminate()
+            except psutil.Error:
+                pass
+        try:
+            await asyncio.wait_for(self.exited.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.process.kill()
 
-def monitor_browser_process(browser_pid):
-    """监控浏览器进程，如果进程结束则退出守护进程"""
-    print(f"🔍 开始监控浏览器进程 (PID: {browser_pid})")
+    def stats(self) -> dict:
+        return {
+            "mode": "launcher",
+            "pid": self.process.pid if self.process else None,
+            "running": self.process is not None and not self.exited.is_set(),
+            "returncode": self.returncode,
+            "started_at": self.started_at,
+        }
 
-    try:
-        while True:
-            if not psutil.pid_exists(browser_pid):
-                print(f"\n🛑 浏览器进程已关闭 (PID: {browser_pid})")
-                print("🛑 正在退出守护进程...")
-                cleanup_lock_file()
-                os._exit(0)
+class InProcessBrowser:
+    """在守护进程内通过 Playwright 异步 API 启动的用户浏览器
+
+    使用持久化的用户目录启动一个浏览器并打开远程调试端口，聊天界面在其中打开，
+    MCP 服务器通过 --cdp-endpoint 连接同一个浏览器，不再为界面和 Agent 各启动一个浏览器和 Node 进程。
+    agent_context 为 isolated 时每个浏览器会话在该浏览器中使用独立的上下文，为 shared 时与界面共用上下文（共享登录状态）。
+    与 BrowserSupervisor 相同，浏览器被关闭后 exited 事件被设置。
+    """
+
+    def __init__(self, user_data_dir: str = ".everbrowser/profile", channel: str = "chrome",
+                 cdp_port: int = 0, agent_context: str = "isolated"):
+        self.user_data_dir = user_data_dir
+        self.channel = channel
+        self.cdp_port = cdp_port
+        self.agent_context = agent_context
+        self.playwright = None
+        self.context = None
+        self.returncode = None
+        self.started_at = None
+        self.exited = asyncio.Event()
+
+    @classmethod
+    def from_config(cls, config: dict):
+        browser_config = config.get("browser", {})
+        return cls(
+            user_data_dir=browser_config.get("user_data_dir", ".everbrowser/profile"),
+            channel=browser_config.get("channel", "chrome"),
+            cdp_port=browser_config.get("cdp_port", 0),
+            agent_context=browser_config.get("agent_context", "isolated"),
+        )
 
-            time.sleep(CHECK_INTERVAL)
-    except Exception as e:
-        print(f"⚠️ 监控进程出错: {e}")
-        cleanup_lock_file()
-        os._exit(1)
+    @property
+    def cdp_endpoint(self) -> str:
+        return f"http://127.0.0.1:{self.cdp_port}"
+
+    def mcp_args(self) -> list:
+        """传给 @playwright/mcp 的参数，让它连接到这个浏览器"""
+        args = ["--cdp-endpoint", self.cdp_endpoint]
+        if self.agent_context == "isolated":
+            args.append("--isolated")
+        return args
+
+    async def launch(self):
+        if not self.cdp_port:
+            with socket.socket() as sock:
+                sock.bind(("127.0.0.1", 0))
+                self.cdp_port = sock.getsockname()[1]
+        self.playwright = await async_playwright().start()
+        self.context = await self.playwright.chromium.launch_persistent_context(
+            self.user_data_dir,
+            channel=None if self.channel in (None, "chromium") else self.channel,
+            headless=False,
+            no_viewport=True,
+            args=[f"--remote-debugging-port={self.cdp_port}"],
+            # 由守护进程在退出时关闭浏览器
+            handle_sigint=False,
+            handle_sigterm=False,
+            handle_sighup=False,
+        )
+        self.context.on("close", lambda _: self._on_close())
+        self.started_at = time.time()
+        log.info(f"✅ 浏览器已启动 (CDP: {self.cdp_endpoint})")
+
+    async def open(self, url: str):
+        """在启动时的空白页中打开聊天界面"""
+        page = self.context.pages[0] if self.context.pages else await self.context.new_page()
+        await page.goto(url)
+
+    def _on_close(self):
+        if not self.exited.is_set():
+            log.info(f"🛑 浏览器已关闭 (CDP: {self.cdp_endpoint})")
+            self.returncode = 0
+            self.exited.set()
+
+    async def stop(self, timeout: float = 5):
+        try:
+            if self.context and not self.exited.is_set():
+                await asyncio.wait_for(self.context.close(), timeout)
+        except Exception as e:
+            log.warning(f"Failed to close browser: {e}")
+        finally:
+            if self.playwright:
+                await self.playwright.stop()
+                self.playwright = None
+
+    def stats(self) -> dict:
+        return {
+            "mode": "inprocess",
+            "cdp_endpoint": self.cdp_endpoint,
+            "agent_context": self.agent_context,
+            "running": self.context is not None and not self.exited.is_set(),
+            "pages": len(self.context.pages) if self.context and not self.exited.is_set() else 0,
+            "started_at": self.started_at,
+        }
 
 system_msg = SystemMessage("""
 # 角色
@@ -137,30 +396,3721 @@ system_msg = SystemMessage("""
 - **工具调用是廉价的**：不要担心调用太多工具，系统设计就是为了支持长工具调用链。
 """)
 
+# ===== MCP 浏览器会话池 =====
+
+class BrowserSessionWedged(Exception):
+    """浏览器会话的熔断器已断开：MCP 会话需要重启后才能继续使用"""
+
+
+class CircuitBreaker:
+    """一个 MCP 会话的熔断器：工具调用连续超时或出错达到 threshold 次后断开
+
+    断开后该会话上的工具调用立即失败，由持有租约的流重启会话，重启后复位。
+    """
+
+    def __init__(self, threshold: int = 2):
+        self.threshold = max(1, threshold)
+        self.failures = 0
+        self.open = False
+        self.trips = 0
+
+    def success(self):
+        self.failures = 0
+
+    def failure(self) -> bool:
+        """记录一次失败，返回熔断器是否因此断开"""
+        self.failures += 1
+        if not self.open and self.failures >= self.threshold:
+            self.open = True
+            self.trips += 1
+            return True
+        return False
+
+    def reset(self):
+        self.failures = 0
+        self.open = False
+
+
+# 当前这一轮 Agent 输出使用的池中浏览器（工具调用据此找到所属会话的熔断器）
+current_browser = contextvars.ContextVar("current_browser", default=None)
+
+class PooledBrowser:
+    """池中的一个浏览器：一个独立的 MCP stdio 会话（即一个 @playwright/mcp 进程）及其 Agent"""
+
+    def __init__(self, pool, index: int):
+        self.pool = pool
+        self.index = index
+        self.session = None
+        self.tools = []
+        self.agent = None
+        self.owner = None        # 最近使用该浏览器的 session_id（用于会话粘滞）
+        self.leased_by = None    # 当前租用者 session_id，None 表示空闲
+        self.last_used = time.monotonic()
+        self._ready = asyncio.Event()
+        self._closing = asyncio.Event()
+        self._task = None
+        self._error = None
+        self.breaker = CircuitBreaker(pool.breaker_threshold)
+        self.restarts = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.agent is not None and not self._closing.is_set()
+
+    async def start(self):
+        """启动会话，等待 MCP 握手和工具加载完成"""
+        # MCP 会话的上下文必须在同一个任务中进入和退出，所以由专属任务持有
+        self._task = asyncio.create_task(self._run())
+        await self._ready.wait()
+        if self._error:
+            raise self._error
+
+    async def _run(self):
+        try:
+            async with self.pool.client.session(self.pool.server_name) as session:
+                self.session = session
+                self.tools = await load_mcp_tools(session)
+                self.agent = self.pool.agent_factory(self.tools)
+                self._ready.set()
+                await self._closing.wait()
+        except Exception as e:
+            self._error = e
+            log.error(f"Browser session #{self.index} failed: {e}")
+        finally:
+            self.session = None
+            self.agent = None
+            self._ready.set()
+
+    async def close(self):
+        """关闭会话（会结束对应的 MCP 进程）"""
+        self._closing.set()
+        if self._task:
+            await self._task
+
+    async def restart(self, timeout: float = 10):
+        """关闭卡住的 MCP 会话并在原位重新启动，租约和粘滞关系不变
+
+        卡住的进程可能不响应正常关闭，超过 timeout 秒后直接取消持有会话的任务。
+        """
+        self._closing.set()
+        if self._task:
+            try:
+                await asyncio.wait_for(self._task, timeout)
+            except asyncio.TimeoutError:
+                log.warning(f"Browser session #{self.index} did not close in {timeout}s, cancelled")
+        self._ready = asyncio.Event()
+        self._closing = asyncio.Event()
+        self._error = None
+        self.restarts += 1
+        await self.start()
+        self.breaker.reset()
+
+
+class MCPSessionPool:
+    """MCP 浏览器会话池
+
+    - 每个会话拥有独立的 MCP 进程和 Agent，不同 session_id 之间不再共用同一个浏览器
+    - 同一个 session_id 优先租用上次使用的浏览器（粘滞），保证对话停留在同一页面上
+    - 池满且全部繁忙时排队等待；空闲超过 idle_timeout 的会话会被回收
+    - 在后台保持 spare 个已完成握手和工具加载的空闲会话，新对话不需要等待 MCP 进程启动
+    """
+
+    def __init__(self, client, server_name: str, agent_factory,
+                 max_size: int = 3, min_size: int = 1, spare: int = 1,
+                 idle_timeout: float = 600, acquire_timeout: float = None, breaker_threshold: int = 2):
+        self.client = client
+        self.server_name = server_name
+        self.agent_factory = agent_factory
+        self.max_size = max(1, max_size)
+        self.min_size = max(0, min(min_size, self.max_size))
+        self.spare = max(0, spare)
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self.breaker_threshold = breaker_threshold
+        self.restarts = 0
+        self.restart_failures = 0
+        self._browsers = []      # 所有存活的浏览器
+        self._by_owner = {}      # {session_id: PooledBrowser}
+        self._starting = 0       # 正在启动的浏览器数量
+        self._starting_spares = 0  # 其中在后台预热的数量
+        self._spare_tasks = set()
+        self._closed = False
+        self._waiting = 0        # 排队等待的请求数量
+        self._next_index = 0
+        self._cond = asyncio.Condition()
+        self._evict_task = None
+
+    @classmethod
+    def from_config(cls, client, server_name: str, agent_factory, config: dict):
+        """根据 config.json 中的 mcp_pool 配置创建会话池"""
+        pool_config = config.get("mcp_pool", {})
+        return cls(
+            client,
+            server_name,
+            agent_factory,
+            max_size=pool_config.get("max_size", 3),
+            min_size=pool_config.get("min_size", 1),
+            spare=pool_config.get("spare", 1),
+            idle_timeout=pool_config.get("idle_timeout", 600),
+            acquire_timeout=pool_config.get("acquire_timeout"),
+            breaker_threshold=pool_config.get("breaker_threshold", 2),
+        )
+
+    async def start(self):
+        """并行启动 min_size 个浏览器会话，然后开始后台预热和空闲回收"""
+        results = await asyncio.gather(*(self._spawn() for _ in range(self.min_size)), return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        async with self._cond:
+            self._browsers.extend(r for r in results if not isinstance(r, BaseException))
+            if not errors:
+                self._schedule_spares()
+        if errors:
+            raise errors[0]
+        self._evict_task = asyncio.create_task(self._evict_idle_loop())
+
+    async def _spawn(self) -> PooledBrowser:
+        self._next_index += 1
+        browser = PooledBrowser(self, self._next_index)
+        await browser.start()
+        log.info(f"Browser session #{browser.index} ready ({len(browser.tools)} tools)")
+        return browser
+
+    def _free_spares(self) -> int:
+        return sum(1 for b in self._browsers if b.leased_by is None and b.owner is None and b.alive)
+
+    def _schedule_spares(self):
+        """在后台补足空闲的备用会话（调用时需持有条件锁）"""
+        if self._closed:
+            return
+        missing = self.spare - self._free_spares() - self._starting_spares
+        capacity = self.max_size - len(self._browsers) - self._starting
+        for _ in range(max(0, min(missing, capacity))):
+            self._starting += 1
+            self._starting_spares += 1
+            task = asyncio.create_task(self._start_spare())
+            self._spare_tasks.add(task)
+            task.add_done_callback(self._spare_tasks.discard)
+
+    async def _start_spare(self):
+        try:
+            browser = await self._spawn()
+        except Exception as e:
+            # 失败后不立即重试，下一次租用时再补充
+            log.error(f"Failed to pre-warm browser session: {e}")
+            browser = None
+        async with self._cond:
+            self._starting -= 1
+            self._starting_spares -= 1
+            if browser is not None:
+                self._browsers.append(browser)
+            self._cond.notify_all()
+        if browser is not None and self._closed:
+            await browser.close()
+
+    def _pick_free(self, session_id: str):
+        """选择一个空闲浏览器：优先粘滞的浏览器，其次无主的，最后最久未使用的"""
+        sticky = self._by_owner.get(session_id)
+        if sticky is not None and sticky.alive:
+            # 粘滞浏览器正在被其他会话使用时等待它，而不是换到别的页面上
+            return sticky if sticky.leased_by is None else None
+
+        free = [b for b in self._browsers if b.leased_by is None and b.alive]
+        if not free:
+            return None
+        free.sort(key=lambda b: (b.owner is not None, b.last_used))
+        return free[0]
+
+    def _lease_to(self, browser: PooledBrowser, session_id: str) -> PooledBrowser:
+        if browser.owner is not None and browser.owner != session_id:
+            self._by_owner.pop(browser.owner, None)
+        browser.owner = session_id
+        browser.leased_by = session_id
+        browser.last_used = time.monotonic()
+        self._by_owner[session_id] = browser
+        self._schedule_spares()
+        return browser
+
+    async def acquire(self, session_id: str) -> PooledBrowser:
+        """为 session_id 租用一个浏览器，池满时排队等待"""
+        deadline = None if self.acquire_timeout is None else time.monotonic() + self.acquire_timeout
+
+        async with self._cond:
+            while True:
+                browser = self._pick_free(session_id)
+                if browser is not None:
+                    return self._lease_to(browser, session_id)
+
+                sticky = self._by_owner.get(session_id)
+                sticky_busy = sticky is not None and sticky.alive
+                if not sticky_busy and len(self._browsers) + self._starting < self.max_size:
+                    # 还有容量，启动新浏览器（启动期间释放条件锁，不阻塞其他会话）
+                    self._starting += 1
+                    self._cond.release()
+                    browser = None
+                    try:
+                        browser = await self._spawn()
+                    finally:
+                        await self._cond.acquire()
+                        self._starting -= 1
+                        if browser is None:
+                            # 启动失败：归还预留的容量并唤醒排队的请求，它们可以自己重新尝试启动
+                            self._cond.notify_all()
+                    self._browsers.append(browser)
+                    return self._lease_to(browser, session_id)
+
+                # 全部繁忙，排队等待
+                timeout = None if deadline is None else deadline - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    raise TimeoutError("浏览器会话池繁忙，请稍后再试")
+                self._waiting += 1
+                try:
+                    await asyncio.wait_for(self._cond.wait(), timeout)
+                except asyncio.TimeoutError:
+                    raise TimeoutError("浏览器会话池繁忙，请稍后再试")
+                finally:
+                    self._waiting -= 1
+
+    async def release(self, browser: PooledBrowser):
+        """归还浏览器并唤醒排队的请求"""
+        async with self._cond:
+            browser.leased_by = None
+            browser.last_used = time.monotonic()
+            if not browser.alive and browser in self._browsers:
+                self._browsers.remove(browser)
+                self._by_owner.pop(browser.owner, None)
+            self._cond.notify_all()
+
+    async def restart(self, browser: PooledBrowser):
+        """重启熔断的浏览器会话（由持有租约的流调用）；失败时该浏览器在归还时被移出池"""
+        log.info(f"Restarting browser session #{browser.index} (breaker open: {browser.breaker.open})")
+        try:
+            await browser.restart()
+        except Exception:
+            self.restart_failures += 1
+            raise
+        self.restarts += 1
+        log.info(f"Browser session #{browser.index} restarted ({len(browser.tools)} tools)")
+
+    @asynccontextmanager
+    async def lease(self, session_id: str, browser: PooledBrowser = None):
+        """租用浏览器，退出时归还；browser 为调用方已经 acquire 到的浏览器时只负责归还"""
+        if browser is None:
+            browser = await self.acquire(session_id)
+        try:
+            yield browser
+        finally:
+            await self.release(browser)
+
+    async def _evict_idle_loop(self):
+        """定期回收空闲过久的浏览器，保留 min_size 个"""
+        interval = max(1.0, min(self.idle_timeout / 4, 60.0))
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            evicted = []
+            async with self._cond:
+                for browser in sorted(self._browsers, key=lambda b: b.last_used):
+                    if len(self._browsers) <= self.min_size:
+                        break
+                    if browser.owner is None and self._free_spares() <= self.spare:
+                        continue  # 保留备用会话
+                    if browser.leased_by is None and now - browser.last_used > self.idle_timeout:
+                        self._browsers.remove(browser)
+                        if self._by_owner.get(browser.owner) is browser:
+                            del self._by_owner[browser.owner]
+                        evicted.append(browser)
+                if evicted:
+                    self._cond.notify_all()
+            for browser in evicted:
+                log.info(f"Evicting idle browser session #{browser.index}")
+                await browser.close()
+
+    async def close(self):
+        """关闭所有浏览器会话"""
+        self._closed = True
+        if self._evict_task:
+            self._evict_task.cancel()
+        if self._spare_tasks:
+            await asyncio.gather(*self._spare_tasks, return_exceptions=True)
+        for browser in list(self._browsers):
+            await browser.close()
+        self._browsers.clear()
+        self._by_owner.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._browsers),
+            "max_size": self.max_size,
+            "busy": sum(1 for b in self._browsers if b.leased_by is not None),
+            "starting": self._starting,
+            "spare": self._free_spares(),
+            "spare_target": self.spare,
+            "waiting": self._waiting,
+            "breaker_open": sum(1 for b in self._browsers if b.breaker.open),
+            "breaker_trips": sum(b.breaker.trips for b in self._browsers),
+            "restarts": self.restarts,
+            "restart_failures": self.restart_failures,
+        }
+
+# ===== 会话历史 =====
+
+class SessionHistory:
+    """单个会话的对话历史，按 token 预算自动压缩
+
+    - 系统提示始终保留在最前面
+    - 每条消息的 token 数在加入时计算一次，总量增量维护
+    - 超出 token_budget 时，把最早的轮次折叠进滚动摘要，直到降到 budget * compact_ratio，
+      分批压缩可以让消息前缀在多轮之间保持不变
+    - 最近 keep_recent_turns 轮（以用户消息开始）始终原样保留
+    """
+
+    SUMMARY_HEADER = "[早前对话摘要，仅供参考]"
+
+    def __init__(self, token_budget: int = 48000, keep_recent_turns: int = 4,
+                 summary_tokens: int = 2000, compact_ratio: float = 0.75):
+        self.token_budget = token_budget
+        # 至少保留最近一轮：自动继续时刚添加的"继续"不能被折叠，推测失败时还要撤回它
+        self.keep_recent_turns = max(1, keep_recent_turns)
+        self.summary_tokens = summary_tokens
+        self.compact_ratio = compact_ratio
+        self.system_message = None
+        self._system_tokens = 0
+        self._entries = deque()         # (message, tokens)
+        self._entry_tokens = 0
+        self._turns = 0                 # 队列中用户消息的数量
+        self._summary_lines = deque()   # (line, tokens)
+        self._summary_line_tokens = 0
+        self._summary_message = None
+        # 消息序号：用于持久化，first_seq 是队列中最早一条消息的序号
+        self.first_seq = 0
+        self.next_seq = 0
+        self.compactions = 0
+
+    @classmethod
+    def from_config(cls, config: dict):
+        history_config = config.get("history", {})
+        return cls(
+            token_budget=history_config.get("token_budget", 48000),
+            keep_recent_turns=history_config.get("keep_recent_turns", 4),
+            summary_tokens=history_config.get("summary_tokens", 2000),
+            compact_ratio=history_config.get("compact_ratio", 0.75),
+        )
+
+    @staticmethod
+    def count_tokens(message) -> int:
+        # 每条消息额外约 4 个 token 的格式开销
+        return estimate_tokens(str(message.content)) + 4
+
+    @property
+    def token_count(self) -> int:
+        return self._system_tokens + self._summary_line_tokens + self._entry_tokens
+
+    @property
+    def summary_lines(self) -> list:
+        return [line for line, _ in self._summary_lines]
+
+    @property
+    def summary(self) -> str:
+        return "\n".join(self.summary_lines)
+
+    def __len__(self) -> int:
+        return (self.system_message is not None) + (1 if self._summary_lines else 0) + len(self._entries)
+
+    def append(self, message):
+        """添加消息，超出预算时压缩"""
+        if isinstance(message, SystemMessage) and self.system_message is None and not self._entries:
+            self.system_message = message
+            self._system_tokens = self.count_tokens(message)
+            return
+
+        tokens = self.count_tokens(message)
+        self._entries.append((message, tokens))
+        self._entry_tokens += tokens
+        self.next_seq += 1
+        if isinstance(message, HumanMessage):
+            self._turns += 1
+
+        if self.token_count > self.token_budget:
+            self._compact()
+
+    def pop(self):
+        """移除并返回最后一条消息"""
+        message, tokens = self._entries.pop()
+        self._entry_tokens -= tokens
+        self.next_seq -= 1
+        if isinstance(message, HumanMessage):
+            self._turns -= 1
+        return message
+
+    def restore(self, system_message, summary_lines: list, first_seq: int, messages: list):
+        """从持久化的数据恢复历史（不触发压缩）"""
+        self.clear()
+        if system_message is not None:
+            self.system_message = system_message
+            self._system_tokens = self.count_tokens(system_message)
+        for line in summary_lines:
+            tokens = estimate_tokens(line) + 1
+            self._summary_lines.append((line, tokens))
+            self._summary_line_tokens += tokens
+        self.first_seq = self.next_seq = first_seq
+        for message in messages:
+            tokens = self.count_tokens(message)
+            self._entries.append((message, tokens))
+            self._entry_tokens += tokens
+            self.next_seq += 1
+            if isinstance(message, HumanMessage):
+                self._turns += 1
+
+    def clear(self):
+        self.system_message = None
+        self._system_tokens = 0
+        self._entries.clear()
+        self._entry_tokens = 0
+        self._turns = 0
+        self._summary_lines.clear()
+        self._summary_line_tokens = 0
+        self._summary_message = None
+        self.first_seq = self.next_seq = 0
+
+    def messages(self) -> list:
+        """返回发送给模型的消息列表：系统提示、滚动摘要、最近的原文消息"""
+        result = []
+        if self.system_message is not None:
+            result.append(self.system_message)
+        if self._summary_lines:
+            if self._summary_message is None:
+                self._summary_message = HumanMessage(content=f"{self.SUMMARY_HEADER}\n{self.summary}")
+            result.append(self._summary_message)
+        result.extend(message for message, _ in self._entries)
+        return result
+
+    def _compact(self):
+        """把最早的轮次折叠进摘要，直到低于压缩目标或只剩最近的轮次"""
+        target = int(self.token_budget * self.compact_ratio)
+        folded = 0
+        while self.token_count > target and self._turns > self.keep_recent_turns:
+            # 弹出最早的一整轮：开头的消息及其后直到下一条用户消息之前的所有消息
+            self._fold(self._popleft())
+            folded += 1
+            # 最新的一条消息始终保留
+            while len(self._entries) > 1 and not isinstance(self._entries[0][0], HumanMessage):
+                self._fold(self._popleft())
+                folded += 1
+        if not folded:
+            return
+        self._summary_message = None
+        self.compactions += 1
+        log.info(f"History compacted to {self.token_count} tokens ({len(self._entries)} messages kept)")
+
+    def _popleft(self):
+        message, tokens = self._entries.popleft()
+        self._entry_tokens -= tokens
+        self.first_seq += 1
+        if isinstance(message, HumanMessage):
+            self._turns -= 1
+        return message
+
+    def _fold(self, message):
+        """把一条消息压缩成一行摘要"""
+        content = " ".join(str(message.content).split())
+        if not content or (isinstance(message, HumanMessage) and content == "继续"):
+            return
+        if isinstance(message, HumanMessage):
+            # 用户的需求原样保留（自动继续时任务的原始需求只剩摘要里这一份），不截断
+            line = f"用户: {content}"
+        else:
+            line = f"助手: {content[:300]}"
+        tokens = estimate_tokens(line) + 1
+        self._summary_lines.append((line, tokens))
+        self._summary_line_tokens += tokens
+        # 摘要超出预算时优先丢弃最早的助手回复，用户的原始需求保留得最久
+        while self._summary_line_tokens > self.summary_tokens and len(self._summary_lines) > 1:
+            for index, (old_line, dropped) in enumerate(self._summary_lines):
+                if old_line.startswith("助手: "):
+                    del self._summary_lines[index]
+                    break
+            else:
+                _, dropped = self._summary_lines.popleft()
+            self._summary_line_tokens -= dropped
+
+# ===== 会话存储 =====
+
+class StreamCancelled:
+    """停止请求或客户端断开时放入流的等待队列，让等待中的流立即退出"""
+
+    def __init__(self, reason: str):
+        self.reason = reason
+
+STREAM_RESUMED = object()  # 暂停的流被继续时放入等待队列的标记
+
+SESSION_STATES = ("idle", "streaming", "tool-running", "checking", "paused")
+
+
+class SessionEventBus:
+    """会话状态变化的发布/订阅
+
+    UI 和监控通过 subscribe() 得到一个队列接收状态变化，不需要轮询 /health。
+    订阅者处理不过来时丢弃最旧的事件，发布方永远不会被阻塞。
+    """
+
+    def __init__(self, max_queue: int = 256):
+        self.max_queue = max_queue
+        self._subscribers = {}  # 队列 -> 关注的 session_id（None 表示全部）
+        self.states = {}        # 非空闲会话的当前状态
+        self.transitions = {state: 0 for state in SESSION_STATES}
+
+    def subscribe(self, session_id: str = None) -> asyncio.Queue:
+        subscriber = asyncio.Queue()
+        self._subscribers[subscriber] = session_id
+        return subscriber
+
+    def unsubscribe(self, subscriber: asyncio.Queue):
+        self._subscribers.pop(subscriber, None)
+
+    def snapshot(self, session_id: str = None) -> list:
+        """当前各会话的状态，供新订阅者初始化"""
+        return [
+            {'type': 'state', 'session_id': sid, 'state': state, 'timestamp': time.time()}
+            for sid, state in self.states.items()
+            if session_id is None or sid == session_id
+        ]
+
+    def publish(self, session_id: str, state: str, **detail):
+        if state == "idle":
+            self.states.pop(session_id, None)
+        else:
+            self.states[session_id] = state
+        self.transitions[state] += 1
+
+        event = {'type': 'state', 'session_id': session_id, 'state': state, 'timestamp': time.time(), **detail}
+        for subscriber, wanted in list(self._subscribers.items()):
+            if wanted is not None and wanted != session_id:
+                continue
+            if subscriber.qsize() >= self.max_queue:
+                subscriber.get_nowait()
+            subscriber.put_nowait(event)
+
+    def stats(self) -> dict:
+        active = {state: 0 for state in SESSION_STATES if state != "idle"}
+        for state in self.states.values():
+            active[state] += 1
+        return {"subscribers": len(self._subscribers), "active": active, "transitions": dict(self.transitions)}
+
+session_events = SessionEventBus()
+
+
+class SessionControl:
+    """一个会话的生成控制：停止、暂停/继续、当前工具结束后停止，并发布状态变化
+
+    - stop(): 立即唤醒正在等待的流，由流取消 Agent 任务（包括正在执行的工具）
+    - pause(): 在下一次工具调用前、或下一轮自动继续前暂停，resume() 后继续
+    - stop_after_tool(): 等正在执行的工具结束后再停止，没有工具在执行时立即停止
+    """
+
+    def __init__(self, session_id: str, bus: SessionEventBus):
+        self.session_id = session_id
+        self.bus = bus
+        self.stopped = asyncio.Event()
+        self.running = asyncio.Event()  # 清除时表示暂停
+        self.running.set()
+        self.stop_reason = None
+        self.stop_after_tool_requested = False
+        self.wakeup = None              # 正在进行的流当前等待的队列
+        self.state = "idle"
+        self._activity = "idle"         # 不考虑暂停时的状态
+        self._tools_running = 0
+
+    @property
+    def paused(self) -> bool:
+        return not self.running.is_set()
+
+    @property
+    def stop_requested(self) -> bool:
+        return self.stopped.is_set()
+
+    def reset(self):
+        """新的生成开始时清除上一次的停止和暂停请求"""
+        self.stopped.clear()
+        self.running.set()
+        self.stop_reason = None
+        self.stop_after_tool_requested = False
+        self._tools_running = 0
+
+    def _notify(self, item):
+        if self.wakeup is not None:
+            self.wakeup.put_nowait(item)
+
+    def _publish(self, **detail):
+        state = "paused" if self.paused and self._activity != "idle" else self._activity
+        if state != self.state:
+            self.state = state
+            self.bus.publish(self.session_id, state, **detail)
+
+    def set_state(self, activity: str, **detail):
+        self._activity = activity
+        self._publish(**detail)
+
+    def stop(self, reason: str = "stop"):
+        self.stop_reason = reason
+        self.stopped.set()
+        self.running.set()  # 暂停中的工具调用不再等待，随 Agent 任务一起取消
+        self._notify(StreamCancelled(reason))
+
+    def stop_after_tool(self):
+        if self._tools_running:
+            self.stop_after_tool_requested = True
+        else:
+            self.stop("after_tool")
+
+    def pause(self):
+        self.running.clear()
+        self._publish()
+
+    def resume(self):
+        self.running.set()
+        self._publish()
+        self._notify(STREAM_RESUMED)
+
+    def tool_started(self, name: str):
+        self._tools_running += 1
+        self.set_state("tool-running", tool=name)
+
+    def tool_finished(self):
+        self._tools_running -= 1
+        if self._tools_running:
+            return
+        if self.stop_after_tool_requested:
+            self.stop("after_tool")
+        else:
+            self.set_state("streaming")
+
+
+class SessionState:
+    """内存中的一个会话：历史、并发锁和生成控制"""
+
+    def __init__(self, session_id: str, history: SessionHistory):
+        self.history = history
+        self.lock = asyncio.Lock()
+        self.control = SessionControl(session_id, session_events)
+        self.persisted = False                  # 磁盘上是否已有该会话的记录
+        self.compactions = history.compactions  # 已持久化的压缩次数
+        self.in_use = 0                         # 正在处理或排队等待的请求数，大于 0 时不会被换出内存
+
+
+class SessionStore:
+    """持久化的会话存储
+
+    - 所有消息写入 SQLite，守护进程重启后对话不会丢失
+    - 内存中只保留最近使用的 max_hot_sessions 个会话（LRU），其余会话在被访问时再从磁盘加载
+    - 会话被换出内存时，对应的锁和停止标志一起回收
+    """
+
+    ROLES = {"system": SystemMessage, "user": HumanMessage, "assistant": AIMessage}
+
+    def __init__(self, path: str, history_factory, max_hot_sessions: int = 64, max_age_days: float = 30):
+        self.path = path
+        self.history_factory = history_factory
+        self.max_hot_sessions = max(1, max_hot_sessions)
+        self._hot = OrderedDict()  # {session_id: SessionState}
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            system TEXT,
+            summary TEXT NOT NULL DEFAULT '[]',
+            first_seq INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL
+        )""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS messages (
+            session_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            PRIMARY KEY (session_id, seq)
+        )""")
+        if max_age_days:
+            self._purge_older_than(time.time() - max_age_days * 86400)
+
+    @classmethod
+    def from_config(cls, config: dict):
+        store_config = config.get("session_store", {})
+        return cls(
+            store_config.get("path", "sessions.db"),
+            lambda: SessionHistory.from_config(config),
+            max_hot_sessions=store_config.get("max_hot_sessions", 64),
+            max_age_days=store_config.get("max_age_days", 30),
+        )
+
+    @classmethod
+    def _role_of(cls, message) -> str:
+        if isinstance(message, SystemMessage):
+            return "system"
+        if isinstance(message, HumanMessage):
+            return "user"
+        return "assistant"
+
+    def get(self, session_id: str, pin: bool = False) -> SessionState:
+        """获取会话，不在内存中时从磁盘加载；pin 为 True 时占用该会话，直到 unpin 前不会被换出内存"""
+        state = self._hot.get(session_id)
+        if state is not None:
+            self._hot.move_to_end(session_id)
+        else:
+            state = self._load(session_id)
+            self._hot[session_id] = state
+        if pin:
+            state.in_use += 1
+        self._evict()
+        return state
+
+    def unpin(self, state: SessionState):
+        """释放 get(pin=True) 的占用"""
+        state.in_use -= 1
+        self._evict()
+
+    def _load(self, session_id: str) -> SessionState:
+        history = self.history_factory()
+        row = self._db.execute(
+            "SELECT system, summary, first_seq FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            return SessionState(session_id, history)
+
+        system, summary, first_seq = row
+        messages = [
+            self.ROLES[role](content=content)
+            for role, content in self._db.execute(
+                "SELECT role, content FROM messages WHERE session_id = ? AND seq >= ? ORDER BY seq",
+                (session_id, first_seq),
+            )
+        ]
+        history.restore(
+            SystemMessage(content=system) if system is not None else None,
+            json.loads(summary),
+            first_seq,
+            messages,
+        )
+        log.info(f"Loaded session {session_id} from disk ({len(messages)} messages)")
+        state = SessionState(session_id, history)
+        state.persisted = True
+        return state
+
+    def _evict(self):
+        """把最久未使用、且没有请求在处理或排队的会话换出内存
+
+        只看会话锁不够：锁释放后到排队的请求被唤醒之间锁是空闲的，此时换出会让后续 get() 创建新的会话锁和生成控制
+        """
+        if len(self._hot) <= self.max_hot_sessions:
+            return
+        for session_id in list(self._hot):
+            if len(self._hot) <= self.max_hot_sessions:
+                break
+            state = self._hot[session_id]
+            if not state.in_use and not state.lock.locked():
+                del self._hot[session_id]
+
+    def append(self, session_id: str, message):
+        """添加消息到历史并写入磁盘"""
+        state = self.get(session_id)
+        history = state.history
+        history.append(message)
+
+        if history.system_message is not message:
+            self._db.execute(
+                "INSERT OR REPLACE INTO messages (session_id, seq, role, content) VALUES (?, ?, ?, ?)",
+                (session_id, history.next_seq - 1, self._role_of(message), str(message.content)),
+            )
+
+        if not state.persisted or history.compactions != state.compactions:
+            # 新会话或发生了压缩：保存系统提示和摘要，删除已经折叠进摘要的消息
+            state.persisted = True
+            state.compactions = history.compactions
+            self._save_session(session_id, history)
+            self._db.execute(
+                "DELETE FROM messages WHERE session_id = ? AND seq < ?", (session_id, history.first_seq)
+            )
+        else:
+            self._db.execute(
+                "UPDATE sessions SET updated_at = ? WHERE session_id = ?", (time.time(), session_id)
+            )
+
+    def pop(self, session_id: str):
+        """撤回最后一条消息"""
+        history = self.get(session_id).history
+        message = history.pop()
+        self._db.execute(
+            "DELETE FROM messages WHERE session_id = ? AND seq = ?", (session_id, history.next_seq)
+        )
+        return message
+
+    def _save_session(self, session_id: str, history: SessionHistory):
+        system = history.system_message.content if history.system_message is not None else None
+        self._db.execute(
+            "INSERT OR REPLACE INTO sessions (session_id, system, summary, first_seq, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (session_id, system, json.dumps(history.summary_lines, ensure_ascii=False), history.first_seq, time.time()),
+        )
+
+    def clear(self, session_id: str):
+        """清除会话历史（内存和磁盘）"""
+        state = self._hot.get(session_id)
+        if state is not None:
+            state.history.clear()
+            state.persisted = False
+        self._db.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+        self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def _purge_older_than(self, timestamp: float):
+        """删除长时间未使用的会话"""
+        self._db.execute(
+            "DELETE FROM messages WHERE session_id IN (SELECT session_id FROM sessions WHERE updated_at < ?)",
+            (timestamp,),
+        )
+        self._db.execute("DELETE FROM sessions WHERE updated_at < ?", (timestamp,))
+
+    def close(self):
+        self._db.close()
+
+    def history_tokens(self) -> int:
+        """内存中所有会话历史的 token 数"""
+        return sum(state.history.token_count for state in self._hot.values())
+
+    def stats(self) -> dict:
+        return {
+            "hot_sessions": len(self._hot),
+            "max_hot_sessions": self.max_hot_sessions,
+            "stored_sessions": self._db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0],
+        }
+
+# ===== 指标与追踪 =====
+
+def _label_text(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = ['%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+             for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{%s}" % ",".join(parts) if parts else ""
+
+def _number_text(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """只增不减的计数（Prometheus counter），按标签分别累计"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.series = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self) -> list:
+        return [f"{self.name}{_label_text(self.labelnames, key)} {_number_text(value)}"
+                for key, value in self.series.items()]
+
+
+class Histogram:
+    """固定桶的分布（Prometheus histogram），按标签分别累计；每次 observe 只做一次二分查找"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = tuple(labelnames)
+        self.series = {}  # {标签值: [各桶计数..., 超出最大桶的计数, 总和, 次数]}
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> list:
+        lines = []
+        for key, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), series):
+                cumulative += count
+                le = 'le="%s"' % _number_text(float(bound))
+                lines.append(f"{self.name}_bucket{_label_text(self.labelnames, key, le)} {cumulative}")
+            labels = _label_text(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_number_text(series[-2])}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+class Collected:
+    """抓取时才从已有的统计对象读取的指标；fn 返回一个数值，或 [(标签字典, 数值), ...]"""
+
+    def __init__(self, name: str, kind: str, help: str, fn):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.fn = fn
+
+    def render(self) -> list:
+        value = self.fn()
+        if value is None:
+            return []
+        if not isinstance(value, list):
+            return [f"{self.name} {_number_text(value)}"]
+        return [f"{self.name}{_label_text(tuple(labels), tuple(labels.values()))} {_number_text(number)}"
+                for labels, number in value]
+
+
+class MetricsRegistry:
+    """/metrics 输出的所有指标，按 Prometheus 文本格式（0.0.4）输出"""
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: tuple = ()) -> Counter:
+        return self._add(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, buckets: tuple, labelnames: tuple = ()) -> Histogram:
+        return self._add(Histogram(name, help, buckets, labelnames))
+
+    def collect(self, name: str, kind: str, help: str, fn):
+        return self._add(Collected(name, kind, help, fn))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                samples = metric.render()
+            except Exception as e:
+                log.warning(f"Failed to collect metric {metric.name}: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+metrics = MetricsRegistry()
+llm_ttft = metrics.histogram("everbrowser_llm_ttft_seconds", "每轮 Agent 输出从开始到第一个 token 的时间", LATENCY_BUCKETS)
+llm_tokens_per_second = metrics.histogram("everbrowser_llm_tokens_per_second", "每轮 Agent 输出第一个 token 之后的输出速度",
+                                          (1, 2, 5, 10, 20, 50, 100, 200, 500))
+tool_duration = metrics.histogram("everbrowser_tool_duration_seconds", "工具调用的执行时间（不含排队）",
+                                  LATENCY_BUCKETS, ("tool",))
+completion_check_duration = metrics.histogram("everbrowser_completion_check_seconds", "任务完成判定的耗时",
+                                              LATENCY_BUCKETS, ("mode",))
+session_lock_wait = metrics.histogram("everbrowser_session_lock_wait_seconds", "请求等待会话锁的时间", LATENCY_BUCKETS)
+history_tokens = metrics.histogram("everbrowser_history_tokens", "每轮开始时会话历史的 token 数",
+                                   (1000, 2000, 4000, 8000, 16000, 32000, 48000, 64000, 128000))
+turns_total = metrics.counter("everbrowser_turns_total", "Agent 输出的轮数")
+auto_continue_total = metrics.counter("everbrowser_auto_continue_total", "判定任务未完成后自动继续的次数")
+
+
+# 当前代码所在的 span（新的 span 默认以它为父 span）
+current_span = contextvars.ContextVar("current_span", default=None)
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def _otlp_attributes(attributes: dict) -> list:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+class Span:
+    """一段被追踪的操作，字段对应 OpenTelemetry 的 span 数据模型"""
+
+    __slots__ = ("tracer", "name", "trace_id", "span_id", "parent_id", "start_ns", "end_ns",
+                 "attributes", "events", "error")
+
+    def __init__(self, tracer, name: str, parent, attributes: dict):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else "%032x" % random.getrandbits(128)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+        self.events = []
+        self.error = None
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+
+    def event(self, name: str, **attributes):
+        self.events.append((time.time_ns(), name, attributes))
+
+    def fail(self, error):
+        self.error = str(error) or type(error).__name__
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            self.tracer._export(self)
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": _otlp_attributes(self.attributes),
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.events:
+            span["events"] = [{"timeUnixNano": str(at), "name": name, "attributes": _otlp_attributes(attrs)}
+                              for at, name, attrs in self.events]
+        if self.error is not None:
+            span["status"] = {"code": 2, "message": self.error}  # STATUS_CODE_ERROR
+        return span
+
+
+class NoopSpan:
+    """关闭追踪时使用的 span：所有操作都不做任何事"""
+
+    trace_id = None
+
+    def set(self, key: str, value):
+        pass
+
+    def event(self, name: str, **attributes):
+        pass
+
+    def fail(self, error):
+        pass
+
+    def end(self):
+        pass
+
+NOOP_SPAN = NoopSpan()
+
+
+class Tracer:
+    """按 OpenTelemetry 数据模型记录 span，结束的 span 定期以 OTLP/JSON 格式追加写入 trace_file
+
+    文件每行是一个 ExportTraceServiceRequest，可以用 OpenTelemetry Collector 的 otlpjsonfile 接收器读取后转发。
+    没有配置 trace_file 时 start() 总是返回同一个 NOOP_SPAN，不分配对象也不读取时间。
+    """
+
+    def __init__(self, path: str = None, service_name: str = "everbrowser", flush_interval: float = 2.0,
+                 max_pending: int = 10000):
+        self.path = path
+        self.service_name = service_name
+        self.flush_interval = flush_interval
+        self._pending = deque(maxlen=max(1, max_pending))
+        self._task = None
+        self.exported = 0
+        self.dropped = 0
+
+    @classmethod
+    def from_config(cls, config: dict):
+        telemetry_config = config.get("telemetry", {})
+        return cls(
+            telemetry_config.get("trace_file"),
+            service_name=telemetry_config.get("service_name", "everbrowser"),
+            flush_interval=telemetry_config.get("flush_interval", 2.0),
+            max_pending=telemetry_config.get("max_pending_spans", 10000),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def start(self, name: str, parent=None, **attributes):
+        """开始一个 span，需要调用 end() 结束；parent 默认为 current_span"""
+        if self.path is None:
+            return NOOP_SPAN
+        if parent is None or parent is NOOP_SPAN:
+            parent = current_span.get()
+        return Span(self, name, parent, attributes)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """在当前上下文中开始一个 span，内部新开始的 span 以它为父 span；异常时记录错误状态"""
+        span = self.start(name, **attributes)
+        if span is NOOP_SPAN:
+            yield span
+            return
+        token = current_span.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.fail(e)
+            raise
+        finally:
+            current_span.reset(token)
+            span.end()
+
+    def _export(self, span: Span):
+        if len(self._pending) == self._pending.maxlen:
+            self.dropped += 1
+        self._pending.append(span)
+
+    def start_exporter(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._export_loop())
+
+    async def _export_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        spans = [span.to_otlp() for span in self._pending]
+        self._pending.clear()
+        line = json.dumps({"resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": self.service_name})},
+            "scopeSpans": [{"scope": {"name": "everbrowser"}, "spans": spans}],
+        }]}, ensure_ascii=False)
+        try:
+            await asyncio.to_thread(self._write, line)
+            self.exported += len(spans)
+        except OSError as e:
+            self.dropped += len(spans)
+            log.warning(f"Failed to write trace file {self.path}: {e}")
+
+    def _write(self, line: str):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "pending": len(self._pending), "exported": self.exported,
+                "dropped": self.dropped}
+
+tracer = Tracer()
+
+# ===== 模型服务连接 =====
+
+model_handshake = metrics.histogram("everbrowser_model_handshake_seconds", "新建模型服务连接的 TCP 和 TLS 握手耗时",
+                                    LATENCY_BUCKETS)
+
+
+class ConnectionStats:
+    """通过 httpcore 的 trace 回调统计每个请求是新建连接还是复用连接，以及新建连接的握手耗时"""
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.connect_failures = 0
+        self.versions = {}
+        self._handshakes = deque(maxlen=1000)
+
+    def trace(self):
+        """返回一个请求的 trace 回调（httpcore 按 "connection.connect_tcp.started" 这样的事件名调用）"""
+        self.requests += 1
+        started = {}
+        handshake = []
+
+        async def trace(event: str, info: dict):
+            name, _, phase = event.rpartition(".")
+            if phase == "started":
+                started[name] = time.perf_counter()
+                if name.endswith(".send_request_headers"):
+                    version = name.split(".", 1)[0]
+                    self.versions[version] = self.versions.get(version, 0) + 1
+                    if handshake:
+                        seconds = sum(handshake)
+                        handshake.clear()
+                        self._handshakes.append(seconds)
+                        model_handshake.observe(seconds)
+            elif phase == "complete" and name in ("connection.connect_tcp", "connection.start_tls"):
+                handshake.append(time.perf_counter() - started.pop(name, time.perf_counter()))
+                if name == "connection.connect_tcp":
+                    self.new_connections += 1
+            elif phase == "failed" and name == "connection.connect_tcp":
+                self.connect_failures += 1
+
+        return trace
+
+    def stats(self) -> dict:
+        handshakes = list(self._handshakes)
+        reused = max(0, self.requests - self.new_connections)
+        return {
+            "requests": self.requests,
+            "new_connections": self.new_connections,
+            "reused": reused,
+            "reuse_rate": round(reused / self.requests, 3) if self.requests else 0.0,
+            "connect_failures": self.connect_failures,
+            "http_versions": dict(self.versions),
+            "handshake_p50_ms": round(percentile(handshakes, 0.5) * 1000, 1),
+            "handshake_p95_ms": round(percentile(handshakes, 0.95) * 1000, 1),
+        }
+
+
+class DrainingStream(httpx.AsyncByteStream):
+    """关闭前先读完响应的剩余部分（最多 drain_timeout 秒、max_bytes 字节），连接才能放回连接池
+
+    openai 客户端读到 data: [DONE] 就关闭流式响应，此时结束 chunk 通常已经到达但还没有被读取，
+    httpcore 会因此丢弃连接，下一次请求（例如紧接着的任务完成判定）就要重新握手。
+    """
+
+    def __init__(self, stream, drain_timeout: float, max_bytes: int = 65536):
+        self._stream = stream
+        self._iterator = stream.__aiter__()
+        self.drain_timeout = drain_timeout
+        self.max_bytes = max_bytes
+
+    async def __aiter__(self):
+        async for chunk in self._iterator:
+            yield chunk
+
+    async def _drain(self):
+        drained = 0
+        async for chunk in self._iterator:
+            drained += len(chunk)
+            if drained > self.max_bytes:
+                return
+
+    async def aclose(self):
+        try:
+            if self.drain_timeout > 0:
+                try:
+                    await asyncio.wait_for(self._drain(), self.drain_timeout)
+                except Exception:
+                    pass
+        finally:
+            # 读取剩余部分时被取消也要关闭底层的流，否则连接一直占用连接池
+            await self._stream.aclose()
+
+
+class TracedTransport(httpx.AsyncHTTPTransport):
+    """给每个请求挂上 ConnectionStats 的 trace 回调，关闭响应前读完剩余部分以便复用连接"""
+
+    def __init__(self, stats: ConnectionStats, drain_timeout: float = 0.2, **kwargs):
+        super().__init__(**kwargs)
+        self.connection_stats = stats
+        self.drain_timeout = drain_timeout
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        request.extensions["trace"] = self.connection_stats.trace()
+        response = await super().handle_async_request(request)
+        response.stream = DrainingStream(response.stream, self.drain_timeout)
+        return response
+
+
+def environment_proxy(url: str) -> Optional[str]:
+    """自定义 transport 时 httpx 不再读取代理环境变量，这里按 HTTPS_PROXY / NO_PROXY 等环境变量选择代理"""
+    parsed = urllib.parse.urlsplit(url)
+    if not parsed.hostname or urllib.request.proxy_bypass(parsed.hostname):
+        return None
+    proxies = urllib.request.getproxies()
+    return proxies.get(parsed.scheme) or proxies.get("all")
+
+
+class ModelTransport:
+    """模型服务的 HTTP 客户端，所有 ChatOpenAI（Agent 和任务完成判定）共用同一个连接池
+
+    每轮输出之后紧接着是任务完成判定的请求，两轮之间还有工具调用，连接在 keep-alive 时间内空闲会被复用，
+    不必每次重新握手。启动时 warmup() 预先建立连接。
+    多个模型服务可能走不同的代理（NO_PROXY 等），每种代理设置各用一个客户端，没有代理的服务共用同一个。
+    """
+
+    def __init__(self, max_connections: int = 100, max_keepalive_connections: int = 20, keepalive_expiry: float = 30.0,
+                 http2: bool = False, connect_timeout: float = 10.0, read_timeout: float = None,
+                 write_timeout: float = None, pool_timeout: float = None, max_retries: int = 2, connect_retries: int = 1,
+                 tcp_keepalive: bool = True, proxy: str = None, warmup_connections: int = 1, drain_timeout: float = 0.2):
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections,
+                                   keepalive_expiry=keepalive_expiry)
+        self.timeout = httpx.Timeout(connect=connect_timeout, read=read_timeout, write=write_timeout, pool=pool_timeout)
+        self.http2 = http2
+        self.max_retries = max_retries
+        self.connect_retries = connect_retries
+        self.tcp_keepalive = tcp_keepalive
+        self.proxy = proxy
+        self.warmup_connections = warmup_connections
+        self.drain_timeout = drain_timeout
+        self.connections = ConnectionStats()
+        self.warmup_seconds = None
+        self._clients = {}  # 代理地址（None 表示直连）-> httpx.AsyncClient
+
+    @classmethod
+    def from_config(cls, config: dict):
+        transport_config = config.get("model_transport", {})
+        return cls(
+            max_connections=transport_config.get("max_connections", 100),
+            max_keepalive_connections=transport_config.get("max_keepalive_connections", 20),
+            keepalive_expiry=transport_config.get("keepalive_expiry", 30.0),
+            http2=transport_config.get("http2", False),
+            connect_timeout=transport_config.get("connect_timeout", 10.0),
+            read_timeout=transport_config.get("read_timeout"),
+            write_timeout=transport_config.get("write_timeout"),
+            pool_timeout=transport_config.get("pool_timeout"),
+            max_retries=transport_config.get("max_retries", 2),
+            connect_retries=transport_config.get("connect_retries", 1),
+            tcp_keepalive=transport_config.get("tcp_keepalive", True),
+            proxy=transport_config.get("proxy"),
+            warmup_connections=transport_config.get("warmup_connections", 1),
+            drain_timeout=transport_config.get("drain_timeout", 0.2),
+        )
+
+    def client(self, base_url: str) -> httpx.AsyncClient:
+        """base_url 对应的客户端：按该地址选择代理，代理相同的服务共用连接池"""
+        proxy = self.proxy or environment_proxy(base_url)
+        client = self._clients.get(proxy)
+        if client is None:
+            if self.http2:
+                try:
+                    import h2  # noqa: F401
+                except ImportError:
+                    log.warning("model_transport.http2 requires the h2 package (pip install httpx[http2]), using HTTP/1.1")
+                    self.http2 = False
+            socket_options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)] if self.tcp_keepalive else None
+            transport = TracedTransport(
+                self.connections, drain_timeout=self.drain_timeout, http2=self.http2, limits=self.limits, retries=self.connect_retries,
+                socket_options=socket_options, proxy=proxy,
+            )
+            client = self._clients[proxy] = httpx.AsyncClient(transport=transport, timeout=self.timeout)
+        return client
+
+    def chat_options(self, base_url: str) -> dict:
+        """传给 ChatOpenAI 的连接参数"""
+        return {"http_async_client": self.client(base_url), "request_timeout": self.timeout, "max_retries": self.max_retries}
+
+    async def warmup(self, base_url: str, api_key: str):
+        """并发请求 {base_url}/models 建立 warmup_connections 个连接，响应读完后连接留在连接池中"""
+        if self.warmup_connections <= 0:
+            return
+        client = self.client(base_url)
+        url = base_url.rstrip("/") + "/models"
+        started = time.perf_counter()
+        results = await asyncio.gather(*(
+            client.get(url, headers={"Authorization": f"Bearer {api_key}"})
+            for _ in range(self.warmup_connections)
+        ), return_exceptions=True)
+        self.warmup_seconds = time.perf_counter() - started
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            log.warning(f"Model connection warmup to {base_url} failed: {errors[0]!r}")
+        else:
+            log.info(f"Warmed {len(results)} model connection(s) to {base_url} in {self.warmup_seconds:.3f}s")
+
+    async def close(self):
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            await client.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "http2": self.http2,
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "keepalive_expiry": self.limits.keepalive_expiry,
+            "warmup_seconds": round(self.warmup_seconds, 3) if self.warmup_seconds is not None else None,
+            **self.connections.stats(),
+        }
+
+model_transport = ModelTransport()
+
+# ===== 多模型服务路由 =====
+
+class ModelCallAttempt:
+    """一次发往某个模型服务的调用，由 RouterCallback 记下第一个 chunk 到达的时间"""
+
+    def __init__(self):
+        self.first_token_at = None
+
+current_model_attempt = contextvars.ContextVar("current_model_attempt", default=None)
+
+
+class RouterCallback(AsyncCallbackHandler):
+    async def on_llm_new_token(self, token, *, chunk=None, run_id, **kwargs):
+        attempt = current_model_attempt.get()
+        if attempt is not None and attempt.first_token_at is None:
+            attempt.first_token_at = time.perf_counter()
+
+router_callback = RouterCallback()
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """从限流响应的 Retry-After 头中取出需要等待的秒数"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class ModelBackend:
+    """路由中的一个模型服务：滚动延迟和错误率、令牌桶限流、熔断冷却
+
+    - latency: 首 token 时间的指数滑动平均（非流式调用为整个调用的时间）
+    - error_rate: 失败率的指数滑动平均，超过阈值时冷却 cooldown 秒，之后再放行请求试探
+    - requests_per_minute: 令牌桶的容量和补充速度；返回 429 时按 Retry-After 暂停使用并清空令牌
+    """
+
+    def __init__(self, name: str, model, weight: float = 1.0, requests_per_minute: float = None, alpha: float = 0.3):
+        self.name = name
+        self.model = model
+        self.weight = max(weight, 0.001)
+        self.alpha = alpha
+        self.capacity = requests_per_minute
+        self.refill_rate = requests_per_minute / 60 if requests_per_minute else None
+        self.tokens = requests_per_minute or 0.0
+        self.refilled = time.monotonic()
+        self.latency = None
+        self.error_rate = 0.0
+        self.cooldown_until = 0.0
+        self.blocked_until = 0.0
+        self.rate_limit_streak = 0
+        self.in_flight = 0
+        self.last_used = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+
+    def _refill(self, now: float):
+        if self.refill_rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.refilled) * self.refill_rate)
+        self.refilled = now
+
+    def available_at(self, now: float) -> float:
+        """最早可以发出请求的时间"""
+        at = max(now, self.blocked_until)
+        if self.refill_rate:
+            self._refill(now)
+            if self.tokens < 1:
+                at = max(at, now + (1 - self.tokens) / self.refill_rate)
+        return at
+
+    def healthy(self, now: float, error_threshold: float) -> bool:
+        return self.error_rate < error_threshold or now >= self.cooldown_until
+
+    def score(self, now: float, default_latency: float, probe_interval: float) -> float:
+        """越小越优先：延迟 × (1 + 正在进行的请求数) × (1 + 错误率) / 权重；长时间没有使用的服务按默认延迟重新试探"""
+        latency = self.latency
+        if latency is None or now - self.last_used > probe_interval:
+            latency = default_latency
+        return latency * (1 + self.in_flight) * (1 + self.error_rate) / self.weight
+
+    def start(self, now: float):
+        self._refill(now)
+        if self.refill_rate:
+            self.tokens -= 1
+        self.in_flight += 1
+        self.requests += 1
+        self.last_used = now
+
+    def succeeded(self, latency: float):
+        self.in_flight -= 1
+        self.rate_limit_streak = 0
+        self.latency = latency if self.latency is None else (1 - self.alpha) * self.latency + self.alpha * latency
+        self.error_rate *= 1 - self.alpha
+
+    def failed(self, now: float, error: BaseException, error_threshold: float, cooldown: float):
+        self.in_flight -= 1
+        if getattr(error, "status_code", None) == 429:
+            # 限流不计入错误率，只是在 Retry-After（没有时按连续限流次数指数增长）之前不再使用
+            self.rate_limited += 1
+            self.rate_limit_streak += 1
+            wait = retry_after_seconds(error) or min(cooldown, 2 ** (self.rate_limit_streak - 1))
+            self.blocked_until = max(self.blocked_until, now + wait)
+            self.tokens = 0.0
+            return
+        self.errors += 1
+        self.error_rate = (1 - self.alpha) * self.error_rate + self.alpha
+        if self.error_rate >= error_threshold:
+            self.cooldown_until = now + cooldown
+
+    def stats(self, now: float, error_threshold: float) -> dict:
+        return {
+            "name": self.name,
+            "weight": self.weight,
+            "healthy": self.healthy(now, error_threshold),
+            "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "error_rate": round(self.error_rate, 3),
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+            "tokens": round(self.tokens, 2) if self.refill_rate else None,
+            "blocked_seconds": round(max(0.0, self.blocked_until - now), 2),
+        }
+
+
+class ModelRouter:
+    """在多个模型服务之间选择：每次模型调用发往当前最快的健康服务，失败时换下一个服务重试
+
+    已经输出了部分内容的调用失败时不再换服务（否则同一轮会输出两遍），交给流的出错重试，
+    下一次调用会因为该服务的错误率上升而选择其他服务。所有服务都在限流时最多等待 max_wait 秒。
+    """
+
+    def __init__(self, backends: list, error_threshold: float = 0.5, cooldown: float = 30.0, max_wait: float = 30.0,
+                 probe_interval: float = 60.0):
+        self.backends = backends
+        self.error_threshold = error_threshold
+        self.cooldown = cooldown
+        self.max_wait = max_wait
+        self.probe_interval = probe_interval
+        self.failovers = 0
+
+    @classmethod
+    def from_config(cls, config: dict, build_model):
+        """config["model"]["backends"] 中的每一项覆盖 model 中的 name / api_key / base_url；build_model 用合并后的配置创建模型"""
+        model_config = {key: value for key, value in config["model"].items() if key != "backends"}
+        router_config = config.get("model_router", {})
+        alpha = router_config.get("ewma_alpha", 0.3)
+        backends = []
+        for index, backend_config in enumerate(config["model"]["backends"]):
+            merged = {**model_config, **backend_config}
+            name = backend_config.get("id") or f"{merged['name']}@{urllib.parse.urlsplit(merged['base_url']).netloc or index}"
+            backends.append(ModelBackend(name, build_model(merged), weight=merged.get("weight", 1.0),
+                                         requests_per_minute=merged.get("requests_per_minute"), alpha=alpha))
+        return cls(
+            backends,
+            error_threshold=router_config.get("error_threshold", 0.5),
+            cooldown=router_config.get("cooldown", 30.0),
+            max_wait=router_config.get("max_wait", 30.0),
+            probe_interval=router_config.get("probe_interval", 60.0),
+        )
+
+    def choose(self, tried: set) -> tuple:
+        """返回 (服务, 需要等待的秒数)；所有服务都试过时返回 (None, 0)"""
+        now = time.monotonic()
+        candidates = [backend for backend in self.backends if backend not in tried]
+        if not candidates:
+            return None, 0.0
+        candidates = [backend for backend in candidates if backend.healthy(now, self.error_threshold)] or candidates
+        ready = [backend for backend in candidates if backend.available_at(now) <= now]
+        if not ready:
+            backend = min(candidates, key=lambda b: b.available_at(now))
+            return backend, backend.available_at(now) - now
+        known = [backend.latency for backend in self.backends if backend.latency is not None]
+        default_latency = min(known) if known else 0.0
+        return min(ready, key=lambda b: b.score(now, default_latency, self.probe_interval)), 0.0
+
+    async def call(self, invoke):
+        """invoke(model) 发出一次模型调用；失败时换服务重试，直到所有服务都试过"""
+        tried = set()
+        last_error = None
+        waited = 0.0
+        while True:
+            backend, wait = self.choose(tried)
+            if backend is None:
+                raise last_error
+            if wait > 0:
+                if waited + wait > self.max_wait:
+                    raise last_error or RuntimeError(f"所有模型服务都在限流中，需要等待 {wait:.1f} 秒")
+                await asyncio.sleep(wait)
+                waited += wait
+                continue
+            span = current_span.get()
+            if span is not None:
+                span.set("backend", backend.name)
+            attempt = ModelCallAttempt()
+            token = current_model_attempt.set(attempt)
+            started = time.perf_counter()
+            backend.start(time.monotonic())
+            try:
+                result = await invoke(backend.model)
+            except Exception as e:
+                if getattr(e, "status_code", None) in (400, 413, 422):
+                    # 请求本身的问题（例如上下文过长），换服务也不会成功
+                    backend.in_flight -= 1
+                    raise
+                backend.failed(time.monotonic(), e, self.error_threshold, self.cooldown)
+                if attempt.first_token_at is not None:
+                    raise
+                tried.add(backend)
+                last_error = e
+                self.failovers += 1
+                log.warning(f"Model backend {backend.name} failed, failing over: {e}")
+                continue
+            except BaseException:
+                backend.in_flight -= 1
+                raise
+            finally:
+                current_model_attempt.reset(token)
+            backend.succeeded((attempt.first_token_at or time.perf_counter()) - started)
+            return result
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {"failovers": self.failovers, "backends": [backend.stats(now, self.error_threshold) for backend in self.backends]}
+
+
+class ModelRouterMiddleware(AgentMiddleware):
+    """Agent 的每次模型调用都经过 ModelRouter 选择模型服务"""
+
+    def __init__(self, router: ModelRouter):
+        super().__init__()
+        self.router = router
+
+    async def awrap_model_call(self, request, handler):
+        return await self.router.call(lambda model: handler(request.override(model=model)))
+
+model_router = None
+
+# ===== 流式 think 标签过滤 =====
+
+class ThinkTagFilter:
+    """流式过滤 <think>...</think> 推理内容的状态机
+
+    - 标签可以被拆分在多个 chunk 中（例如 "<thi" + "nk>"），可能构成标签前缀的尾部会暂存到下一个 chunk
+    - 每个字符只扫描常数次，总耗时 O(总字符数)，不会重复扫描已处理的内容
+    - 不改动正文中的空白，只去掉回复开头的空白（通常是 </think> 之后的换行）
+    """
+
+    OPEN = "<think>"
+    CLOSE = "</think>"
+
+    def __init__(self, strip_leading: bool = True):
+        self.in_think = False
+        self._pending = ""  # 可能是标签前缀的尾部，最多 len(CLOSE) - 1 个字符
+        self._strip_leading = strip_leading
+
+    def _partial_suffix(self, text: str, start: int) -> int:
+        """text[start:] 的尾部与标签前缀重合的长度（只需检查最后一个 "<" 之后的部分）"""
+        lt = text.rfind("<", max(start, len(text) - len(self.CLOSE) + 1))
+        if lt == -1:
+            return 0
+        tail = text[lt:]
+        if self.CLOSE.startswith(tail) or (not self.in_think and self.OPEN.startswith(tail)):
+            return len(tail)
+        return 0
+
+    def feed(self, chunk: str) -> str:
+        """输入一个 chunk，返回其中应当显示的内容"""
+        if not self._pending and "<" not in chunk:
+            # 快速路径：没有任何标签字符
+            return "" if self.in_think else self._emit(chunk)
+
+        text = self._pending + chunk if self._pending else chunk
+        self._pending = ""
+        out = []
+        pos = 0
+        # 不在 think 块中时，单独出现的 </think> 也需要去掉；记录查找结果避免重复扫描
+        next_close = -2
+        while True:
+            if self.in_think:
+                end = text.find(self.CLOSE, pos)
+                if end == -1:
+                    keep = self._partial_suffix(text, pos)
+                    self._pending = text[len(text) - keep:] if keep else ""
+                    break
+                pos = end + len(self.CLOSE)
+                self.in_think = False
+                next_close = -2
+            else:
+                start = text.find(self.OPEN, pos)
+                if next_close == -2 or (next_close != -1 and next_close < pos):
+                    next_close = text.find(self.CLOSE, pos)
+                if next_close != -1 and (start == -1 or next_close < start):
+                    out.append(text[pos:next_close])
+                    pos = next_close + len(self.CLOSE)
+                    next_close = -2
+                    continue
+                if start == -1:
+                    keep = self._partial_suffix(text, pos)
+                    out.append(text[pos:len(text) - keep])
+                    self._pending = text[len(text) - keep:] if keep else ""
+                    break
+                out.append(text[pos:start])
+                pos = start + len(self.OPEN)
+                self.in_think = True
+        return self._emit("".join(out))
+
+    def flush(self) -> str:
+        """流结束时调用：返回暂存的、最终没有构成标签的尾部"""
+        pending, self._pending = self._pending, ""
+        if self.in_think:
+            return ""
+        return self._emit(pending)
+
+    def _emit(self, content: str) -> str:
+        if self._strip_leading and content:
+            content = content.lstrip()
+            if content:
+                self._strip_leading = False
+        return content
+
+def strip_think(text: str) -> str:
+    """移除完整文本中的所有 <think>...</think> 标签及其内容"""
+    think_filter = ThinkTagFilter()
+    return think_filter.feed(text) + think_filter.flush()
+
+# ===== 任务完成判定 =====
+
+TASK_COMPLETION_PROMPT = """当前任务是否完成？只通过上下文判断，不要调用工具；只回答以下三个选项之一，不要回答其他内容：
+- `True` - 任务已完成
+- `False` - 任务未完成，我应该继续执行
+- `userActionRequired` - 需要用户提供更多信息或进行操作 (例如需要用户登录)"""
+
+_CJK_PATTERN = re.compile(r'[\u2e80-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符约 1 字 1 token，其余约 4 字符 1 token"""
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def usage_tokens(messages) -> int:
+    """统计模型返回的 token 用量，后端没有返回 usage 时按内容估算"""
+    total = 0
+    for msg in messages:
+        usage = getattr(msg, 'usage_metadata', None)
+        if usage:
+            total += usage.get('total_tokens', 0)
+        elif isinstance(msg, AIMessage):
+            total += estimate_tokens(str(msg.content))
+    return total
+
+def prompt_cache_usage(message):
+    """后端返回的 (提示 token, 命中前缀缓存的 token)；没有返回 usage 时为 None"""
+    usage = getattr(message, 'usage_metadata', None)
+    if not usage:
+        return None
+    details = usage.get('input_token_details') or {}
+    cached = sum(v or 0 for k, v in details.items() if k.endswith('cache_read'))
+    if not cached:
+        # DeepSeek 等后端使用 prompt_cache_hit_tokens 字段
+        token_usage = (getattr(message, 'response_metadata', None) or {}).get('token_usage') or {}
+        cached = token_usage.get('prompt_cache_hit_tokens') or 0
+    return usage.get('input_tokens', 0), cached
+
+
+class PromptCacheStats:
+    """各类模型调用的提示 token 与前缀缓存命中统计（来自后端返回的 usage）"""
+
+    def __init__(self, recent: int = 50):
+        self._kinds = {}
+        self.recent = deque(maxlen=recent)
+
+    def record(self, kind: str, message, session_id: str = None):
+        entry = self._kinds.setdefault(kind, {"calls": 0, "reported": 0, "prompt_tokens": 0, "cached_tokens": 0})
+        entry["calls"] += 1
+        usage = prompt_cache_usage(message)
+        if usage is None:
+            return
+        prompt_tokens, cached_tokens = usage
+        entry["reported"] += 1
+        entry["prompt_tokens"] += prompt_tokens
+        entry["cached_tokens"] += cached_tokens
+        self.recent.append({
+            "kind": kind,
+            "session_id": session_id,
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "timestamp": time.time(),
+        })
+
+    def snapshot(self) -> dict:
+        calls = {}
+        for kind, entry in self._kinds.items():
+            calls[kind] = {
+                "calls": entry["calls"],
+                "reported": entry["reported"],
+                "prompt_tokens": entry["prompt_tokens"],
+                "cached_tokens": entry["cached_tokens"],
+                "uncached_tokens": entry["prompt_tokens"] - entry["cached_tokens"],
+                "hit_ratio": round(entry["cached_tokens"] / entry["prompt_tokens"], 3) if entry["prompt_tokens"] else 0,
+            }
+        return {"calls": calls, "recent": list(self.recent)}
+
+prompt_cache_stats = PromptCacheStats()
+
+# 当前模型调用的用途（agent: 对话轮次, check: 任务完成判定, chat: 非流式接口），用于分别统计缓存命中
+model_call_kind = contextvars.ContextVar("model_call_kind", default="agent")
+
+def parse_completion_answer(content: str) -> str:
+    """解析任务完成检查的回答"""
+    content = strip_think(content).strip().lower()
+
+    log.debug("Task completion check response (filtered): %s", content)
+
+    # 优先检查 userActionRequired，然后先检查 continue（避免"未完成"被"完成"误匹配）
+    if 'useractionrequired' in content.replace(' ', '') or '需要用户' in content or '用户操作' in content or '用户提供' in content:
+        return "userActionRequired"
+    elif 'false' in content or '否' == content or '未完成' in content or '没有' in content:
+        return "continue"
+    elif 'true' in content or '是' == content or '完成' in content or '已完成' in content:
+        return "completed"
+
+    # 默认认为任务完成（保守策略，避免过度继续）
+    return "completed"
+
+_USER_ACTION_PATTERN = re.compile(r'请(您)?(先)?登录|登录后|验证码|人机验证|扫码|需要您|请您|请(提供|确认|告诉我|选择)')
+_CONTINUE_PATTERN = re.compile(r'接下来|下一步|我将|我会继续|继续(执行|操作|查看|浏览)|正在|稍等|让我')
+_COMPLETED_PATTERN = re.compile(r'已完成|完成了|已经为您|总结|以上(就)?是|希望(这些|以上)')
+
+def classify_turn_heuristically(text: str, tool_calls: list) -> str:
+    """基于规则判断任务状态：只看最后一条 AI 回复和本轮的工具调用，不访问模型"""
+    text = text.strip()
+    tail = text[-120:]
+
+    if _USER_ACTION_PATTERN.search(tail) or tail.endswith(('？', '?')):
+        return "userActionRequired"
+    if _COMPLETED_PATTERN.search(tail):
+        return "completed"
+    # 回复以冒号结尾或在末尾宣布下一步动作，说明模型还打算继续操作
+    if tail.endswith(('：', ':')) or _CONTINUE_PATTERN.search(tail[-60:]):
+        return "continue"
+    # 本轮调用了工具但只给出很短的回复，多半是工具链被中断
+    if tool_calls and len(text) < 40:
+        return "continue"
+    return "completed"
+
+
+class CompletionStats:
+    """各判定模式的延迟与 token 统计"""
+
+    def __init__(self):
+        self._modes = {}
+
+    def _entry(self, mode: str) -> dict:
+        if mode not in self._modes:
+            self._modes[mode] = {
+                "checks": 0,
+                "decision_seconds": 0.0,
+                "steps": 0,
+                "step_seconds": 0.0,
+                "tokens": 0,
+                "results": {},
+                "speculative_kept": 0,
+                "speculative_cancelled": 0,
+            }
+        return self._modes[mode]
+
+    def record_check(self, mode: str, status: str, seconds: float, tokens: int):
+        entry = self._entry(mode)
+        entry["checks"] += 1
+        entry["decision_seconds"] += seconds
+        entry["tokens"] += tokens
+        entry["results"][status] = entry["results"].get(status, 0) + 1
+
+    def record_step(self, mode: str, seconds: float):
+        """记录一次自动继续步骤中判定阶段造成的阻塞时间"""
+        entry = self._entry(mode)
+        entry["steps"] += 1
+        entry["step_seconds"] += seconds
+
+    def record_speculation(self, mode: str, kept: bool):
+        entry = self._entry(mode)
+        entry["speculative_kept" if kept else "speculative_cancelled"] += 1
+
+    def snapshot(self) -> dict:
+        result = {}
+        for mode, entry in self._modes.items():
+            result[mode] = {
+                "checks": entry["checks"],
+                "avg_decision_ms": round(entry["decision_seconds"] / entry["checks"] * 1000, 1) if entry["checks"] else 0,
+                "avg_step_ms": round(entry["step_seconds"] / entry["steps"] * 1000, 1) if entry["steps"] else 0,
+                "tokens": entry["tokens"],
+                "avg_tokens": round(entry["tokens"] / entry["checks"], 1) if entry["checks"] else 0,
+                "results": dict(entry["results"]),
+                "speculative_kept": entry["speculative_kept"],
+                "speculative_cancelled": entry["speculative_cancelled"],
+            }
+        return result
+
+
+class TaskCompletionChecker:
+    """任务完成判定阶段
+
+    模式（config.json 中 completion_check.mode）：
+    - agent: 使用 Agent 对完整历史追加一次提问（默认，与旧版行为一致）
+    - heuristic: 基于规则判断最后一条 AI 回复和工具调用，不产生模型调用
+    - model: 使用 completion_check.model 中单独配置的小模型，不带工具
+    - speculative: 判定与下一轮推测执行同时进行，判定为完成时取消推测的一轮
+    """
+
+    MODES = ("agent", "heuristic", "model", "speculative")
+
+    def __init__(self, mode: str = "agent", model=None, speculative_base: str = None,
+                 context_messages: int = 12):
+        if mode not in self.MODES:
+            raise ValueError(f"未知的 completion_check.mode: {mode}")
+        self.mode = mode
+        self.model = model
+        self.router = None  # 判定使用 Agent 的模型且配置了多个模型服务时，由 ModelRouter 选择服务
+        self.context_messages = context_messages
+        if mode == "speculative":
+            # 推测执行时真正做判定的模式
+            self.decision_mode = speculative_base or ("model" if model is not None else "agent")
+        else:
+            self.decision_mode = mode
+        self.stats = CompletionStats()
+
+    @classmethod
+    def from_config(cls, config: dict, default_model=None, transport: "ModelTransport" = None):
+        check_config = config.get("completion_check", {})
+        model = None
+        if "model" in check_config:
+            base_url = check_config["model"].get("base_url", config["model"]["base_url"])
+            model = ChatOpenAI(
+                model=check_config["model"]["name"],
+                api_key=check_config["model"].get("api_key", config["model"]["api_key"]),
+                base_url=base_url,
+                temperature=0,
+                **(transport.chat_options(base_url) if transport else {}),
+            )
+        mode = check_config.get("mode", "agent")
+        if mode == "model" and model is None:
+            model = default_model
+        return cls(
+            mode=mode,
+            model=model,
+            speculative_base=check_config.get("speculative_base"),
+            context_messages=check_config.get("context_messages", 12),
+        )
+
+    @property
+    def speculative(self) -> bool:
+        return self.mode == "speculative"
+
+    async def check(self, history: list, agent, turn_text: str = "", turn_tool_calls: list = None) -> str:
+        """
+        判断任务是否完成
+        返回值:
+        - "completed": 任务完成
+        - "continue": 任务未完成，需要继续
+        - "userActionRequired": 需要用户操作，停止自动继续
+        """
+        started = time.perf_counter()
+        tokens = 0
+        kind_token = model_call_kind.set("check")
+        span = tracer.start("completion_check", mode=self.mode)
+        span_token = current_span.set(span) if tracer.enabled else None
+        try:
+            if self.decision_mode == "heuristic":
+                status = classify_turn_heuristically(turn_text, turn_tool_calls or [])
+            elif self.decision_mode == "model":
+                # 小模型只需要系统提示和最近的上下文；窗口起点按半个窗口对齐，
+                # 连续几次判定的前缀保持一致，可以命中后端的前缀缓存
+                system = [history[0]] if history and isinstance(history[0], SystemMessage) else []
+                body = [m for m in history if not isinstance(m, SystemMessage)]
+                step = max(1, self.context_messages // 2)
+                start = max(0, (len(body) - self.context_messages) // step * step)
+                messages = system + body[start:] + [HumanMessage(content=TASK_COMPLETION_PROMPT)]
+                if self.router is not None:
+                    response = await self.router.call(lambda model: model.ainvoke(messages))
+                else:
+                    response = await self.model.ainvoke(messages)
+                prompt_cache_stats.record("check", response)
+                tokens = usage_tokens([response])
+                status = parse_completion_answer(str(response.content))
+            else:
+                # 构建检查消息 - 不添加到历史，只用于检查（判定提示只追加在末尾，历史前缀保持不变）
+                check_messages = history.copy()
+                check_messages.append(HumanMessage(content=TASK_COMPLETION_PROMPT))
+                response = await agent.ainvoke({"messages": check_messages})
+                status = "completed"
+                if response and 'messages' in response:
+                    tokens = usage_tokens(response['messages'][len(check_messages):])
+                    status = parse_completion_answer(str(response['messages'][-1].content))
+        except Exception as e:
+            log.error(f"Task completion check failed: {e}")
+            status = "completed"  # 出错时假设任务完成，避免无限循环
+        finally:
+            model_call_kind.reset(kind_token)
+            if span_token is not None:
+                current_span.reset(span_token)
+
+        seconds = time.perf_counter() - started
+        self.stats.record_check(self.mode, status, seconds, tokens)
+        completion_check_duration.observe(seconds, mode=self.mode)
+        span.set("status", status)
+        span.set("tokens", tokens)
+        span.end()
+        return status
+
+
+# 推测执行的一轮中，工具调用需要等待判定结果确认后才能执行，避免产生副作用
+speculation_gate = contextvars.ContextVar("speculation_gate", default=None)
+
+class SpeculationGateMiddleware(AgentMiddleware):
+    """推测执行的一轮只预先生成模型输出，工具调用在判定为"继续"之后才真正执行"""
+
+    async def awrap_tool_call(self, request, handler):
+        gate = speculation_gate.get()
+        if gate is not None:
+            await gate.wait()
+        return await handler(request)
+
+
+# 当前这一轮 Agent 输出所属会话的生成控制
+current_control = contextvars.ContextVar("current_control", default=None)
+
+class PromptCacheMiddleware(AgentMiddleware):
+    """记录每次模型调用的提示 token 和命中前缀缓存的 token"""
+
+    async def awrap_model_call(self, request, handler):
+        with tracer.span("llm", kind=model_call_kind.get()) as span:
+            response = await handler(request)
+            messages = getattr(response, "result", None) or [response]
+            control = current_control.get()
+            prompt_cache_stats.record(model_call_kind.get(), messages[-1], control.session_id if control else None)
+            usage = prompt_cache_usage(messages[-1])
+            if usage is not None:
+                span.set("prompt_tokens", usage[0])
+                span.set("cached_tokens", usage[1])
+        return response
+
+class SessionControlMiddleware(AgentMiddleware):
+    """工具调用前等待暂停结束，并发布 tool-running 状态"""
+
+    async def awrap_tool_call(self, request, handler):
+        control = current_control.get()
+        if control is None:
+            return await handler(request)
+        await control.running.wait()
+        control.tool_started(request.tool_call.get("name"))
+        try:
+            return await handler(request)
+        finally:
+            control.tool_finished()
+
+
+# ===== 工具输出截断 =====
+
+class ToolOutputStore:
+    """工具输出的截断、去重和带外存储
+
+    超过 max_tokens 的文本输出只把开头部分放进模型上下文，完整内容按内容哈希保存在内存中（按总字符数 LRU 淘汰），
+    模型需要时通过 fetch_tool_output 分段取回。同一轮中与之前完全相同的输出（例如页面没有变化时的快照）只返回引用。
+
+    去重只在一轮（一次 Agent 调用）之内进行：工具输出不写入 SessionHistory，之后的轮次不会再发送之前的工具输出，
+    跨轮去重只会让模型看不到它上下文中没有的内容。
+    """
+
+    def __init__(self, max_tokens: int = 4000, dedupe: bool = True, dedupe_min_tokens: int = 200,
+                 store_chars: int = 32 * 1024 * 1024):
+        self.max_tokens = max_tokens
+        self.dedupe = dedupe
+        self.dedupe_min_tokens = dedupe_min_tokens
+        self.store_chars = store_chars
+        self._outputs = OrderedDict()  # {output_id: text}
+        self._chars = 0
+        self.totals = {"results": 0, "truncated": 0, "deduped": 0, "fetches": 0,
+                       "tokens_in": 0, "tokens_out": 0}
+
+    @classmethod
+    def from_config(cls, config: dict):
+        output_config = config.get("tool_output", {})
+        return cls(
+            max_tokens=output_config.get("max_tokens", 4000),
+            dedupe=output_config.get("dedupe", True),
+            dedupe_min_tokens=output_config.get("dedupe_min_tokens", 200),
+            store_chars=int(output_config.get("store_mb", 32) * 1024 * 1024),
+        )
+
+    @staticmethod
+    def output_id(text: str) -> str:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+
+    def put(self, text: str) -> str:
+        output_id = self.output_id(text)
+        if output_id in self._outputs:
+            self._outputs.move_to_end(output_id)
+            return output_id
+        self._outputs[output_id] = text
+        self._chars += len(text)
+        while self._chars > self.store_chars and len(self._outputs) > 1:
+            _, evicted = self._outputs.popitem(last=False)
+            self._chars -= len(evicted)
+        return output_id
+
+    def get(self, output_id: str):
+        text = self._outputs.get(output_id)
+        if text is not None:
+            self._outputs.move_to_end(output_id)
+        return text
+
+    def budget_chars(self, text: str) -> int:
+        """max_tokens 大致对应的字符数（按这段文本的 token 密度换算）"""
+        tokens = estimate_tokens(text)
+        return len(text) if tokens <= self.max_tokens else max(1, len(text) * self.max_tokens // tokens)
+
+    def process(self, text: str, previous_ids: set) -> tuple:
+        """返回 (放进上下文的内容, output_id)；不需要处理时 output_id 为 None"""
+        tokens = estimate_tokens(text)
+        self.totals["results"] += 1
+        self.totals["tokens_in"] += tokens
+        output_id = None
+        if self.dedupe and tokens >= self.dedupe_min_tokens:
+            output_id = self.put(text)
+            if output_id in previous_ids:
+                self.totals["deduped"] += 1
+                content = f"[输出与本轮之前的工具输出 {output_id} 完全相同，内容没有变化]"
+                self.totals["tokens_out"] += estimate_tokens(content)
+                return content, output_id
+        if self.max_tokens and tokens > self.max_tokens:
+            output_id = output_id or self.put(text)
+            shown = self.budget_chars(text)
+            self.totals["truncated"] += 1
+            content = (f"{text[:shown]}\n\n[输出已截断：只显示了前 {shown}/{len(text)} 个字符。"
+                       f"完整内容保存为 {output_id}，需要时调用 fetch_tool_output(output_id=\"{output_id}\", offset={shown}) 读取后续内容]")
+            self.totals["tokens_out"] += estimate_tokens(content)
+            return content, output_id
+        self.totals["tokens_out"] += tokens
+        return text, output_id
+
+    def fetch(self, output_id: str, offset: int = 0) -> str:
+        """从 offset 开始读取保存的完整输出，每次最多 max_tokens"""
+        self.totals["fetches"] += 1
+        text = self.get(output_id)
+        if text is None:
+            return f"找不到输出 {output_id}（可能已过期），请重新调用原来的工具"
+        offset = max(0, offset)
+        chunk = text[offset:]
+        end = offset + (self.budget_chars(chunk) if self.max_tokens else len(chunk))
+        content = text[offset:end]
+        if end < len(text):
+            content += (f"\n\n[第 {offset}-{end}/{len(text)} 个字符，"
+                        f"继续读取请调用 fetch_tool_output(output_id=\"{output_id}\", offset={end})]")
+        return content
+
+    def stats(self) -> dict:
+        return {
+            **self.totals,
+            "stored": len(self._outputs),
+            "stored_chars": self._chars,
+            "max_tokens": self.max_tokens,
+        }
+
+def tool_message_text(message):
+    """ToolMessage 的纯文本内容；包含图片等非文本内容时返回 None（不做处理）"""
+    content = message.content
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list) and all(
+        isinstance(part, str) or (isinstance(part, dict) and part.get("type") == "text") for part in content
+    ):
+        return "".join(part if isinstance(part, str) else part.get("text", "") for part in content)
+    return None
+
+class ToolOutputMiddleware(AgentMiddleware):
+    """工具输出进入上下文之前截断和去重，并提供 fetch_tool_output 工具取回完整内容"""
+
+    def __init__(self, store: ToolOutputStore):
+        super().__init__()
+        self.store = store
+
+        @tool
+        async def fetch_tool_output(output_id: str, offset: int = 0) -> str:
+            """读取之前被截断的工具输出的完整内容。output_id 和 offset 见截断提示。"""
+            return store.fetch(output_id, offset)
+
+        self.tools = [fetch_tool_output]
+
+    async def awrap_tool_call(self, request, handler):
+        """截断并去重工具输出；去重的对照范围是本轮 Agent 状态中的工具消息（即模型上下文中已有的输出）"""
+        result = await handler(request)
+        if not isinstance(result, ToolMessage) or request.tool_call.get("name") == "fetch_tool_output":
+            return result
+        text = tool_message_text(result)
+        if text is None:
+            return result
+        messages = request.state.get("messages", []) if isinstance(request.state, dict) else []
+        previous_ids = {m.additional_kwargs.get("output_id") for m in messages if isinstance(m, ToolMessage)}
+        content, output_id = self.store.process(text, previous_ids)
+        if output_id is None:
+            return result
+        return result.model_copy(update={
+            "content": content,
+            "additional_kwargs": {**result.additional_kwargs, "output_id": output_id},
+        })
+
+tool_output_store = ToolOutputStore()
+
+# ===== 页面快照增量 =====
+
+_SNAPSHOT_PATTERN = re.compile(r"(- Page Snapshot:[^\n]*\n```yaml\n)(.*?)(\n```)", re.S)
+_SNAPSHOT_REF_PATTERN = re.compile(r"\[ref=([^\]]+)\]")
+_PAGE_URL_PATTERN = re.compile(r"^- Page URL: (.*)$", re.M)
+_CURRENT_TAB_PATTERN = re.compile(r"^- (\d+): \(current\)", re.M)
+
+def snapshot_nodes(body: str) -> OrderedDict:
+    """把快照的每一行解析为节点 {key: (文本, 最近的带 ref 的祖先)}
+
+    带 [ref=...] 的节点以 ref 为键（Playwright 对同一元素的 ref 保持不变），其余节点以父节点和文本为键。
+    """
+    nodes = OrderedDict()
+    stack = []   # [(缩进, 键, 最近的 ref)]
+    counts = {}
+    for line in body.splitlines():
+        text = line.strip()
+        if not text:
+            continue
+        indent = len(line) - len(line.lstrip())
+        while stack and stack[-1][0] >= indent:
+            stack.pop()
+        parent_key, anchor = (stack[-1][1], stack[-1][2]) if stack else ("", "")
+        match = _SNAPSHOT_REF_PATTERN.search(text)
+        if match:
+            key = match.group(1)
+        else:
+            base = f"{parent_key}/{text}"
+            counts[base] = counts.get(base, 0) + 1
+            key = f"{base}#{counts[base]}"
+        nodes[key] = (text, anchor)
+        stack.append((indent, key, match.group(1) if match else anchor))
+    return nodes
+
+def snapshot_diff(old_body: str, new_body: str) -> tuple:
+    """返回 (差异行, 新快照的节点数)；+ 新增，- 删除，~ 内容变化"""
+    old, new = snapshot_nodes(old_body), snapshot_nodes(new_body)
+    lines = []
+    for key, (text, anchor) in new.items():
+        where = f"  (在 {anchor} 下)" if anchor else ""
+        if key not in old:
+            lines.append(f"+ {text}{where}")
+        elif old[key][0] != text:
+            lines.append(f"~ {text}{where}")
+    for key, (text, anchor) in old.items():
+        if key not in new:
+            lines.append(f"- {text}")
+    return lines, len(new)
+
+class SnapshotDiffMiddleware(AgentMiddleware):
+    """页面快照增量
+
+    同一轮中同一标签页、同一 URL 的快照变化不大时，只把与上一次快照相比新增、删除和变化的节点放进上下文；
+    变化超过 max_ratio、URL 改变、上一次快照已过期或连续增量达到 max_chain 次时发送完整快照。
+    上一次快照从本轮的消息中查找，所以模型上下文中总是有可以对照的完整快照。
+    """
+
+    def __init__(self, store: ToolOutputStore, max_ratio: float = 0.3, max_chain: int = 5):
+        super().__init__()
+        self.store = store
+        self.max_ratio = max_ratio
+        self.max_chain = max_chain
+        self.totals = {"snapshots": 0, "diffs": 0, "tokens_full": 0, "tokens_sent": 0}
+
+    @classmethod
+    def from_config(cls, config: dict, store: ToolOutputStore):
+        diff_config = config.get("snapshot_diff", {})
+        return cls(
+            store,
+            max_ratio=diff_config.get("max_ratio", 0.3),
+            max_chain=diff_config.get("max_chain", 5),
+        )
+
+    async def awrap_tool_call(self, request, handler):
+        result = await handler(request)
+        if not isinstance(result, ToolMessage):
+            return result
+        text = tool_message_text(result)
+        match = _SNAPSHOT_PATTERN.search(text) if text else None
+        if match is None:
+            return result
+
+        body = match.group(2)
+        url_match = _PAGE_URL_PATTERN.search(text)
+        tab_match = _CURRENT_TAB_PATTERN.search(text)
+        snapshot = {
+            "id": self.store.put(body),
+            "url": url_match.group(1).strip() if url_match else "",
+            "tab": tab_match.group(1) if tab_match else "0",
+            "chain": 0,
+        }
+
+        messages = request.state.get("messages", []) if isinstance(request.state, dict) else []
+        previous = next((m.additional_kwargs["snapshot"] for m in reversed(messages)
+                         if isinstance(m, ToolMessage) and m.additional_kwargs.get("snapshot", {}).get("tab") == snapshot["tab"]), None)
+
+        content = text
+        if previous and previous["url"] == snapshot["url"] and previous["chain"] < self.max_chain:
+            old_body = self.store.get(previous["id"])
+            if old_body is not None:
+                lines, total = snapshot_diff(old_body, body)
+                if len(lines) <= self.max_ratio * total:
+                    snapshot["chain"] = previous["chain"] + 1
+                    self.totals["diffs"] += 1
+                    header = f"- Page Snapshot（与上一次快照相比的变化，共 {total} 个节点；+ 新增，- 删除，~ 变化）:\n```diff\n"
+                    content = text[:match.start()] + header + ("\n".join(lines) or "（没有变化）") + "\n```" + text[match.end():]
+
+        self.totals["snapshots"] += 1
+        self.totals["tokens_full"] += estimate_tokens(text)
+        self.totals["tokens_sent"] += estimate_tokens(content)
+        return result.model_copy(update={
+            "content": content,
+            "additional_kwargs": {**result.additional_kwargs, "snapshot": snapshot},
+        })
+
+    def stats(self) -> dict:
+        return dict(self.totals)
+
+
+# ===== 工具并发执行 =====
+
+# 不改变页面状态的工具，可以与同一条消息中的其他只读工具并发执行
+READ_ONLY_TOOLS = {
+    "browser_snapshot", "browser_take_screenshot", "browser_console_messages",
+    "browser_network_requests", "browser_generate_locator", "fetch_tool_output",
+}
+
+class ToolTimingStats:
+    """每个工具的调用次数、耗时和排队时间"""
+
+    def __init__(self):
+        self.tools = {}
+        self.max_concurrent = 0
+        self._running = 0
+
+    def started(self):
+        self._running += 1
+        self.max_concurrent = max(self.max_concurrent, self._running)
+
+    def _entry(self, name: str, kind: str = None) -> dict:
+        entry = self.tools.setdefault(name, {"kind": kind, "calls": 0, "errors": 0, "timeouts": 0,
+                                             "total_seconds": 0.0, "max_seconds": 0.0, "wait_seconds": 0.0})
+        entry["kind"] = kind or entry["kind"]
+        return entry
+
+    def timed_out(self, name: str):
+        self._entry(name)["timeouts"] += 1
+
+    def finished(self, name: str, kind: str, waited: float, seconds: float, error: bool):
+        self._running -= 1
+        entry = self._entry(name, kind)
+        entry["calls"] += 1
+        entry["errors"] += int(error)
+        entry["total_seconds"] += seconds
+        entry["max_seconds"] = max(entry["max_seconds"], seconds)
+        entry["wait_seconds"] += waited
+
+    def snapshot(self) -> dict:
+        return {
+            "running": self._running,
+            "max_concurrent": self.max_concurrent,
+            "tools": {name: {**entry, "total_seconds": round(entry["total_seconds"], 3),
+                             "max_seconds": round(entry["max_seconds"], 3),
+                             "wait_seconds": round(entry["wait_seconds"], 3)}
+                      for name, entry in self.tools.items()},
+        }
+
+tool_stats = ToolTimingStats()
+
+class ToolCallBatch:
+    """同一条 AIMessage 中的工具调用
+
+    修改页面的调用是屏障：等之前的所有调用完成后才执行，之后的调用也要等它完成；
+    只读调用只等待之前的修改类调用，因此相邻的只读调用可以并发执行。
+    """
+
+    def __init__(self, kinds: list):
+        self.kinds = kinds
+        self.done = [asyncio.Event() for _ in kinds]
+
+    async def wait_turn(self, index: int):
+        for previous in range(index):
+            if self.kinds[index] == "write" or self.kinds[previous] == "write":
+                await self.done[previous].wait()
+
+    def finish(self, index: int) -> bool:
+        """标记完成，全部完成时返回 True"""
+        self.done[index].set()
+        return all(event.is_set() for event in self.done)
+
+class ToolSchedulerMiddleware(AgentMiddleware):
+    """调度同一条消息中的多个工具调用
+
+    Agent 会同时派发一条消息中的所有工具调用；这里按只读 / 修改分类决定哪些调用可以并发，
+    并限制每个会话同时执行的工具数量，记录每次调用的排队时间和耗时。结果仍按原来的顺序进入历史。
+    """
+
+    def __init__(self, max_per_session: int = 4, read_only: set = None):
+        super().__init__()
+        self.max_per_session = max(1, max_per_session)
+        self.read_only = set(READ_ONLY_TOOLS) | set(read_only or [])
+        self._batches = {}
+        self._slots = weakref.WeakKeyDictionary()  # {SessionControl: Semaphore}
+        self._default_slots = asyncio.Semaphore(self.max_per_session)
+
+    @classmethod
+    def from_config(cls, config: dict):
+        concurrency_config = config.get("tool_concurrency", {})
+        return cls(
+            max_per_session=concurrency_config.get("max_per_session", 4),
+            read_only=concurrency_config.get("read_only", []),
+        )
+
+    def classify(self, tool_call: dict) -> str:
+        name = tool_call.get("name")
+        if name in self.read_only:
+            return "read"
+        if name == "browser_tabs" and (tool_call.get("args") or {}).get("action") == "list":
+            return "read"
+        return "write"
+
+    def _batch_of(self, request):
+        """找到这次调用所在的 AIMessage，返回 (batch 键, batch, 序号)"""
+        call_id = request.tool_call.get("id")
+        messages = request.state.get("messages", []) if isinstance(request.state, dict) else []
+        answered = {m.tool_call_id for m in messages if isinstance(m, ToolMessage)}
+        for message in reversed(messages):
+            # 已经有结果的调用不会再执行，不能让其他调用等待它们
+            calls = [call for call in getattr(message, "tool_calls", None) or [] if call.get("id") not in answered]
+            ids = [call.get("id") for call in calls]
+            if call_id in ids:
+                key = tuple(ids)
+                batch = self._batches.get(key)
+                if batch is None:
+                    batch = self._batches[key] = ToolCallBatch([self.classify(call) for call in calls])
+                return key, batch, ids.index(call_id)
+        return None, None, 0
+
+    def _slots_for(self, control) -> asyncio.Semaphore:
+        if control is None:
+            return self._default_slots
+        slots = self._slots.get(control)
+        if slots is None:
+            slots = self._slots[control] = asyncio.Semaphore(self.max_per_session)
+        return slots
+
+    async def awrap_tool_call(self, request, handler):
+        name = request.tool_call.get("name")
+        kind = self.classify(request.tool_call)
+        key, batch, index = self._batch_of(request)
+        queued = time.perf_counter()
+        error = False
+        try:
+            if batch is not None:
+                await batch.wait_turn(index)
+            async with self._slots_for(current_control.get()):
+                started = time.perf_counter()
+                tool_stats.started()
+                try:
+                    with tracer.span("tool", tool=name, kind=kind, queued_seconds=round(started - queued, 6)) as span:
+                        result = await handler(request)
+                        error = getattr(result, "status", None) == "error"
+                        if error:
+                            span.fail((tool_message_text(result) or str(result.content))[:200])
+                    return result
+                except BaseException:
+                    error = True
+                    raise
+                finally:
+                    seconds = time.perf_counter() - started
+                    tool_stats.finished(name, kind, started - queued, seconds, error)
+                    tool_duration.observe(seconds, tool=name)
+                    log.info(f"Tool {name} ({kind}) finished in {seconds:.3f}s, queued {started - queued:.3f}s"
+                          f"{' with error' if error else ''}")
+        finally:
+            if batch is not None and batch.finish(index):
+                self._batches.pop(key, None)
+
+
+# ===== 工具超时与出错重试 =====
+
+class RetryStats:
+    """工具超时、流出错后的重试和退避等待的计数"""
+
+    def __init__(self):
+        self.counts = {"tool_timeouts": 0, "tool_failures": 0, "stream_errors": 0, "retries": 0,
+                       "gave_up": 0, "backoff_seconds": 0.0}
+
+    def record(self, name: str, amount: float = 1):
+        self.counts[name] += amount
+
+    def snapshot(self) -> dict:
+        return {**self.counts, "backoff_seconds": round(self.counts["backoff_seconds"], 3)}
+
+retry_stats = RetryStats()
+
+class RetryPolicy:
+    """流出错后自动重试的策略：第 n 次连续出错后等待 base_delay * 2^(n-1) 秒（不超过 max_delay），
+    再随机减少最多 jitter 比例，避免多个会话在后端故障恢复时同时重试"""
+
+    def __init__(self, max_errors: int = 10, base_delay: float = 1.0, max_delay: float = 30.0, jitter: float = 0.5):
+        self.max_errors = max(1, max_errors)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = min(1.0, max(0.0, jitter))
+
+    @classmethod
+    def from_config(cls, config: dict):
+        retry_config = config.get("retry", {})
+        return cls(
+            max_errors=retry_config.get("max_errors", 10),
+            base_delay=retry_config.get("base_delay", 1.0),
+            max_delay=retry_config.get("max_delay", 30.0),
+            jitter=retry_config.get("jitter", 0.5),
+        )
+
+    def delay(self, attempt: int) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** max(0, attempt - 1))
+        return delay * (1 - self.jitter * random.random())
+
+class ToolGuardMiddleware(AgentMiddleware):
+    """给每次工具调用加上超时，并维护所属 MCP 会话的熔断器
+
+    - 超时的调用返回一条错误的工具结果，模型可以据此换一种方式继续，而不是一直占着会话锁
+    - 超时或 MCP 会话抛出异常都计为一次失败，连续失败达到阈值时熔断器断开，
+      之后的调用抛出 BrowserSessionWedged，由流重启该会话后重试
+    - 工具正常返回（包括工具自身报告的错误）时失败计数清零
+    """
+
+    def __init__(self, default_timeout: float = 60, timeouts: dict = None):
+        super().__init__()
+        self.default_timeout = default_timeout
+        self.timeouts = dict(timeouts or {})
+
+    @classmethod
+    def from_config(cls, config: dict):
+        timeouts = dict(config.get("tool_timeouts", {}))
+        default_timeout = timeouts.pop("default", 60)
+        return cls(default_timeout=default_timeout, timeouts=timeouts)
+
+    def timeout_for(self, name: str):
+        """工具的超时秒数，0 或 None 表示不限制"""
+        return self.timeouts.get(name, self.default_timeout) or None
+
+    def _failed(self, browser, reason: str):
+        if browser is not None and browser.breaker.failure():
+            raise BrowserSessionWedged(
+                f"浏览器会话 #{browser.index} 连续 {browser.breaker.failures} 次工具调用失败（{reason}），需要重启"
+            )
+
+    async def awrap_tool_call(self, request, handler):
+        name = request.tool_call.get("name")
+        browser = current_browser.get()
+        if browser is not None and browser.breaker.open:
+            raise BrowserSessionWedged(f"浏览器会话 #{browser.index} 已熔断，等待重启")
+
+        timeout = self.timeout_for(name)
+        try:
+            result = await asyncio.wait_for(handler(request), timeout)
+        except asyncio.TimeoutError:
+            retry_stats.record("tool_timeouts")
+            tool_stats.timed_out(name)
+            log.warning(f"Tool {name} timed out after {timeout}s")
+            self._failed(browser, f"{name} 超时")
+            return ToolMessage(
+                content=f"工具 {name} 在 {timeout} 秒内没有返回，调用已取消。页面可能仍在加载，"
+                        f"可以先查看页面当前状态再决定下一步。",
+                tool_call_id=request.tool_call.get("id"),
+                name=name,
+                status="error",
+            )
+        except BrowserSessionWedged:
+            raise
+        except Exception as e:
+            retry_stats.record("tool_failures")
+            self._failed(browser, f"{name}: {e}")
+            raise
+        if browser is not None:
+            browser.breaker.success()
+        return result
+
+
+TURN_END = object()  # 一轮 Agent 输出结束的标记
+RETRY_DUE = object()  # 出错后的退避等待结束的标记
+
+class CompletionDecision:
+    """推测执行时，判定结果通过同一个队列送达"""
+
+    def __init__(self, status: str):
+        self.status = status
+
+async def pump_agent_stream(agent, messages: list, queue: asyncio.Queue, gate: asyncio.Event = None,
+                            control: SessionControl = None, browser: PooledBrowser = None, span=None):
+    """在独立任务中运行一轮 Agent 流式输出，将 chunk 依次放入队列"""
+    speculation_gate.set(gate)
+    current_control.set(control)
+    current_browser.set(browser)
+    current_span.set(span)
+    try:
+        async for chunk in agent.astream({"messages": messages}, stream_mode=["messages"]):
+            await queue.put(chunk)
+    except Exception as e:
+        await queue.put(e)
+    finally:
+        queue.put_nowait(TURN_END)
+
+# ===== 会话录制与回放 =====
+
+current_recording = contextvars.ContextVar("current_recording", default=None)
+current_replay = contextvars.ContextVar("current_replay", default=None)
+
+class ReplayExhausted(Exception):
+    """回放时记录中已经没有对应的模型输出或工具结果（通常是回放时的配置与录制时不同）"""
+
+
+def _message_record(message) -> dict:
+    """记录中的消息只保留发送给模型的字段"""
+    record = {"role": message.type, "content": message.content}
+    for key in ("tool_calls", "tool_call_id", "name"):
+        value = getattr(message, key, None)
+        if value:
+            record[key] = value
+    return record
+
+def _chunk_record(message, offset: float) -> dict:
+    """一个输出 chunk 的紧凑表示：t 为相对调用开始的秒数，其余字段只在非空时出现"""
+    entry = {"t": round(offset, 4)}
+    if message.content:
+        entry["c"] = message.content
+    tool_call_chunks = getattr(message, "tool_call_chunks", None)
+    if tool_call_chunks:
+        entry["tc"] = tool_call_chunks
+    elif getattr(message, "tool_calls", None):
+        # 非流式调用只有完整的 tool_calls，转换成 chunk 形式以便回放时流式输出
+        entry["tc"] = [{"name": call["name"], "args": json.dumps(call["args"], ensure_ascii=False),
+                        "id": call["id"], "index": index} for index, call in enumerate(message.tool_calls)]
+    if getattr(message, "usage_metadata", None):
+        entry["u"] = message.usage_metadata
+    if message.response_metadata:
+        entry["m"] = message.response_metadata
+    if getattr(message, "chunk_position", None):
+        entry["p"] = message.chunk_position
+    return entry
+
+
+class SessionRecording:
+    """一次请求的记录：模型调用的请求和 chunk 流、工具调用的参数和结果，请求结束时一次写出
+
+    同一类模型调用（agent / check）的请求只记录与上一次请求相比新增的消息：base 为沿用的消息数，append 为新增的消息。
+    """
+
+    def __init__(self, path: str, session_id: str, message: str):
+        self.path = path
+        self.started = time.perf_counter()
+        self.events = [{"type": "request", "version": 1, "session_id": session_id, "message": message, "ts": time.time()}]
+        self.closed = False
+        self._calls = {}
+        self._previous = {}
+
+    def offset(self) -> float:
+        return round(time.perf_counter() - self.started, 4)
+
+    def llm_started(self, run_id, kind: str, messages: list):
+        records = [_message_record(message) for message in messages]
+        encoded = [json.dumps(record, ensure_ascii=False, sort_keys=True, default=str) for record in records]
+        previous = self._previous.get(kind, [])
+        base = 0
+        while base < min(len(previous), len(encoded)) and previous[base] == encoded[base]:
+            base += 1
+        self._previous[kind] = encoded
+        event = {"type": "llm", "kind": kind, "t": self.offset(), "base": base, "append": records[base:], "chunks": []}
+        self._calls[run_id] = (time.perf_counter(), event)
+        self.events.append(event)
+
+    def llm_chunk(self, run_id, message):
+        call = self._calls.get(run_id)
+        if call is not None:
+            call[1]["chunks"].append(_chunk_record(message, time.perf_counter() - call[0]))
+
+    def llm_finished(self, run_id, message=None, error: BaseException = None):
+        call = self._calls.pop(run_id, None)
+        if call is None:
+            return
+        started, event = call
+        event["duration"] = round(time.perf_counter() - started, 4)
+        if not event["chunks"] and message is not None:
+            event["chunks"].append(_chunk_record(message, event["duration"]))
+        if error is not None:
+            event["error"] = str(error) or type(error).__name__
+
+    def tool_finished(self, call: dict, started: float, result=None, error: BaseException = None, cancelled: bool = False):
+        event = {"type": "tool", "t": round(started - self.started, 4), "id": call.get("id"), "name": call.get("name"),
+                 "args": call.get("args"), "duration": round(time.perf_counter() - started, 4)}
+        if cancelled:
+            event["cancelled"] = True
+        elif error is not None:
+            event["error"] = str(error) or type(error).__name__
+        elif isinstance(result, ToolMessage):
+            event["content"] = result.content
+            event["status"] = result.status
+        else:
+            return
+        self.events.append(event)
+
+    def finish(self) -> str:
+        self.closed = True
+        self.events.append({"type": "end", "t": self.offset()})
+        return "".join(json.dumps(event, ensure_ascii=False, default=str) + "\n" for event in self.events)
+
+
+class RecordingCallback(AsyncCallbackHandler):
+    """把模型调用的请求和 chunk 流写入当前请求的记录；当前请求没有在录制时什么都不做"""
+
+    async def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        recording = current_recording.get()
+        if recording is not None and not recording.closed:
+            recording.llm_started(run_id, model_call_kind.get(), messages[0])
+
+    async def on_llm_new_token(self, token, *, chunk=None, run_id, **kwargs):
+        recording = current_recording.get()
+        if recording is not None and chunk is not None:
+            recording.llm_chunk(run_id, chunk.message)
+
+    async def on_llm_end(self, response, *, run_id, **kwargs):
+        recording = current_recording.get()
+        if recording is not None:
+            generations = response.generations[0] if response.generations else []
+            recording.llm_finished(run_id, message=generations[0].message if generations else None)
+
+    async def on_llm_error(self, error, *, run_id, **kwargs):
+        recording = current_recording.get()
+        if recording is not None:
+            recording.llm_finished(run_id, error=error)
+
+
+class SessionRecorder:
+    """按 session_id 录制会话，每次请求作为一个 gzip 成员追加到 {dir}/{session_id}.jsonl.gz，在后台线程中写出"""
+
+    def __init__(self, directory: str = "recordings", sessions: list = None):
+        self.directory = directory
+        self.sessions = set(sessions or [])
+        self.callback = RecordingCallback()
+        self.recorded = 0
+        self.failed = 0
+        self._writes = set()
+
+    @classmethod
+    def from_config(cls, config: dict):
+        recording_config = config.get("recording", {})
+        return cls(recording_config.get("dir", "recordings"), recording_config.get("sessions", []))
+
+    def path(self, session_id: str) -> str:
+        return os.path.join(self.directory, re.sub(r"[^\w.-]", "_", session_id) + ".jsonl.gz")
+
+    def begin(self, session_id: str, message: str):
+        """开始录制一次请求；该会话不需要录制时返回 None"""
+        if "*" not in self.sessions and session_id not in self.sessions:
+            return None
+        return SessionRecording(self.path(session_id), session_id, message)
+
+    def finish(self, recording: SessionRecording):
+        task = asyncio.create_task(asyncio.to_thread(self._write, recording.path, recording.finish()))
+        self._writes.add(task)
+        task.add_done_callback(self._written)
+
+    def _written(self, task: asyncio.Task):
+        self._writes.discard(task)
+        if task.cancelled() or task.exception() is not None:
+            self.failed += 1
+            log.warning(f"Failed to write session recording: {task.exception() if not task.cancelled() else 'cancelled'}")
+        else:
+            self.recorded += 1
+
+    def _write(self, path: str, data: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with gzip.open(path, "at", encoding="utf-8") as f:
+            f.write(data)
+
+    async def close(self):
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {"sessions": sorted(self.sessions), "dir": self.directory, "recorded": self.recorded,
+                "failed": self.failed, "pending": len(self._writes)}
+
+session_recorder = SessionRecorder()
+
+
+class TracePlayer:
+    """按录制时的顺序回放一个会话记录中的模型输出和工具结果
+
+    模型调用按类型（agent / check）依次取出记录，工具结果按 tool_call_id 取出（回放的模型输出带有相同的 ID）。
+    speed 为时间倍速：1 保持录制时的 chunk 间隔和工具耗时，10 表示快 10 倍，0 表示不等待。
+    """
+
+    def __init__(self, requests: list, speed: float = 1.0):
+        self.requests = requests
+        self.speed = speed
+        self.mismatches = 0
+        self.model_calls = 0
+        self.tool_calls = 0
+        self._llm = {"agent": deque(), "check": deque()}
+        self._tools = {}
+        self._busy = []
+
+    @classmethod
+    def load(cls, path: str, speed: float = 1.0):
+        requests = []
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                event = json.loads(line)
+                if event["type"] == "request":
+                    requests.append({"message": event["message"], "events": []})
+                elif requests:
+                    requests[-1]["events"].append(event)
+        return cls(requests, speed)
+
+    def prepare(self, index: int):
+        """载入第 index 次请求的记录，丢弃上一次请求中没有用到的部分"""
+        for calls in self._llm.values():
+            calls.clear()
+        self._tools.clear()
+        for event in self.requests[index]["events"]:
+            if event["type"] == "llm":
+                self._llm["check" if event["kind"] == "check" else "agent"].append(event)
+            elif event["type"] == "tool" and event.get("id"):
+                self._tools[event["id"]] = event
+
+    async def _wait(self, seconds: float):
+        if self.speed > 0 and seconds > 0:
+            await asyncio.sleep(seconds / self.speed)
+
+    def _exhausted(self, what: str):
+        self.mismatches += 1
+        control = current_control.get()
+        if control is not None:
+            control.stop("replay_exhausted")
+        return ReplayExhausted(f"No recorded {what} left to replay")
+
+    async def stream(self, kind: str):
+        """依次产生记录中的 AIMessageChunk，chunk 之间按录制时的间隔等待"""
+        calls = self._llm["check" if kind == "check" else "agent"]
+        if not calls:
+            raise self._exhausted(f"{kind} model call")
+        event = calls.popleft()
+        self.model_calls += 1
+        started = time.perf_counter()
+        elapsed = 0.0
+        try:
+            for entry in event["chunks"]:
+                await self._wait(entry["t"] - elapsed)
+                elapsed = entry["t"]
+                yield AIMessageChunk(content=entry.get("c", ""), tool_call_chunks=entry.get("tc", []),
+                                     usage_metadata=entry.get("u"), response_metadata=entry.get("m", {}),
+                                     chunk_position=entry.get("p"))
+            if "error" in event:
+                raise RuntimeError(event["error"])
+            await self._wait(event.get("duration", elapsed) - elapsed)
+        finally:
+            self._busy.append((started, time.perf_counter()))
+
+    async def tool_result(self, call: dict) -> ToolMessage:
+        event = self._tools.pop(call.get("id"), None)
+        if event is None:
+            raise self._exhausted(f"result for tool {call.get('name')}")
+        self.tool_calls += 1
+        started = time.perf_counter()
+        try:
+            await self._wait(event["duration"])
+        finally:
+            self._busy.append((started, time.perf_counter()))
+        if event.get("cancelled"):
+            # 录制时被工具超时取消，回放时让 ToolGuardMiddleware 同样按超时处理
+            raise asyncio.TimeoutError()
+        if "error" in event:
+            raise RuntimeError(event["error"])
+        return ToolMessage(content=event["content"], name=call["name"], tool_call_id=call["id"],
+                           status=event.get("status", "success"))
+
+    def busy_seconds(self) -> float:
+        """回放的模型输出和工具调用占用的时间（重叠部分只算一次）"""
+        total = 0.0
+        end = None
+        for started, finished in sorted(self._busy):
+            if end is None or started > end:
+                total += finished - started
+                end = finished
+            elif finished > end:
+                total += finished - end
+                end = finished
+        return total
+
+    def summary(self, wall: float, statuses: list) -> dict:
+        recorded = sum(next((event["t"] for event in request["events"] if event["type"] == "end"), 0.0)
+                       for request in self.requests)
+        overhead = max(0.0, wall - self.busy_seconds())
+        return {
+            "requests": len(self.requests),
+            "statuses": statuses,
+            "speed": self.speed,
+            "model_calls": self.model_calls,
+            "tool_calls": self.tool_calls,
+            "mismatches": self.mismatches,
+            "recorded_seconds": round(recorded, 3),
+            "wall_seconds": round(wall, 3),
+            "replayed_seconds": round(self.busy_seconds(), 3),
+            "overhead_seconds": round(overhead, 3),
+            "overhead_ms_per_call": round(overhead / max(1, self.model_calls) * 1000, 2),
+        }
+
+
+class ReplayChatModel(BaseChatModel):
+    """回放会话记录中的模型输出，在没有模型服务的情况下测量守护进程本身的开销"""
+
+    player: Any = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "everbrowser-replay"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        raise NotImplementedError("ReplayChatModel 只支持异步调用")
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        async for message in self.player.stream(model_call_kind.get()):
+            chunk = ChatGenerationChunk(message=message)
+            if run_manager:
+                await run_manager.on_llm_new_token(message.text, chunk=chunk)
+            yield chunk
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        return await agenerate_from_stream(self._astream(messages, stop, run_manager, **kwargs))
+
+
+class SessionRecordingMiddleware(AgentMiddleware):
+    """录制时记录 MCP 工具调用的参数、结果和耗时；回放时直接返回记录的结果，不调用 MCP"""
+
+    async def awrap_tool_call(self, request, handler):
+        player = current_replay.get()
+        if player is not None:
+            return await player.tool_result(request.tool_call)
+        recording = current_recording.get()
+        if recording is None or recording.closed:
+            return await handler(request)
+        started = time.perf_counter()
+        try:
+            result = await handler(request)
+        except asyncio.CancelledError:
+            recording.tool_finished(request.tool_call, started, cancelled=True)
+            raise
+        except Exception as e:
+            recording.tool_finished(request.tool_call, started, error=e)
+            raise
+        recording.tool_finished(request.tool_call, started, result=result)
+        return result
+
+# ===== SSE 输出 =====
+
+SSE_TICK = object()  # SSEWriter 定时器到期的标记
+
+class SSEWriter:
+    """SSE 帧编码：合并 token、空闲时发送心跳
+
+    - token 先暂存，累计达到 flush_bytes 或距第一个暂存 token 超过 flush_interval 秒时合并成一帧发送
+    - 只有在超过 heartbeat_interval 秒没有发送任何帧时才发送心跳
+    - token 帧使用预先编码好的前缀，每帧只需序列化一次内容
+    - 等待时不对每个 chunk 设置超时，而是用 arm() 在到期时向队列放入一个 SSE_TICK
+    """
+
+    totals = {"streams": 0, "frames": 0, "bytes": 0, "tokens": 0, "heartbeats": 0}
+
+    def __init__(self, session_id: str, flush_interval: float = 0.05, flush_bytes: int = 1024,
+                 heartbeat_interval: float = 15):
+        self.session_id = session_id
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.heartbeat_interval = heartbeat_interval
+        self._token_prefix = 'data: {"type":"token","session_id":' + json.dumps(session_id, ensure_ascii=False) + ',"content":'
+        self._pending = []
+        self._pending_size = 0
+        self._pending_since = None
+        self._last_frame_at = time.monotonic()
+        self._tick = None
+        self._tick_at = 0.0
+        self._tick_queue = None
+        SSEWriter.totals["streams"] += 1
+
+    @classmethod
+    def from_config(cls, session_id: str, config: dict):
+        sse_config = config.get("sse", {})
+        return cls(
+            session_id,
+            flush_interval=sse_config.get("flush_interval", 0.05),
+            flush_bytes=sse_config.get("flush_bytes", 1024),
+            heartbeat_interval=sse_config.get("heartbeat_interval", 15),
+        )
+
+    def _count(self, frame: str) -> str:
+        self._last_frame_at = time.monotonic()
+        SSEWriter.totals["frames"] += 1
+        SSEWriter.totals["bytes"] += len(frame)
+        return frame
+
+    def token(self, content: str):
+        """暂存一个 token，达到合并阈值时返回合并后的帧，否则返回 None"""
+        if self._pending_since is None:
+            self._pending_since = time.monotonic()
+        self._pending.append(content)
+        self._pending_size += len(content)
+        SSEWriter.totals["tokens"] += 1
+        if self._pending_size >= self.flush_bytes:
+            return self.flush()
+        return None
+
+    def flush(self) -> str:
+        """立即发送暂存的 token，没有暂存内容时返回空字符串"""
+        if not self._pending:
+            return ""
+        content = self._pending[0] if len(self._pending) == 1 else "".join(self._pending)
+        self._pending.clear()
+        self._pending_size = 0
+        self._pending_since = None
+        return self._count('%s%s,"timestamp":%.3f}\n\n' % (
+            self._token_prefix, json.dumps(content, ensure_ascii=False), time.time()
+        ))
+
+    def event(self, data: dict) -> str:
+        """发送其他类型的帧，先发送暂存的 token 以保证顺序"""
+        return self.flush() + self._count(f"data: {json.dumps(data, ensure_ascii=False)}\n\n")
+
+    def timeout(self) -> float:
+        """距离下一次需要合并发送或心跳的秒数"""
+        now = time.monotonic()
+        if self._pending_since is not None:
+            return max(0.0, self._pending_since + self.flush_interval - now)
+        return max(0.0, self._last_frame_at + self.heartbeat_interval - now)
+
+    def due(self) -> str:
+        """到时间后调用：发送暂存的 token，或者在空闲时发送心跳"""
+        now = time.monotonic()
+        if self._pending_since is not None:
+            if now - self._pending_since >= self.flush_interval:
+                return self.flush()
+            return ""
+        if now - self._last_frame_at >= self.heartbeat_interval:
+            SSEWriter.totals["heartbeats"] += 1
+            return self._count('data: {"type":"ping","timestamp":%.3f}\n\n' % time.time())
+        return ""
+
+    def arm(self, queue: asyncio.Queue):
+        """保证在下一次需要调用 due() 时向队列放入 SSE_TICK；已有更早的定时器时不重复设置"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout()
+        if self._tick is not None:
+            if self._tick_queue is queue and self._tick_at <= deadline:
+                return
+            self._tick.cancel()
+        self._tick_queue = queue
+        self._tick_at = deadline
+        self._tick = loop.call_at(deadline, self._fire, queue)
+
+    def _fire(self, queue: asyncio.Queue):
+        self._tick = None
+        queue.put_nowait(SSE_TICK)
+
+    def disarm(self):
+        if self._tick is not None:
+            self._tick.cancel()
+            self._tick = None
+
+# ===== 批量任务队列 =====
+
+JOB_DONE = object()  # 任务结束时放入订阅队列的标记
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(q * (len(values) - 1))))]
+
+
+class Job:
+    """一个批量浏览任务：状态、计时和结果
+
+    运行期间输出的 SSE 帧保存在 frames 中，/jobs/{job_id}/stream 中途订阅时先回放已有的帧；任务结束后释放。
+    """
+
+    def __init__(self, job_id: str, message: str, session_id: str, priority: int = 0, created: float = None,
+                 status: str = "pending", started: float = None, finished: float = None,
+                 content: str = "", error: str = None):
+        self.job_id = job_id
+        self.message = message
+        self.session_id = session_id
+        self.priority = priority
+        self.created = created or time.time()
+        self.status = status
+        self.started = started
+        self.finished = finished
+        self.content = content
+        self.error = error
+        self.cancel_requested = False
+        self.frames = []
+        self.subscribers = set()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("completed", "failed", "cancelled")
+
+    def publish(self, frame):
+        if frame is not JOB_DONE:
+            self.frames.append(frame)
+        for subscriber in self.subscribers:
+            subscriber.put_nowait(frame)
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "session_id": self.session_id,
+            "message": self.message,
+            "priority": self.priority,
+            "status": self.status,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "queued_seconds": round(self.started - self.created, 3) if self.started else None,
+            "run_seconds": round((self.finished or time.time()) - self.started, 3) if self.started else None,
+            "content": self.content,
+            "error": self.error,
+        }
+
+
+class JobQueue:
+    """批量浏览任务的优先级队列
+
+    - 任务按 priority 从高到低、同优先级按提交顺序执行，workers 个任务同时运行（默认等于浏览器会话池的大小）
+    - 每个任务通过与 /chat/stream 相同的流程运行，默认使用独立的会话（job-<id>），因此各自租用一个浏览器
+    - 任务和结果写入 SQLite；守护进程重启后未开始的任务继续排队，运行中被中断的任务标记为失败
+    - 最近完成的 max_recent 个任务的排队时间和运行时间用于计算吞吐量和 p50/p95 延迟
+    """
+
+    COLUMNS = ("job_id", "session_id", "message", "priority", "status", "created", "started", "finished",
+               "content", "error")
+
+    def __init__(self, path: str, workers: int = 3, max_recent: int = 1000, max_age_days: float = 7):
+        self.path = path
+        self.workers = max(1, workers)
+        self.max_recent = max(1, max_recent)
+        self._queue = asyncio.PriorityQueue()
+        self._jobs = {}              # 未完成的任务和最近访问的已完成任务
+        self._finished = OrderedDict()
+        self._recent = deque(maxlen=self.max_recent)  # (完成时间, 总耗时, 运行时间)
+        self._counts = {"submitted": 0, "completed": 0, "failed": 0, "cancelled": 0}
+        self._seq = 0
+        self._running = 0
+        self._tasks = []
+        self._runner = None
+        self._stopper = None
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            message TEXT NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL,
+            created REAL NOT NULL,
+            started REAL,
+            finished REAL,
+            content TEXT NOT NULL DEFAULT '',
+            error TEXT
+        )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created)")
+        if max_age_days:
+            self._db.execute("DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?",
+                             (time.time() - max_age_days * 86400,))
+        self._recover()
+
+    @classmethod
+    def from_config(cls, config: dict, default_workers: int = 3):
+        jobs_config = config.get("jobs", {})
+        return cls(
+            jobs_config.get("path", "jobs.db"),
+            workers=jobs_config.get("workers") or default_workers,
+            max_recent=jobs_config.get("max_recent", 1000),
+            max_age_days=jobs_config.get("max_age_days", 7),
+        )
+
+    def _recover(self):
+        """上次退出时运行中的任务标记为失败，未开始的任务重新排队"""
+        interrupted = self._db.execute(
+            "UPDATE jobs SET status = 'failed', finished = ?, error = ? WHERE status = 'running'",
+            (time.time(), "守护进程退出，任务被中断"),
+        ).rowcount
+        pending = [self._row_to_job(row) for row in self._db.execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE status = 'pending' ORDER BY created"
+        )]
+        for job in pending:
+            self._enqueue(job)
+        if interrupted or pending:
+            log.info(f"Job queue recovered: {len(pending)} pending, {interrupted} interrupted")
+
+    def _row_to_job(self, row) -> Job:
+        return Job(**dict(zip(self.COLUMNS, row)))
+
+    def _save(self, job: Job):
+        self._db.execute(
+            f"INSERT OR REPLACE INTO jobs ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})",
+            tuple(getattr(job, column) for column in self.COLUMNS),
+        )
+
+    def _enqueue(self, job: Job):
+        self._seq += 1
+        self._jobs[job.job_id] = job
+        self._queue.put_nowait((-job.priority, self._seq, job.job_id))
+
+    def start(self, runner, stopper):
+        """启动 workers 个执行任务的协程
+
+        runner(job, on_frame) 运行一个任务并返回 {"content", "status", "error"}；stopper(session_id) 停止会话的生成。
+        """
+        self._runner = runner
+        self._stopper = stopper
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, message: str, session_id: str = None, priority: int = 0) -> Job:
+        job_id = uuid.uuid4().hex
+        job = Job(job_id, message, session_id or f"job-{job_id[:12]}", priority)
+        self._save(job)
+        self._enqueue(job)
+        self._counts["submitted"] += 1
+        return job
+
+    def get(self, job_id: str):
+        job = self._jobs.get(job_id) or self._finished.get(job_id)
+        if job is not None:
+            return job
+        row = self._db.execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def list(self, status: str = None, limit: int = 100) -> list:
+        """最近提交的任务（不含结果正文），按提交时间倒序"""
+        query = f"SELECT {', '.join(self.COLUMNS)} FROM jobs"
+        params = ()
+        if status:
+            query += " WHERE status = ?"
+            params = (status,)
+        query += " ORDER BY created DESC LIMIT ?"
+        jobs = []
+        for row in self._db.execute(query, (*params, max(1, limit))):
+            # 内存中的任务状态比磁盘上的新
+            job = self._jobs.get(row[0]) or self._row_to_job(row)
+            jobs.append({**job.to_dict(), "content": None})
+        return jobs
+
+    def cancel(self, job_id: str):
+        """取消任务：排队中的直接标记为取消，运行中的停止会话的生成"""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return self.get(job_id)
+        if job.status == "pending":
+            self._finish(job, {"content": "", "status": "cancelled", "error": None})
+        elif job.status == "running":
+            job.cancel_requested = True
+            self._stopper(job.session_id)
+        return job
+
+    def _finish(self, job: Job, result: dict):
+        job.status = result["status"]
+        job.content = result.get("content", "")
+        job.error = result.get("error") if job.status != "cancelled" else None
+        job.finished = time.time()
+        self._save(job)
+        self._counts[job.status] += 1
+        if job.started is not None:
+            self._recent.append((job.finished, job.finished - job.created, job.finished - job.started))
+        job.publish(JOB_DONE)
+        job.frames = []
+        self._jobs.pop(job.job_id, None)
+        self._finished[job.job_id] = job
+        while len(self._finished) > self.max_recent:
+            self._finished.popitem(last=False)
+
+    async def _worker(self):
+        while True:
+            _, _, job_id = await self._queue.get()
+            job = self._jobs.get(job_id)
+            if job is None or job.status != "pending":
+                continue  # 排队期间被取消
+            job.status = "running"
+            job.started = time.time()
+            self._save(job)
+            self._running += 1
+            try:
+                result = await self._runner(job, job.publish)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error(f"Job {job_id} failed: {e}")
+                result = {"content": "", "status": "failed", "error": str(e)}
+            finally:
+                self._running -= 1
+            if job.cancel_requested:
+                result = {**result, "status": "cancelled"}
+            self._finish(job, result)
+            log.info(f"Job {job_id} {job.status} in {job.finished - job.started:.2f}s "
+                  f"(queued {job.started - job.created:.2f}s)")
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._db.close()
+
+    def stats(self) -> dict:
+        now = time.time()
+        totals = [total for _, total, _ in self._recent]
+        runs = [run for _, _, run in self._recent]
+        last_minute = sum(1 for finished, _, _ in self._recent if now - finished <= 60)
+        return {
+            "workers": self.workers,
+            "running": self._running,
+            "queue_depth": sum(1 for job in self._jobs.values() if job.status == "pending"),
+            **self._counts,
+            "throughput_per_minute": last_minute,
+            "latency_p50_seconds": round(percentile(totals, 0.5), 3),
+            "latency_p95_seconds": round(percentile(totals, 0.95), 3),
+            "run_p50_seconds": round(percentile(runs, 0.5), 3),
+            "run_p95_seconds": round(percentile(runs, 0.95), 3),
+        }
+
+# ===== 启动快速路径 =====
+
+class StartupTimer:
+    """记录启动各阶段的耗时，冷启动（需要安装浏览器）和热启动分开统计"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = OrderedDict()
+        self.kind = "warm"
+        self.finished = None
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round(time.perf_counter() - started, 3)
+            log.info(f"Startup phase {name}: {self.phases[name]:.3f}s")
+
+    def finish(self) -> dict:
+        self.finished = round(time.perf_counter() - self.started, 3)
+        log.info(f"Startup finished ({self.kind}): {self.finished:.3f}s")
+        return self.snapshot()
+
+    def snapshot(self) -> dict:
+        return {
+            "kind": self.kind,
+            "total_seconds": self.finished,
+            "phases": dict(self.phases),
+        }
+
+startup_timer = StartupTimer()
+
+class BrowserManifest:
+    """已安装浏览器的本地清单
+
+    启动时只检查 ms-playwright 目录中带 INSTALLATION_COMPLETE 标记的浏览器目录和 Chrome 可执行文件，
+    都存在、清单记录的版本仍在磁盘上、当前 playwright 包要求的浏览器版本已安装、playwright 包的版本与清单记录的相同，
+    且未超过 max_age_days 时跳过 npx playwright install。
+    超过 max_age_days 后重新安装一次，以便获取 @latest 的浏览器更新。
+    """
+
+    MARKER = "INSTALLATION_COMPLETE"
+    HISTORY = 20  # 清单中保留的启动记录条数
+
+    def __init__(self, path: str = ".everbrowser/browsers.json", browsers_path: str = None,
+                 browsers: list = None, chrome: bool = True, max_age_days: float = 7):
+        self.path = path
+        self.browsers_path = browsers_path or self.default_browsers_path()
+        self.browsers = browsers or ["chromium"]
+        self.chrome = chrome
+        self.max_age_days = max_age_days
+        self.data = self._load()
+
+    @classmethod
+    def from_config(cls, config: dict):
+        install_config = config.get("browser_install", {})
+        return cls(
+            path=install_config.get("manifest", ".everbrowser/browsers.json"),
+            browsers_path=install_config.get("browsers_path"),
+            browsers=install_config.get("browsers", ["chromium"]),
+            chrome=install_config.get("chrome", True),
+            max_age_days=install_config.get("max_age_days", 7),
+        )
+
+    @staticmethod
+    def default_browsers_path() -> str:
+        """Playwright 默认的浏览器安装目录"""
+        if os.environ.get("PLAYWRIGHT_BROWSERS_PATH"):
+            return os.environ["PLAYWRIGHT_BROWSERS_PATH"]
+        system = platform.system()
+        if system == "Windows":
+            return os.path.join(os.environ.get("LOCALAPPDATA", os.path.expanduser("~")), "ms-playwright")
+        if system == "Darwin":
+            return os.path.expanduser("~/Library/Caches/ms-playwright")
+        return os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "ms-playwright")
+
+    @staticmethod
+    def chrome_path():
+        """npx playwright install chrome 安装的 Chrome 稳定版路径，不存在时返回 None"""
+        system = platform.system()
+        if system == "Windows":
+            candidates = [os.path.join(os.environ.get(env, ""), "Google", "Chrome", "Application", "chrome.exe")
+                          for env in ("PROGRAMFILES", "PROGRAMFILES(X86)", "LOCALAPPDATA") if os.environ.get(env)]
+        elif system == "Darwin":
+            candidates = ["/Applications/Google Chrome.app/Contents/MacOS/Google Chrome"]
+        else:
+            candidates = ["/opt/google/chrome/chrome"]
+        return next((path for path in candidates if os.path.exists(path)), None)
+
+    @staticmethod
+    def playwright_package() -> tuple:
+        """当前环境中 playwright 包的版本及其要求的浏览器版本 {浏览器名: 版本号}，读取失败时返回 (None, {})"""
+        try:
+            import playwright
+            version = importlib.metadata.version("playwright")
+            with open(os.path.join(os.path.dirname(playwright.__file__), "driver", "package", "browsers.json"),
+                      "r", encoding="utf-8") as f:
+                browsers = json.load(f)["browsers"]
+            return version, {browser["name"]: browser["revision"] for browser in browsers}
+        except (ImportError, importlib.metadata.PackageNotFoundError, OSError, ValueError, KeyError, TypeError):
+            return None, {}
+
+    def installed(self) -> dict:
+        """扫描浏览器目录，返回 {浏览器名: [已完整安装的版本号]}，例如 chromium-1187 -> {"chromium": ["1187"]}"""
+        revisions = {}
+        try:
+            entries = os.listdir(self.browsers_path)
+        except OSError:
+            return revisions
+        for entry in entries:
+            name, _, revision = entry.rpartition("-")
+            if name and os.path.exists(os.path.join(self.browsers_path, entry, self.MARKER)):
+                revisions.setdefault(name.replace("_", "-"), []).append(revision)
+        for versions in revisions.values():
+            versions.sort()
+        return revisions
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, self.path)
+
+    def check(self) -> list:
+        """返回需要安装的原因，空列表表示可以跳过安装"""
+        reasons = []
+        installed = self.installed()
+        for name in self.browsers:
+            if not installed.get(name):
+                reasons.append(f"{name} not installed")
+        if self.chrome and not self.chrome_path():
+            reasons.append("chrome not installed")
+        for name, versions in self.data.get("revisions", {}).items():
+            missing = [v for v in versions if v not in installed.get(name, [])]
+            if missing:
+                reasons.append(f"{name} {','.join(missing)} removed")
+        # playwright 包升级后要求的浏览器版本可能已经变了，磁盘上的旧版本无法被它启动
+        version, required = self.playwright_package()
+        recorded_version = self.data.get("playwright_version")
+        if version and recorded_version and version != recorded_version:
+            reasons.append(f"playwright {recorded_version} -> {version}")
+        for name in self.browsers:
+            revision = required.get(name)
+            if revision and installed.get(name) and revision not in installed[name]:
+                reasons.append(f"{name} {revision} required by playwright {version} not installed")
+        installed_at = self.data.get("installed_at")
+        if installed_at and self.max_age_days and time.time() - installed_at > self.max_age_days * 86400:
+            reasons.append(f"older than {self.max_age_days} days")
+        return reasons
+
+    def record(self, installed_now: bool):
+        """记录当前磁盘上的浏览器版本；第一次发现浏览器已经装好时也写入清单"""
+        if installed_now or "installed_at" not in self.data:
+            self.data["installed_at"] = time.time()
+        self.data["browsers_path"] = self.browsers_path
+        self.data["playwright_version"] = self.playwright_package()[0]
+        self.data["revisions"] = {name: versions for name, versions in self.installed().items() if name in self.browsers}
+        self.data["chrome"] = self.chrome_path()
+        self._save()
+
+    def record_startup(self, startup: dict):
+        self.data["startups"] = (self.data.get("startups", []) + [{**startup, "timestamp": time.time()}])[-self.HISTORY:]
+        self._save()
+
+class MCPServerCache:
+    """本地缓存的 MCP 服务器
+
+    把 npm 包安装到 cache_dir 后直接用 node 运行入口文件，每个浏览器会话启动时不再经过 npx 解析版本和下载。
+    version 为固定版本时只在版本不一致时安装；为 latest 时每 update_days 天更新一次。
+    安装失败（例如离线）时继续使用已缓存的版本，没有缓存时才退回 npx。
+    配置了 command 时原样使用 command 和 args，不做缓存。
+    """
+
+    def __init__(self, package: str = "@playwright/mcp", version: str = "latest",
+                 cache_dir: str = ".everbrowser/mcp", update_days: float = 7,
+                 args: list = None, env: dict = None, command: str = None):
+        self.package = package
+        self.version = version
+        self.cache_dir = cache_dir
+        self.update_days = update_days
+        self.args = list(args or [])
+        self.env = env
+        self.command = command
+
+    @classmethod
+    def from_config(cls, config: dict):
+        mcp_config = config.get("mcp", {})
+        return cls(
+            package=mcp_config.get("package", "@playwright/mcp"),
+            version=str(mcp_config.get("version", "latest")),
+            cache_dir=mcp_config.get("cache_dir", ".everbrowser/mcp"),
+            update_days=mcp_config.get("update_days", 7),
+            args=mcp_config.get("args"),
+            env=mcp_config.get("env"),
+            command=mcp_config.get("command"),
+        )
+
+    @property
+    def package_dir(self) -> str:
+        return os.path.join(self.cache_dir, "node_modules", *self.package.split("/"))
+
+    @property
+    def stamp_path(self) -> str:
+        return os.path.join(self.cache_dir, "everbrowser-install.json")
+
+    def installed(self) -> dict:
+        """已缓存的包信息 {"version", "bin", "installed_at"}，没有缓存时返回 None"""
+        try:
+            with open(os.path.join(self.package_dir, "package.json"), "r", encoding="utf-8") as f:
+                package_json = json.load(f)
+        except (OSError, ValueError):
+            return None
+        bin_entry = package_json.get("bin")
+        if isinstance(bin_entry, dict):
+            bin_entry = next(iter(bin_entry.values()), None)
+        if not bin_entry or not os.path.exists(os.path.join(self.package_dir, bin_entry)):
+            return None
+        try:
+            with open(self.stamp_path, "r", encoding="utf-8") as f:
+                installed_at = json.load(f).get("installed_at", 0)
+        except (OSError, ValueError):
+            installed_at = 0
+        return {
+            "version": package_json.get("version"),
+            "bin": os.path.abspath(os.path.join(self.package_dir, bin_entry)),
+            "installed_at": installed_at,
+        }
+
+    def check(self) -> list:
+        """返回需要安装的原因，空列表表示可以直接使用缓存"""
+        installed = self.installed()
+        if installed is None:
+            return [f"{self.package} not cached"]
+        if self.version != "latest":
+            return [] if installed["version"] == self.version else [f"{self.package} {installed['version']} != {self.version}"]
+        if self.update_days and time.time() - installed["installed_at"] > self.update_days * 86400:
+            return [f"{self.package} older than {self.update_days} days"]
+        return []
+
+    async def install(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        npm = "npm.cmd" if os.name == "nt" else "npm"
+        process = await asyncio.create_subprocess_exec(
+            npm, "install", "--prefix", self.cache_dir, "--no-audit", "--no-fund", f"{self.package}@{self.version}",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+        if process.returncode != 0:
+            message = stderr.decode("utf-8", errors="ignore").strip()
+            raise Exception(message.splitlines()[0] if message else f"npm exited with {process.returncode}")
+        with open(self.stamp_path, "w", encoding="utf-8") as f:
+            json.dump({"package": self.package, "version": self.version, "installed_at": time.time()}, f)
+
+    async def server_config(self) -> dict:
+        """返回 MultiServerMCPClient 的 stdio 服务器配置，必要时先安装或更新缓存"""
+        if self.command:
+            server = {"transport": "stdio", "command": self.command, "args": self.args}
+        else:
+            reasons = self.check()
+            if reasons:
+                log.info(f"Installing MCP server: {'; '.join(reasons)}")
+                try:
+                    await self.install()
+                except Exception as e:
+                    log.warning(f"MCP server install failed, using cached version if any: {e}")
+            installed = self.installed()
+            if installed:
+                log.info(f"MCP server {self.package} {installed['version']} from {self.cache_dir}")
+                server = {"transport": "stdio", "command": "node", "args": [installed["bin"], *self.args]}
+            else:
+                log.warning(f"MCP server not cached, falling back to npx {self.package}@{self.version}")
+                server = {"transport": "stdio", "command": "npx", "args": ["-y", f"{self.package}@{self.version}", *self.args]}
+        if self.env:
+            server["env"] = self.env
+        return server
+
 # API Models
 class ChatRequest(BaseModel):
     message: str = ""
     session_id: str = "default"
     messages: list = None  # 支持对话历史格式 - 期望格式: [{"role": "user", "content": "消息内容"}]
+    wait: bool = True      # /chat：为 False 时立即返回 job_id，之后通过 /chat/jobs/{job_id} 查询结果
+
+class ControlRequest(BaseModel):
+    session_id: str = "default"
+    mode: str = "now"  # 停止方式: "now" 立即停止, "after_tool" 当前工具结束后停止
+
+class JobRequest(BaseModel):
+    message: str
+    session_id: Optional[str] = None  # 默认每个任务使用独立的会话
+    priority: int = 0                 # 越大越先执行
 
 class ChatResponse(BaseModel):
-    content: str
+    content: str = ""
     session_id: str
     timestamp: float
+    status: str = "completed"  # pending / running / completed / failed / cancelled
+    job_id: Optional[str] = None
+    error: Optional[str] = None
 
 # Global variables for agent and messages
 app = FastAPI(title="everBrowser API", version="1.0.0")
-global_agent = None
 global_client = None
-global_session = None
-global_session_manager = None
+global_session_pool = None  # MCPSessionPool：每个 session_id 从池中租用独立的浏览器会话
 system_msg_content = system_msg.content
 
-# 会话历史管理 - 存储每个 session_id 的对话历史
-session_histories = {}  # {session_id: [messages]}
-session_locks = {}      # {session_id: asyncio.Lock} 用于并发控制
-MAX_HISTORY_LENGTH = 50  # 最大历史消息数量（防止 token 溢出）
-stop_flags = {}         # {session_id: bool} 用于停止生成
+# 会话历史管理 - 每个 session_id 的对话历史、并发锁和停止标志（持久化到磁盘）
+session_store = None  # SessionStore
+job_queue = None      # JobQueue：/jobs 和 /chat?wait=false 提交的任务
 
 def send_macos_notification(title, message, sound=True):
     """在 macOS 上发送系统通知"""
@@ -175,7 +4125,7 @@ def send_macos_notification(title, message, sound=True):
     try:
         subprocess.run(["osascript", "-e", script], check=False, capture_output=True)
     except Exception as e:
-        print(f"⚠️ 发送通知失败: {e}")
+        log.warning(f"⚠️ 发送通知失败: {e}")
 
 def show_image(image_path):
     img = Image.open(image_path)
@@ -225,8 +4175,15 @@ def hide_image(w):
     if w and tkinter.Toplevel.winfo_exists(w):
         w.destroy()
 
+def playwright_npx() -> str:
+    """npx 运行的 playwright 固定为与 Python playwright 包相同的版本，安装的浏览器版本才与 BrowserManifest 检查的一致"""
+    version = BrowserManifest.playwright_package()[0]
+    return f"npx -y playwright@{version}" if version else "npx -y playwright"
+
+
 async def install_playwright_with_flash(image_window):
     """异步安装 Playwright，在安装过程中让图标闪烁或发送通知"""
+    npx = playwright_npx()
     # macOS 使用通知，其他系统使用闪烁图标
     is_macos = platform.system() == "Darwin"
     is_windows = platform.system() == "Windows"
@@ -234,13 +4191,13 @@ async def install_playwright_with_flash(image_window):
     # 启动安装进程（非阻塞）
     if is_windows:
         process = await asyncio.create_subprocess_shell(
-            "npx -y playwright install & npx -y playwright install chrome",
+            f"{npx} install & {npx} install chrome",
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE
         )
     elif is_macos:
         process = await asyncio.create_subprocess_shell(
-            'osascript -e \'do shell script "npx -y playwright install && npx -y playwright install chrome" with administrator privileges\'',
+            f'osascript -e \'do shell script "{npx} install && {npx} install chrome" with administrator privileges\'',
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE
         )
@@ -258,7 +4215,7 @@ async def install_playwright_with_flash(image_window):
             if result.strip():
                 # 使用用户输入的密码执行命令
                 process = await asyncio.create_subprocess_shell(
-                    f'echo "{password}" | sudo -S npx -y playwright install && npx -y playwright install chrome',
+                    f'echo "{result.strip()}" | sudo -S {npx} install && {npx} install chrome',
                     stdout=asyncio.subprocess.PIPE,
                     stderr=asyncio.subprocess.PIPE,
                     shell=True
@@ -279,7 +4236,7 @@ async def install_playwright_with_flash(image_window):
             if result.strip():
                 # 使用用户输入的密码执行命令
                 process = await asyncio.create_subprocess_shell(
-                    f'echo "{password}" | sudo -S npx -y playwright install && npx -y playwright install chrome',
+                    f'echo "{result.strip()}" | sudo -S {npx} install && {npx} install chrome',
                     stdout=asyncio.subprocess.PIPE,
                     stderr=asyncio.subprocess.PIPE,
                     shell=True
@@ -343,57 +4300,55 @@ async def install_playwright_with_flash(image_window):
 
     return process.returncode
 
-async def start_server_and_browser(image_window):
-    """启动服务器并打开浏览器"""
+async def start_server_and_browser(image_window, server_config: dict = None, headless: bool = False,
+                                   ui_browser: "InProcessBrowser" = None):
+    """启动服务器并打开浏览器（headless 模式只启动服务器），返回 (server, server_task, 浏览器或 None)
+
+    ui_browser 是已经启动的进程内浏览器，在其中打开聊天界面；为 None 时用 npx playwright cr 启动浏览器。
+    """
+    server_config = server_config or {}
+    host = server_config.get("host", "127.0.0.1")
+    port = server_config.get("port", 41465)
+    base_url = f"http://{host}:{port}"
+
     # 启动 API 服务器
     config = uvicorn.Config(
         app=app,
-        host="127.0.0.1",
-        port=41465,
+        host=host,
+        port=port,
         log_level="info"
     )
     server = uvicorn.Server(config)
 
-    print("🚀 everBrowser API Server starting on http://127.0.0.1:41465")
-    print("💬 Chat UI: http://127.0.0.1:41465")
-    print("📖 API Documentation: http://127.0.0.1:41465/docs")
-    print("📡 Streaming Chat: POST /chat/stream")
-    print("🔍 Health Check: GET /health")
-    print("📜 User Script: http://127.0.0.1:41465/chat.user.js")
+    log.info(f"🚀 everBrowser API Server starting on {base_url}")
+    log.info(f"💬 Chat UI: {base_url}")
+    log.info(f"📖 API Documentation: {base_url}/docs")
+    log.info("📡 Streaming Chat: POST /chat/stream")
+    log.info("📶 Session Events: GET /chat/events")
+    log.info("🔍 Health Check: GET /health")
+    log.info(f"📜 User Script: {base_url}/chat.user.js")
 
     # 在后台运行服务器
     server_task = asyncio.create_task(server.serve())
     
-    # 等待服务器启动完成
-    await asyncio.sleep(3)
-    
-    # 服务器启动完成后再打开浏览器（使用 subprocess 后台运行）
-    try:
-        if os.name == 'nt':  # Windows
-            browser_process = subprocess.Popen(
-                "npx playwright cr http://127.0.0.1:41465",
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-        else:  # Unix / Linux / macOS
-            browser_process = subprocess.Popen(
-                ["npx", "playwright", "cr", "http://127.0.0.1:41465"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-
-        # 后台监控浏览器进程，检测异常退出
-        async def monitor_playwright_launch():
-            """监控 Playwright 启动进程，同步退出守护进程"""
-            returncode = await asyncio.get_event_loop().run_in_executor(None, browser_process.wait)
-            exit(1)
-
-        # 启动监控任务（不等待，让它在后台运行）
-        asyncio.create_task(monitor_playwright_launch())
-
-    except Exception as e:
-        raise Exception(f"{e}")
+    # 等待服务器开始监听（端口被占用等启动失败时 serve() 会提前结束）
+    while not server.started:
+        if server_task.done():
+            server_task.result()
+            raise Exception(f"API 服务器启动失败: {base_url}")
+        await asyncio.sleep(0.02)
+
+    if headless:
+        log.info("Headless mode, not opening the browser")
+        return server, server_task, None
+
+    # 服务器启动完成后再打开聊天界面
+    if ui_browser:
+        supervisor = ui_browser
+        await supervisor.open(base_url)
+    else:
+        supervisor = BrowserSupervisor(base_url)
+        await supervisor.start()
 
     # 隐藏启动图像（仅非 macOS）或发送启动成功通知（macOS）
     if platform.system() == "Darwin":
@@ -401,108 +4356,197 @@ async def start_server_and_browser(image_window):
     elif image_window and tkinter.Toplevel.winfo_exists(image_window):
         hide_image(image_window)
 
-    # 查找并监控浏览器进程 - 持续查找直到找到为止
-    browser_pid = None
-    while browser_pid is None:
-        browser_pid = find_playwright_browser()
-        if browser_pid:
-            print(f"✅ 找到浏览器进程 (PID: {browser_pid})")
-            monitor_thread = threading.Thread(
-                target=monitor_browser_process,
-                args=(browser_pid,),
-                daemon=True
-            )
-            monitor_thread.start()
-        else:
-            time.sleep(CHECK_INTERVAL)
+    return server, server_task, supervisor
 
-async def main():
+async def main(headless: bool = False, config_path: str = "config.json", reinstall: bool = False,
+               replay: str = None, replay_speed: float = 1.0):
+    """headless 模式不显示启动图标和通知、不安装 Playwright、不打开浏览器，用于测试和基准测试；
+    reinstall 忽略浏览器清单，强制执行一次 npx playwright install；
+    replay 为会话记录文件时，启动后用记录中的模型输出和工具结果回放整个会话，输出耗时汇总后退出"""
     ### Init started ###
 
-    print("--- everBrowser Daemon ---")
+    global log_pipeline
+    log_pipeline.start()
+    log.info("--- everBrowser Daemon ---")
 
     # 检查单实例
     if not check_single_instance():
+        log_pipeline.stop()
         sys.exit(1)
 
     # macOS 使用系统通知，其他系统使用图形界面
     image_window = None
     photo_obj = None
-    if platform.system() == "Darwin":
+    if headless:
+        pass
+    elif platform.system() == "Darwin":
         send_macos_notification("everBrowser", "正在启动 everBrowser...", sound=True)
     else:
         image_window, photo_obj = show_image('starting.png')
 
+    ui_browser = None
     try:
-        with open('config.json', 'r', encoding='utf-8') as config_file:
-            config = json.load(config_file)
-
-        # 异步安装 Playwright，在安装过程中图标会闪烁
-        await install_playwright_with_flash(image_window)
-
-        client = MultiServerMCPClient(
-            {
-                "everbrowser": {
-                    "transport": "stdio",
-                    "command": "npx",
-                    "args": ["@playwright/mcp@latest"],
-                }
-            }
-        )
-        model = ChatOpenAI(
-            model = config["model"]["name"],
-            api_key = config["model"]["api_key"],
-            base_url = config["model"]["base_url"],
-            streaming = True,
-            temperature = 0.7,
-            max_tokens = None,  # 不限制最大 token 数 - 作为显式参数
-            request_timeout = None  # 不限制请求超时时间
+        with startup_timer.phase("config"):
+            with open(config_path, 'r', encoding='utf-8') as config_file:
+                config = json.load(config_file)
+
+        # 日志在后台线程写出（级别、格式和输出文件见 logging 配置）
+        log_pipeline.stop()
+        log_pipeline = LogPipeline.from_config(config)
+        log_pipeline.start()
+
+        # 浏览器已经装好时跳过安装；缺失或过期时异步安装 Playwright，在安装过程中图标会闪烁
+        browser_manifest = None
+        if not headless:
+            with startup_timer.phase("browser_check"):
+                browser_manifest = BrowserManifest.from_config(config)
+                reasons = ["--reinstall"] if reinstall else browser_manifest.check()
+            if reasons:
+                log.info(f"Installing browsers: {'; '.join(reasons)}")
+                startup_timer.kind = "cold"
+                with startup_timer.phase("browser_install"):
+                    await install_playwright_with_flash(image_window)
+            else:
+                log.info(f"Browsers up to date in {browser_manifest.browsers_path}, skipping install")
+            browser_manifest.record(installed_now=bool(reasons))
+
+        # MCP 服务器的启动命令（默认使用本地缓存的 @playwright/mcp，测试时可以换成本地的模拟服务器）
+        with startup_timer.phase("mcp_resolve"):
+            mcp_cache = MCPServerCache.from_config(config)
+            mcp_server = await mcp_cache.server_config()
+
+        # 默认在进程内启动用户浏览器，MCP 服务器通过 CDP 连接同一个浏览器（browser.mode 为 launcher 时使用 npx playwright cr）
+        if not headless and config.get("browser", {}).get("mode", "inprocess") == "inprocess":
+            with startup_timer.phase("browser_launch"):
+                ui_browser = InProcessBrowser.from_config(config)
+                await ui_browser.launch()
+            if not mcp_cache.command:
+                mcp_server["args"] = [*mcp_server["args"], *ui_browser.mcp_args()]
+        client = MultiServerMCPClient({"everbrowser": mcp_server})
+
+        # 会话录制（recording.sessions 中的会话）；回放时模型输出来自会话记录
+        global session_recorder
+        replay_player = TracePlayer.load(replay, replay_speed) if replay else None
+        session_recorder = SessionRecorder() if replay_player else SessionRecorder.from_config(config)
+
+        # 模型服务的连接池（Agent 和任务完成判定共用），启动时在后台预先建立连接
+        global model_transport
+        model_transport = ModelTransport.from_config(config)
+        def chat_model(model_config: dict, callbacks: list = (), **options) -> ChatOpenAI:
+            return ChatOpenAI(
+                model = model_config["name"],
+                api_key = model_config["api_key"],
+                base_url = model_config["base_url"],
+                streaming = True,
+                stream_usage = model_config.get("stream_usage", True),  # 流式输出结束时返回 usage（含命中缓存的 token 数）
+                temperature = 0.7,
+                max_tokens = None,  # 不限制最大 token 数 - 作为显式参数
+                callbacks = [session_recorder.callback, *callbacks],
+                # 连接池、超时（默认只限制建立连接的时间）和重试
+                **{**model_transport.chat_options(model_config["base_url"]), **options},
+            )
+
+        # 配置了 model.backends 时，每次模型调用由路由选择最快的健康服务，失败时换服务重试（客户端自身不再重试）
+        global model_router
+        model_router = None
+        if replay_player:
+            model = ReplayChatModel(player=replay_player)
+        elif config["model"].get("backends"):
+            model_router = ModelRouter.from_config(
+                config, lambda model_config: chat_model(model_config, [router_callback], max_retries=0))
+            model = model_router.backends[0].model
+        else:
+            model = chat_model(config["model"])
+        # 在后台预热模型服务的连接，不阻塞启动；退出时取消尚未完成的预热
+        model_warmup = None
+        if not replay_player:
+            backend_configs = [{**config["model"], **backend} for backend in config["model"].get("backends") or [{}]]
+            model_warmup = asyncio.gather(*(model_transport.warmup(backend["base_url"], backend["api_key"])
+                                            for backend in backend_configs))
+
+        # 任务完成判定阶段（模式见 config.json 中的 completion_check）
+        completion_checker = TaskCompletionChecker.from_config(config, model, model_transport)
+        if completion_checker.model is not None and completion_checker.model is not model:
+            if replay_player:
+                completion_checker.model = model
+            else:
+                completion_checker.model.callbacks = [session_recorder.callback]
+        elif completion_checker.model is model and model_router:
+            completion_checker.router = model_router
+
+        # 同一条消息中多个工具调用的并发调度（所有 Agent 共用，按会话限制并发数）
+        tool_scheduler = ToolSchedulerMiddleware.from_config(config)
+
+        # 工具调用超时和 MCP 会话熔断；流出错后的退避重试
+        tool_guard = ToolGuardMiddleware.from_config(config)
+        retry_policy = RetryPolicy.from_config(config)
+
+        # 追踪（配置了 telemetry.trace_file 时写入 OTLP/JSON 文件）
+        global tracer
+        tracer = Tracer.from_config(config)
+        tracer.start_exporter()
+
+        # 工具输出的截断和带外存储
+        global tool_output_store
+        tool_output_store = ToolOutputStore.from_config(config)
+        snapshot_diff_middleware = None
+        if config.get("snapshot_diff", {}).get("enabled", False):
+            snapshot_diff_middleware = SnapshotDiffMiddleware.from_config(config, tool_output_store)
+
+        # 持久化的会话存储
+        global session_store
+        session_store = SessionStore.from_config(config)
+
+        # 创建 MCP 浏览器会话池（每个会话拥有独立的 MCP 进程和 Agent）
+        session_pool = MCPSessionPool.from_config(
+            client,
+            "everbrowser",
+            # 配置 Agent 支持长工具调用链
+            lambda tools: create_agent(model, tools=tools, middleware=[
+                PromptCacheMiddleware(), *([ModelRouterMiddleware(model_router)] if model_router else []),
+                SpeculationGateMiddleware(), tool_scheduler, SessionControlMiddleware(),
+                # 超时只计算工具本身的执行时间，不包括暂停和排队
+                tool_guard, ToolOutputMiddleware(tool_output_store),
+                # 快照增量在截断之前处理工具输出
+                *([snapshot_diff_middleware] if snapshot_diff_middleware else []),
+                # 录制和回放的是 MCP 返回的原始结果
+                SessionRecordingMiddleware(),
+            ]),
+            config,
         )
 
-        # 创建持久的MCP会话
-        session_manager = client.session("everbrowser")
-        session = await session_manager.__aenter__()
-        
         try:
-            tools = await load_mcp_tools(session)
-            # 配置 Agent 支持长工具调用链
-            agent = create_agent(
-                model,
-                tools=tools,
-            )
+            with startup_timer.phase("session_pool"):
+                await session_pool.start()
 
-            messages = [system_msg]
+            if image_window and tkinter.Toplevel.winfo_exists(image_window):
+                image_window.update()
+                image_window.update_idletasks()
+
+            # 保存会话池到全局变量
+            global global_session_pool
+            global_session_pool = session_pool
 
-            for i in range(10):
-                if image_window and tkinter.Toplevel.winfo_exists(image_window):
-                    image_window.update()
-                    image_window.update_idletasks()
-                await asyncio.sleep(0.5)
-            
-            # 保存会话和agent到全局变量
-            global global_agent, global_session, global_session_manager
-            global_agent = agent
-            global_session = session
-            global_session_manager = session_manager
-
-            
         except Exception as e:
             # 确保在出错时也能正确关闭会话
-            await session_manager.__aexit__(type(e), e, e.__traceback__)
+            await session_pool.close()
             raise e
-            
+
     except Exception as e:
         try:
             if image_window and tkinter.Toplevel.winfo_exists(image_window):
                 hide_image(image_window)
         except:
             pass
+        if ui_browser:
+            await ui_browser.stop()
 
-        print(f"Error: {e}")
-        traceback.print_exc()
+        log.critical(f"Startup failed: {e}", exc_info=True)
 
         # macOS 使用通知，其他系统使用失败图标闪烁
-        if platform.system() == "Darwin":
+        if headless:
+            pass
+        elif platform.system() == "Darwin":
             # 发送失败通知
             send_macos_notification("everBrowser", f"⚠️ 启动失败！", sound=True)
         else:
@@ -525,10 +4569,10 @@ async def main():
                 hide_image(fail_window)
 
         cleanup_lock_file()
+        log_pipeline.stop()
         exit(1)
 
     ### Init Finished ###
-    messages = [system_msg]
 
     # Set up CORS middleware
     app.add_middleware(
@@ -548,433 +4592,762 @@ async def main():
     global_client = client
 
     # 启动服务器后再打开浏览器
-    await start_server_and_browser(image_window)
+    with startup_timer.phase("server_and_browser"):
+        server, server_task, browser_supervisor = await start_server_and_browser(
+            image_window, config.get("server", {}), headless, ui_browser)
+    startup = startup_timer.finish()
+    if browser_manifest:
+        browser_manifest.record_startup(startup)
 
     # ===== 会话历史管理辅助函数 =====
 
-    def get_session_lock(session_id: str) -> asyncio.Lock:
-        """获取或创建会话锁"""
-        if session_id not in session_locks:
-            session_locks[session_id] = asyncio.Lock()
-        return session_locks[session_id]
-
-    def get_session_history(session_id: str) -> list:
-        """获取会话历史"""
-        if session_id not in session_histories:
-            session_histories[session_id] = []
-        return session_histories[session_id]
+    def get_session_history(session_id: str) -> SessionHistory:
+        """获取会话历史（不在内存中时从磁盘加载）"""
+        return session_store.get(session_id).history
 
     def add_to_history(session_id: str, message):
-        """添加消息到历史，自动管理长度"""
-        history = get_session_history(session_id)
-        history.append(message)
-
-        # 保持历史长度在限制内（保留系统消息）
-        if len(history) > MAX_HISTORY_LENGTH:
-            # 保留第一条系统消息，删除最旧的对话
-            system_msg = history[0] if isinstance(history[0], SystemMessage) else None
-            history = history[-(MAX_HISTORY_LENGTH-1):]
-            if system_msg:
-                history.insert(0, system_msg)
-            session_histories[session_id] = history
+        """添加消息到历史并持久化，超出 token 预算时自动压缩"""
+        session_store.append(session_id, message)
 
     def clear_session_history(session_id: str):
         """清除会话历史"""
-        if session_id in session_histories:
-            session_histories[session_id] = []
-        if session_id in stop_flags:
-            del stop_flags[session_id]
-
-    def set_stop_flag(session_id: str, value: bool = True):
-        """设置停止标志"""
-        stop_flags[session_id] = value
-
-    def should_stop(session_id: str) -> bool:
-        """检查是否应该停止"""
-        return stop_flags.get(session_id, False)
-
-    async def check_task_completion(session_id: str) -> str:
-        """
-        后台检查任务是否完成
-        返回值:
-        - "completed": 任务完成
-        - "continue": 任务未完成，需要继续
-        - "userActionRequired": 需要用户操作，停止自动继续
+        session_store.clear(session_id)
+
+    def get_session_control(session_id: str) -> SessionControl:
+        """获取会话的生成控制（停止、暂停/继续、状态发布）"""
+        return session_store.get(session_id).control
+
+    @asynccontextmanager
+    async def generation_scope(control: SessionControl, request: Request = None):
+        """一次生成的生命周期：后台等待 ASGI 的 http.disconnect 消息，客户端断开后立即取消生成；结束时发布 idle 状态"""
+        async def watch():
+            while True:
+                message = await request.receive()
+                if message.get("type") == "http.disconnect":
+                    log.info(f"Client disconnected, cancelling session {control.session_id}")
+                    control.stop("disconnect")
+                    return
+
+        watcher = asyncio.create_task(watch()) if request is not None else None
+        try:
+            yield
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            control.wakeup = None
+            control.set_state("idle")
+
+    @asynccontextmanager
+    async def request_scope(session_id: str, message: str = None):
+        """一次请求的会话锁、追踪 span 和会话录制：同一会话的请求串行处理，记录等待会话锁的时间
+
+        请求（包括排队等待会话锁的时间）期间占用会话，保证整个请求使用同一个 SessionState 的锁、历史和生成控制
         """
+        span = tracer.start("chat", session_id=session_id)
+        log_session.set(session_id)
+        recording = None
+        state = session_store.get(session_id, pin=True)
+        waiting_since = time.perf_counter()
         try:
-            # 获取会话历史
-            history = get_session_history(session_id)
-
-            # 构建检查消息 - 不添加到历史，只用于检查
-            check_messages = history.copy()
-            check_messages.append(HumanMessage(content="""当前任务是否完成？只通过上下文判断，不要调用工具；只回答以下三个选项之一，不要回答其他内容：
-- `True` - 任务已完成
-- `False` - 任务未完成，我应该继续执行
-- `userActionRequired` - 需要用户提供更多信息或进行操作 (例如需要用户登录)"""))
-
-            # 使用非流式调用检查
-            response = await global_agent.ainvoke({"messages": check_messages})
-
-            if response and 'messages' in response:
-                ai_message = response['messages'][-1]
-                content = ai_message.content.strip()
-
-                # 过滤 <think> 标签
-                import re
-                # 移除所有 <think>...</think> 标签及其内容
-                content = re.sub(r'<think>.*?</think>', '', content, flags=re.DOTALL)
-                content = content.strip().lower()
-
-                print(f"[DEBUG] Task completion check response (filtered): {content}")
-
-                # 解析回答 - 优先检查 userActionRequired，然后先检查 continue（避免"未完成"被"完成"误匹配）
-                if 'useractionrequired' in content.replace(' ', '') or '需要用户' in content or '用户操作' in content or '用户提供' in content:
-                    return "userActionRequired"
-                elif 'false' in content or '否' == content or '未完成' in content or '没有' in content:
-                    return "continue"
-                elif 'true' in content or '是' == content or '完成' in content or '已完成' in content:
-                    return "completed"
-
-            # 默认认为任务完成（保守策略，避免过度继续）
-            return "completed"
+            async with state.lock:
+                waited = time.perf_counter() - waiting_since
+                session_lock_wait.observe(waited)
+                span.set("lock_wait_seconds", round(waited, 6))
+                recording = session_recorder.begin(session_id, message)
+                current_recording.set(recording)
+                yield span, state
         except Exception as e:
-            print(f"[ERROR] Task completion check failed: {e}")
-            return "completed"  # 出错时假设任务完成，避免无限循环
-
-    async def stream_agent_response(message: str, session_id: str = "default") -> AsyncGenerator[str, None]:
+            span.fail(e)
+            raise
+        finally:
+            session_store.unpin(state)
+            span.end()
+            if recording is not None:
+                session_recorder.finish(recording)
+
+    async def stream_agent_response(message: str, session_id: str = "default", request: Request = None) -> AsyncGenerator[str, None]:
         """改进版流式生成 Agent 响应 - 支持连贯上下文和自动任务完成检查"""
         MAX_AUTO_CONTINUE = 80  # 最多自动继续 80 次
-        MAX_ERROR_RETRY = 80  # 最多连续错误 80 次
+        MAX_ERROR_RETRY = retry_policy.max_errors  # 最多连续错误次数，每次重试前按指数退避等待
 
-        # 获取会话锁，确保同一会话的请求串行处理
-        lock = get_session_lock(session_id)
+        # SSE 帧编码：合并 token，空闲时发送心跳
+        writer = SSEWriter.from_config(session_id, config)
 
-        async with lock:
+        # 获取会话锁，确保同一会话的请求串行处理
+        async with request_scope(session_id, message) as (request_span, state):
             error_count = 0  # 错误计数器
 
-            # 确保会话处于活动状态
-            if not global_session:
+            # 确保会话池处于活动状态
+            if not global_session_pool:
                 error_data = {
                     'type': 'error',
                     'error': 'MCP会话未初始化',
                     'session_id': session_id,
                     'timestamp': time.time()
                 }
-                yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
+                yield writer.event(error_data)
                 return
 
-            # 重置停止标志
-            set_stop_flag(session_id, False)
+            # 清除上一次的停止和暂停请求
+            control = state.control
+            control.reset()
 
             # 获取会话历史
-            history = get_session_history(session_id)
+            history = state.history
 
             # 如果历史为空，添加系统消息
             if not history:
-                history.append(SystemMessage(content=system_msg_content))
-                session_histories[session_id] = history
+                add_to_history(session_id, SystemMessage(content=system_msg_content))
 
             # 添加当前用户消息到历史
             user_message = HumanMessage(content=message)
             add_to_history(session_id, user_message)
 
             # 发送开始标记（只发送一次）
-            yield f"data: {json.dumps({'type': 'start', 'session_id': session_id, 'timestamp': time.time()})}\n\n"
+            yield writer.event({'type': 'start', 'session_id': session_id, 'timestamp': time.time()})
 
             # 主循环：处理任务和错误重试
             continue_count = 0
             connection_alive = True
 
-            while continue_count <= MAX_AUTO_CONTINUE and error_count < MAX_ERROR_RETRY:
+            # 从会话池租用浏览器（同一 session_id 优先回到上次使用的浏览器）
+            # 已经发送了开始标记，排队超时或启动失败时要以错误帧和结束标记收尾
+            try:
+                browser = await global_session_pool.acquire(session_id)
+            except Exception as e:
+                log.error(f"Failed to lease browser session: {e}")
+                request_span.fail(e)
                 try:
-                    # 如果用户请求停止，退出循环
-                    if should_stop(session_id):
-                        print(f"[INFO] Stop requested for session {session_id}")
-                        connection_alive = False
-                        break
-
-                    # 构建完整的消息列表（包含历史上下文）
-                    chat_messages = get_session_history(session_id).copy()
-
-                    # 使用更智能的流式处理
-                    last_content = ""  # 避免重复发送相同内容
-                    tool_call_active = False  # 跟踪是否有活跃的工具调用
-                    skip_next_content_token = False   # 跳过工具调用后的第一个有内容的token
-                    in_think_block = False    # 标记是否在think块中（处理跨chunk的情况）
-                    ai_response_content = ""  # 累积 AI 的完整回复
-
-                    async for chunk in global_agent.astream(
-                        {"messages": chat_messages},
-                        stream_mode=["messages"]
-                    ):
-                        # 检查停止标志
-                        if should_stop(session_id):
-                            print(f"[INFO] Stop requested for session {session_id}")
-                            connection_alive = False
-                            break
+                    yield writer.event({'type': 'error', 'error': f"无法获取浏览器会话: {e}", 'session_id': session_id, 'timestamp': time.time()})
+                    yield writer.event({'type': 'end', 'session_id': session_id, 'timestamp': time.time()})
+                except (ConnectionError, BrokenPipeError, GeneratorExit):
+                    pass
+                return
 
-                        # 检查连接是否仍然活跃
-                        try:
-                            # 尝试发送一个心跳包来检查连接
-                            yield f"data: {json.dumps({'type': 'ping', 'timestamp': time.time()})}\n\n"
-                        except (ConnectionError, BrokenPipeError, GeneratorExit):
-                            print(f"[INFO] Client disconnected, stopping stream for session {session_id}")
+            # 客户端断开时立即取消，不等下一次发送失败
+            async with global_session_pool.lease(session_id, browser), generation_scope(control, request):
+                agent = browser.agent
+
+                async def decide_into_queue(queue: asyncio.Queue, history_msgs: list, turn_text: str, tool_calls: list):
+                    """在后台判定任务是否完成，结果和 chunk 一样通过队列送达"""
+                    current_span.set(request_span)
+                    try:
+                        status = await completion_checker.check(history_msgs, agent, turn_text, tool_calls)
+                    except Exception as e:
+                        queue.put_nowait(e)
+                        return
+                    queue.put_nowait(CompletionDecision(status))
+
+                # 推测执行模式下等待判定的上一轮：(判定用的历史快照, AI 回复, 工具调用)
+                pending_check = None
+
+                while continue_count <= MAX_AUTO_CONTINUE and error_count < MAX_ERROR_RETRY:
+                    turn_task = None
+                    check_task = None
+                    turn_span = NOOP_SPAN
+                    # 本轮的 chunk、判定结果、定时器和停止请求都通过这个队列送达
+                    turn_queue = asyncio.Queue()
+                    control.wakeup = turn_queue
+                    try:
+                        # 暂停时在开始下一轮之前等待继续，期间照常发送心跳
+                        if control.paused:
+                            log.info(f"Session {session_id} paused")
+                            while control.paused:
+                                writer.arm(turn_queue)
+                                if await turn_queue.get() is SSE_TICK:
+                                    frame = writer.due()
+                                    if frame:
+                                        yield frame
+
+                        # 如果用户请求停止，退出循环
+                        if control.stop_requested:
+                            log.info(f"Stop requested for session {session_id} ({control.stop_reason})")
                             connection_alive = False
                             break
 
-                        # LangChain 的流式响应格式：('messages', (AIMessageChunk(...), metadata_dict))
-                        if isinstance(chunk, tuple) and len(chunk) >= 2:
-                            # 检查是否是 messages 类型
-                            if chunk[0] == 'messages':
-                                # 获取 AIMessageChunk 对象（元组的第一个元素）
-                                message_data = chunk[1]
-                                if isinstance(message_data, tuple) and len(message_data) >= 1:
-                                    ai_message_chunk = message_data[0]
-
-                                    # 提取内容
-                                    if hasattr(ai_message_chunk, 'content') and ai_message_chunk.content:
-                                        content = str(ai_message_chunk.content)
-
-                                        # 只发送新增的内容，避免重复
-                                        if content != last_content:
-                                            # 过滤掉代码块标签
-                                            if not content.strip().startswith('```') and not content.strip().startswith('</'):
-                                                # 检查是否需要跳过这个token（工具调用后的第一个有内容的token）
-                                                if skip_next_content_token:
-                                                    print(f"[DEBUG] Skipping tool return token: {content[:50]}{'...' if len(content) > 50 else ''}")
-                                                    skip_next_content_token = False
-                                                    last_content = content
-                                                    continue
-
-                                                # 过滤 think 标签对中的内容
-                                                original_content = content
-
-                                                if in_think_block:
-                                                    if '</think>' in content:
-                                                        think_end = content.find('</think>') + 8
-                                                        content = content[think_end:]
-                                                        in_think_block = False
-                                                    else:
-                                                        content = ""
-                                                else:
-                                                    if '<think>' in content and '</think>' in content:
-                                                        think_start = content.find('<think>')
-                                                        think_end = content.find('</think>') + 8
-                                                        content = content[:think_start] + content[think_end:]
-                                                    elif '<think>' in content:
-                                                        think_start = content.find('<think>')
-                                                        content = content[:think_start]
-                                                        in_think_block = True
-                                                    elif '</think>' in content:
-                                                        think_end = content.find('</think>') + 8
-                                                        content = content[think_end:]
-
-                                                # 如果过滤后内容为空，跳过这个token
-                                                if not content.strip():
-                                                    last_content = original_content
-                                                    continue
-
-                                                # 去除内容的首尾换行
-                                                content = content.strip()
-
-                                                # 🔧 修复：累积过滤后的内容（实际发送到前端的内容）
-                                                ai_response_content += content + " "
-
-                                                chunk_data = {
-                                                    'type': 'token',
-                                                    'content': content,
-                                                    'session_id': session_id,
-                                                    'timestamp': time.time()
-                                                }
-                                                try:
-                                                    yield f"data: {json.dumps(chunk_data, ensure_ascii=False)}\n\n"
-                                                except (ConnectionError, BrokenPipeError, GeneratorExit):
-                                                    print(f"[INFO] Client disconnected while sending token")
-                                                    connection_alive = False
-                                                    break
-                                                last_content = content
-
-                                    # 处理工具调用 - 静默处理
-                                    if hasattr(ai_message_chunk, 'tool_calls') and ai_message_chunk.tool_calls:
-                                        print(f"[DEBUG] Tool call detected: {ai_message_chunk.tool_calls}")
-                                        skip_next_content_token = True
-
-                    # 如果连接断开，退出循环
-                    if not connection_alive:
-                        break
-
-                    # 流式响应结束后，将 AI 回复添加到历史
-                    if ai_response_content.strip():
-                        ai_message = AIMessage(content=ai_response_content)
-                        add_to_history(session_id, ai_message)
-                        print(f"[INFO] Added AI response to history for session {session_id}")
-
-                        # 重置错误计数（成功响应后）
-                        error_count = 0
+                        # 构建完整的消息列表（包含历史上下文）
+                        chat_messages = history.messages()
+
+                        # 使用更智能的流式处理
+                        think_filter = ThinkTagFilter()   # 过滤 think 块（处理标签跨 chunk 的情况）
+                        ai_response_content = ""  # 累积 AI 的完整回复
+                        turn_tool_calls = []      # 本轮调用过的工具名称（供启发式判定使用）
+
+                        # 推测执行：本轮与上一轮的完成判定同时进行，判定结果出来之前输出先缓存
+                        speculating = pending_check is not None
+                        buffered_tokens = []
+                        first_buffered_at = None
+                        speculation_result = None
+                        turn_finished = False
+
+                        control.set_state("streaming")
+                        turns_total.inc()
+                        history_tokens.observe(history.token_count)
+                        turn_span = tracer.start("turn", parent=request_span, turn=continue_count, speculative=speculating)
+                        turn_started = time.perf_counter()
+                        first_token_at = None
+                        gate = asyncio.Event() if speculating else None
+                        turn_task = asyncio.create_task(pump_agent_stream(agent, chat_messages, turn_queue, gate, control,
+                                                                          browser, turn_span))
+
+                        if speculating:
+                            check_task = asyncio.create_task(decide_into_queue(turn_queue, *pending_check))
+                            pending_check = None
+
+                        while True:
+                            # 等待下一个 chunk，期间按时合并发送 token 或发送心跳
+                            writer.arm(turn_queue)
+                            chunk = await turn_queue.get()
+
+                            if chunk is SSE_TICK:
+                                frame = writer.due()
+                                if frame:
+                                    yield frame
+                                continue
+
+                            if chunk is STREAM_RESUMED:
+                                continue
+
+                            if isinstance(chunk, StreamCancelled):
+                                log.info(f"Generation cancelled for session {session_id} ({chunk.reason})")
+                                connection_alive = False
+                                break
 
-                        # 后台检查任务是否完成
-                        task_status = await check_task_completion(session_id)
+                            if chunk is TURN_END:
+                                turn_finished = True
+                                # 输出暂存的、最终没有构成标签的尾部
+                                tail = think_filter.flush()
+                                if tail:
+                                    ai_response_content += tail
+                                    if speculating:
+                                        buffered_tokens.append(tail)
+                                    else:
+                                        frame = writer.token(tail)
+                                        if frame:
+                                            yield frame
+                                if speculating:
+                                    # 本轮已结束但判定还没出来，继续等待判定结果
+                                    continue
+                                break
 
-                        if task_status == "completed":
-                            # 任务完成，退出循环
-                            print(f"[INFO] Task completed (count: {continue_count})")
-                            break
-                        elif task_status == "userActionRequired":
-                            # 需要用户操作，停止自动继续
-                            print(f"[INFO] User action required, stopping auto-continue (count: {continue_count})")
-                            break
-                        elif task_status == "continue":
-                            # 检查是否达到最大次数
-                            if continue_count >= MAX_AUTO_CONTINUE:
-                                print(f"[INFO] Max auto-continue reached ({MAX_AUTO_CONTINUE})")
+                            if isinstance(chunk, Exception):
+                                raise chunk
+
+                            if isinstance(chunk, CompletionDecision):
+                                blocked = time.perf_counter() - first_buffered_at if first_buffered_at else 0.0
+                                completion_checker.stats.record_step(completion_checker.mode, blocked)
+                                if chunk.status == "continue":
+                                    # 推测命中：放行工具调用并发送缓存的输出
+                                    completion_checker.stats.record_speculation(completion_checker.mode, kept=True)
+                                    continue_count += 1
+                                    auto_continue_total.inc()
+                                    log.info(f"Task not completed, speculative turn kept ({continue_count}/{MAX_AUTO_CONTINUE})")
+                                    speculating = False
+                                    gate.set()
+                                    for token in buffered_tokens:
+                                        frame = writer.token(token)
+                                        if frame:
+                                            yield frame
+                                    buffered_tokens.clear()
+                                    if turn_finished:
+                                        break
+                                    continue
+
+                                # 推测失败：取消推测的一轮，并撤回暂存的"继续"
+                                completion_checker.stats.record_speculation(completion_checker.mode, kept=False)
+                                speculation_result = chunk.status
+                                turn_task.cancel()
+                                session_store.pop(session_id)
                                 break
 
-                            # 任务未完成，自动继续
-                            print(f"[INFO] Task not completed, auto-continuing... ({continue_count + 1}/{MAX_AUTO_CONTINUE})")
-                            continue_count += 1
+                            # LangChain 的流式响应格式：('messages', (AIMessageChunk(...), metadata_dict))
+                            if isinstance(chunk, tuple) and len(chunk) >= 2:
+                                # 检查是否是 messages 类型
+                                if chunk[0] == 'messages':
+                                    # 获取 AIMessageChunk 对象（元组的第一个元素）
+                                    message_data = chunk[1]
+                                    if isinstance(message_data, tuple) and len(message_data) >= 1:
+                                        ai_message_chunk = message_data[0]
+
+                                        # 工具的返回内容只给模型看，不发送到前端（一次调用多个工具时会有多条）
+                                        if isinstance(ai_message_chunk, ToolMessage):
+                                            continue
+
+                                        # 处理工具调用 - 静默处理（先于内容处理：同时带有内容的 chunk 在内容为空、暂存或合并时会提前跳过）
+                                        if hasattr(ai_message_chunk, 'tool_calls') and ai_message_chunk.tool_calls:
+                                            if log.isEnabledFor(logging.DEBUG):
+                                                log.debug("Tool call detected: %s", [call.get('name') for call in ai_message_chunk.tool_calls])
+                                            turn_tool_calls.extend(call.get('name') for call in ai_message_chunk.tool_calls if call.get('name'))
+
+                                        # 提取内容
+                                        if hasattr(ai_message_chunk, 'content') and ai_message_chunk.content:
+                                            content = str(ai_message_chunk.content)
+
+                                            # 过滤 think 标签对中的内容（标签可能跨 chunk）
+                                            content = think_filter.feed(content)
+
+                                            # 整个 chunk 都在 think 块中（或暂存为标签前缀）时没有要发送的内容
+                                            if not content:
+                                                continue
+
+                                            # 累积过滤后的内容（实际发送到前端的内容）
+                                            if first_token_at is None:
+                                                first_token_at = time.perf_counter()
+                                            ai_response_content += content
+                                            if speculating:
+                                                if first_buffered_at is None:
+                                                    first_buffered_at = time.perf_counter()
+                                                buffered_tokens.append(content)
+                                                continue
+                                            frame = writer.token(content)
+                                            if not frame:
+                                                continue
+                                            try:
+                                                yield frame
+                                            except (ConnectionError, BrokenPipeError, GeneratorExit):
+                                                log.info("Client disconnected while sending token")
+                                                connection_alive = False
+                                                break
+
+                        # 如果连接断开，退出循环
+                        if not connection_alive:
+                            break
 
-                            # 添加"继续"到历史
-                            continue_message = HumanMessage(content="继续")
-                            add_to_history(session_id, continue_message)
+                        # 本轮的首 token 时间和输出速度
+                        if first_token_at is not None:
+                            ttft = first_token_at - turn_started
+                            llm_ttft.observe(ttft)
+                            turn_span.set("ttft_seconds", round(ttft, 6))
+                            output_seconds = time.perf_counter() - first_token_at
+                            if output_seconds > 0:
+                                llm_tokens_per_second.observe(estimate_tokens(ai_response_content) / output_seconds)
+                        turn_span.set("output_tokens", estimate_tokens(ai_response_content))
+                        turn_span.set("tool_calls", len(turn_tool_calls))
+
+                        # 本轮结束，立即发送暂存的 token，不等合并间隔
+                        frame = writer.flush()
+                        if frame:
+                            yield frame
+
+                        # 推测执行被判定为不需要继续，本轮输出直接丢弃
+                        if speculation_result is not None:
+                            if speculation_result == "userActionRequired":
+                                log.info(f"User action required, speculative turn cancelled (count: {continue_count})")
+                            else:
+                                log.info(f"Task completed, speculative turn cancelled (count: {continue_count})")
+                            break
 
-                            # 继续下一轮循环
-                            continue
+                        # 流式响应结束后，将 AI 回复添加到历史
+                        if ai_response_content.strip():
+                            ai_message = AIMessage(content=ai_response_content)
+                            add_to_history(session_id, ai_message)
+                            log.info(f"Added AI response to history for session {session_id}")
+
+                            # 重置错误计数（成功响应后）
+                            error_count = 0
+
+                            if completion_checker.speculative:
+                                if continue_count >= MAX_AUTO_CONTINUE:
+                                    log.info(f"Max auto-continue reached ({MAX_AUTO_CONTINUE})")
+                                    break
+
+                                # 推测执行：暂存"继续"并立即开始下一轮，判定在下一轮中并行完成
+                                pending_check = (history.messages(), ai_response_content, turn_tool_calls)
+                                add_to_history(session_id, HumanMessage(content="继续"))
+                                continue
+
+                            # 检查任务是否完成（判定期间流是空闲的，按时发送心跳）
+                            check_started = time.perf_counter()
+                            control.set_state("checking")
+                            check_task = asyncio.create_task(decide_into_queue(
+                                turn_queue, history.messages(), ai_response_content, turn_tool_calls
+                            ))
+                            while True:
+                                writer.arm(turn_queue)
+                                decision = await turn_queue.get()
+                                if decision is STREAM_RESUMED:
+                                    continue
+                                if decision is not SSE_TICK:
+                                    break
+                                frame = writer.due()
+                                if frame:
+                                    yield frame
+                            if isinstance(decision, StreamCancelled):
+                                log.info(f"Generation cancelled for session {session_id} ({decision.reason})")
+                                connection_alive = False
+                                break
+                            if isinstance(decision, Exception):
+                                raise decision
+                            task_status = decision.status
+                            completion_checker.stats.record_step(completion_checker.mode, time.perf_counter() - check_started)
+
+                            if task_status == "completed":
+                                # 任务完成，退出循环
+                                log.info(f"Task completed (count: {continue_count})")
+                                break
+                            elif task_status == "userActionRequired":
+                                # 需要用户操作，停止自动继续
+                                log.info(f"User action required, stopping auto-continue (count: {continue_count})")
+                                break
+                            elif task_status == "continue":
+                                # 检查是否达到最大次数
+                                if continue_count >= MAX_AUTO_CONTINUE:
+                                    log.info(f"Max auto-continue reached ({MAX_AUTO_CONTINUE})")
+                                    break
+
+                                # 任务未完成，自动继续
+                                log.info(f"Task not completed, auto-continuing... ({continue_count + 1}/{MAX_AUTO_CONTINUE})")
+                                continue_count += 1
+                                auto_continue_total.inc()
+
+                                # 添加"继续"到历史
+                                continue_message = HumanMessage(content="继续")
+                                add_to_history(session_id, continue_message)
+
+                                # 继续下一轮循环
+                                continue
+                            else:
+                                # 未知状态，默认完成
+                                log.warning(f"Unknown task status: {task_status}, treating as completed")
+                                break
                         else:
-                            # 未知状态，默认完成
-                            print(f"[WARNING] Unknown task status: {task_status}, treating as completed")
+                            # 🔧 修复：没有内容发送到前端时，检查是否需要发送说明消息
+                            log.warning("No content was sent to frontend (all filtered or empty)")
+
+                            # 仍然检查任务完成状态，可能需要向用户说明情况
+                            control.set_state("checking")
+                            check_task = asyncio.create_task(decide_into_queue(
+                                turn_queue, history.messages(), ai_response_content, turn_tool_calls
+                            ))
+                            while True:
+                                writer.arm(turn_queue)
+                                decision = await turn_queue.get()
+                                if decision is STREAM_RESUMED:
+                                    continue
+                                if decision is not SSE_TICK:
+                                    break
+                                frame = writer.due()
+                                if frame:
+                                    yield frame
+                            if isinstance(decision, StreamCancelled):
+                                log.info(f"Generation cancelled for session {session_id} ({decision.reason})")
+                                connection_alive = False
+                                break
+                            if isinstance(decision, Exception):
+                                raise decision
+                            task_status = decision.status
+
+                            if task_status == "userActionRequired":
+                                # 向前端发送说明消息
+                                explanation = "任务需要您的操作才能继续。"
+                                try:
+                                    writer.token(explanation)
+                                    yield writer.flush()
+
+                                    # 添加说明消息到历史
+                                    ai_message = AIMessage(content=explanation)
+                                    add_to_history(session_id, ai_message)
+                                    log.info("Sent user action required message to frontend")
+                                except (ConnectionError, BrokenPipeError, GeneratorExit):
+                                    log.warning("Failed to send user action message")
+
+                            # 退出循环
                             break
-                    else:
-                        # 🔧 修复：没有内容发送到前端时，检查是否需要发送说明消息
-                        print(f"[WARNING] No content was sent to frontend (all filtered or empty)")
 
-                        # 仍然检查任务完成状态，可能需要向用户说明情况
-                        task_status = await check_task_completion(session_id)
+                    except Exception as e:
+                        # 增加错误计数
+                        error_count += 1
+                        retry_stats.record("stream_errors")
+                        turn_span.fail(e)
+                        log.error(f"Stream error for session {session_id} (attempt {error_count}/{MAX_ERROR_RETRY}): {str(e)}",
+                                  exc_info=not isinstance(e, BrowserSessionWedged))
 
-                        if task_status == "userActionRequired":
-                            # 向前端发送说明消息
-                            explanation = "任务需要您的操作才能继续。"
+                        # 🔧 修复：先保存已经生成的内容到历史记录（如果有的话）
+                        if ai_response_content.strip():
                             try:
-                                chunk_data = {
-                                    'type': 'token',
-                                    'content': explanation,
-                                    'session_id': session_id,
-                                    'timestamp': time.time()
-                                }
-                                yield f"data: {json.dumps(chunk_data, ensure_ascii=False)}\n\n"
-
-                                # 添加说明消息到历史
-                                ai_message = AIMessage(content=explanation)
+                                ai_message = AIMessage(content=ai_response_content)
                                 add_to_history(session_id, ai_message)
-                                print(f"[INFO] Sent user action required message to frontend")
-                            except (ConnectionError, BrokenPipeError, GeneratorExit):
-                                print(f"[WARNING] Failed to send user action message")
-
-                        # 退出循环
-                        break
-
-                except Exception as e:
-                    # 增加错误计数
-                    error_count += 1
-                    print(f"[ERROR] Stream error for session {session_id} (attempt {error_count}/{MAX_ERROR_RETRY}): {str(e)}")
-                    traceback.print_exc()
-
-                    # 🔧 修复：先保存已经生成的内容到历史记录（如果有的话）
-                    if ai_response_content.strip():
-                        try:
-                            ai_message = AIMessage(content=ai_response_content)
-                            add_to_history(session_id, ai_message)
-                            print(f"[INFO] Saved partial AI response to history before retry ({len(ai_response_content)} chars)")
-                        except Exception as save_error:
-                            print(f"[WARNING] Failed to save partial response: {save_error}")
-
-                    if error_count >= MAX_ERROR_RETRY:
-                        # 达到最大错误次数，报错
-                        print(f"[FATAL] Max error retries reached ({MAX_ERROR_RETRY}), giving up")
-                        error_data = {
-                            'type': 'error',
-                            'error': f"连续错误 {error_count} 次: {str(e)}",
-                            'session_id': session_id,
-                            'timestamp': time.time()
-                        }
-                        try:
-                            yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
-                        except (ConnectionError, BrokenPipeError, GeneratorExit):
-                            pass
-                        break
-                    else:
-                        # 未达到最大次数，添加"继续"并重试
-                        print(f"[INFO] Error occurred, adding '继续' to retry... ({error_count}/{MAX_ERROR_RETRY})")
-                        try:
-                            # 尝试添加"继续"到历史
-                            continue_message = HumanMessage(content="继续")
-                            add_to_history(session_id, continue_message)
-                            # 继续循环
-                            continue
-                        except Exception as retry_error:
-                            # 如果添加"继续"也失败了，直接报错
-                            print(f"[FATAL] Failed to add continue message: {retry_error}")
+                                log.info(f"Saved partial AI response to history before retry ({len(ai_response_content)} chars)")
+                            except Exception as save_error:
+                                log.warning(f"Failed to save partial response: {save_error}")
+
+                        if error_count >= MAX_ERROR_RETRY:
+                            # 达到最大错误次数，报错
+                            retry_stats.record("gave_up")
+                            log.critical(f"Max error retries reached ({MAX_ERROR_RETRY}), giving up")
                             error_data = {
                                 'type': 'error',
-                                'error': f"重试失败: {str(retry_error)}",
+                                'error': f"连续错误 {error_count} 次: {str(e)}",
                                 'session_id': session_id,
                                 'timestamp': time.time()
                             }
                             try:
-                                yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
+                                yield writer.event(error_data)
                             except (ConnectionError, BrokenPipeError, GeneratorExit):
                                 pass
                             break
+                        else:
+                            # 失败的这一轮不再需要，重试前先取消，避免退避期间继续占用浏览器
+                            for task in (turn_task, check_task):
+                                if task is not None and not task.done():
+                                    task.cancel()
+
+                            # 熔断的或已经退出的 MCP 会话在原位重启；重启失败时浏览器已经不可用，不再重试，直接报错
+                            if browser.breaker.open or not browser.alive:
+                                try:
+                                    await global_session_pool.restart(browser)
+                                    agent = browser.agent
+                                except Exception as restart_error:
+                                    log.error(f"Failed to restart browser session #{browser.index}: {restart_error}")
+                                    retry_stats.record("gave_up")
+                                    error_data = {
+                                        'type': 'error',
+                                        'error': f"浏览器会话重启失败: {str(restart_error)}",
+                                        'session_id': session_id,
+                                        'timestamp': time.time()
+                                    }
+                                    try:
+                                        yield writer.event(error_data)
+                                    except (ConnectionError, BrokenPipeError, GeneratorExit):
+                                        pass
+                                    break
+
+                            # 指数退避（带抖动）后重试，等待期间照常发送心跳，停止请求立即生效
+                            delay = retry_policy.delay(error_count)
+                            log.info(f"Error occurred, retrying in {delay:.2f}s ({error_count}/{MAX_ERROR_RETRY})")
+                            retry_stats.record("retries")
+                            retry_stats.record("backoff_seconds", delay)
+                            request_span.event("retry", attempt=error_count, delay_seconds=round(delay, 3), error=str(e)[:200])
+                            retry_timer = asyncio.get_running_loop().call_later(delay, turn_queue.put_nowait, RETRY_DUE)
+                            try:
+                                while True:
+                                    writer.arm(turn_queue)
+                                    item = await turn_queue.get()
+                                    if item is RETRY_DUE or isinstance(item, StreamCancelled):
+                                        break
+                                    if item is SSE_TICK:
+                                        frame = writer.due()
+                                        if frame:
+                                            yield frame
+                                    # 其他的是失败那一轮剩下的输出，丢弃
+                            finally:
+                                retry_timer.cancel()
+                            if isinstance(item, StreamCancelled):
+                                log.info(f"Generation cancelled for session {session_id} ({item.reason})")
+                                connection_alive = False
+                                break
+
+                            # 添加"继续"并重试
+                            try:
+                                # 尝试添加"继续"到历史
+                                continue_message = HumanMessage(content="继续")
+                                add_to_history(session_id, continue_message)
+                                # 继续循环
+                                continue
+                            except Exception as retry_error:
+                                # 如果添加"继续"也失败了，直接报错
+                                log.critical(f"Failed to add continue message: {retry_error}")
+                                error_data = {
+                                    'type': 'error',
+                                    'error': f"重试失败: {str(retry_error)}",
+                                    'session_id': session_id,
+                                    'timestamp': time.time()
+                                }
+                                try:
+                                    yield writer.event(error_data)
+                                except (ConnectionError, BrokenPipeError, GeneratorExit):
+                                    pass
+                                break
+                    finally:
+                        turn_span.end()
+                        # 取消本轮的定时器、尚未结束的 Agent 输出任务和判定任务
+                        control.wakeup = None
+                        writer.disarm()
+                        for task in (turn_task, check_task):
+                            if task is not None and not task.done():
+                                task.cancel()
+
+            request_span.set("auto_continue", continue_count)
+            request_span.set("completed", connection_alive)
 
             # 发送结束标记（只在连接正常时发送一次）
             if connection_alive:
                 try:
-                    yield f"data: {json.dumps({'type': 'end', 'session_id': session_id, 'timestamp': time.time()})}\n\n"
+                    yield writer.event({'type': 'end', 'session_id': session_id, 'timestamp': time.time()})
                 except (ConnectionError, BrokenPipeError, GeneratorExit):
-                    print(f"[INFO] Client disconnected while sending end marker")
+                    log.info("Client disconnected while sending end marker")
+
+    def request_message(request: ChatRequest) -> str:
+        """取出请求中的用户消息：对话历史格式时使用最后一条用户消息"""
+        if request.messages:
+            for msg in reversed(request.messages):
+                if msg.get('role') == 'user':
+                    return msg.get('content', '') or request.message
+        return request.message
+
+    async def collect_agent_response(message: str, session_id: str, request: Request = None, on_frame=None) -> dict:
+        """运行与 /chat/stream 完全相同的流程（会话锁、历史、压缩、自动继续），把输出的帧汇总成一个结果"""
+        model_call_kind.set("chat")
+        content = []
+        error = None
+        ended = False
+        async for frame in stream_agent_response(message, session_id, request):
+            if on_frame is not None:
+                on_frame(frame)
+            # 一次输出可能包含多个帧（暂存的 token 帧 + 事件帧）
+            for block in frame.split("\n\n"):
+                if not block.startswith("data: "):
+                    continue
+                data = json.loads(block[6:])
+                if data["type"] == "token":
+                    content.append(data["content"])
+                elif data["type"] == "error":
+                    error = data["error"]
+                elif data["type"] == "end":
+                    ended = True
+        status = "failed" if error else "completed" if ended else "cancelled"
+        return {"content": "".join(content), "status": status, "error": error}
+
+    async def replay_session(player: TracePlayer) -> dict:
+        """把会话记录中的每次请求依次送入 stream_agent_response（使用新的会话），输出回放耗时和守护进程的开销"""
+        current_replay.set(player)
+        session_id = f"replay-{uuid.uuid4().hex[:8]}"
+        statuses = []
+        started = time.perf_counter()
+        for index, request in enumerate(player.requests):
+            player.prepare(index)
+            result = await collect_agent_response(request["message"], session_id)
+            statuses.append(result["status"])
+        summary = player.summary(time.perf_counter() - started, statuses)
+        log.info(f"Replay finished: {json.dumps(summary, ensure_ascii=False)}")
+        return summary
+
+    def chat_job_response(job: Job) -> ChatResponse:
+        return ChatResponse(
+            content=job.content,
+            session_id=job.session_id,
+            timestamp=job.finished or job.created,
+            status=job.status,
+            job_id=job.job_id,
+            error=job.error,
+        )
+
+    # 批量任务队列：每个任务通过与 /chat 相同的流程运行，同时运行的任务数默认等于浏览器会话池的大小
+    global job_queue
+    job_queue = JobQueue.from_config(config, default_workers=global_session_pool.max_size)
+    job_queue.start(
+        lambda job, on_frame: collect_agent_response(job.message, job.session_id, on_frame=on_frame),
+        lambda session_id: get_session_control(session_id).stop("cancel"),
+    )
 
     @app.post("/chat", response_model=ChatResponse)
-    async def chat(request: ChatRequest):
-        """普通聊天接口（非流式）- 使用状态化MCP工具"""
-        try:
-            # 确保会话处于活动状态
-            if not global_session:
-                raise Exception("MCP会话未初始化")
-            
-            chat_messages = [SystemMessage(content=system_msg_content), HumanMessage(content=request.message)]
-            response = await global_agent.ainvoke({"messages": chat_messages})
-
-            if response and 'messages' in response:
-                ai_message = response['messages'][-1]
-                content = ai_message.content if hasattr(ai_message, 'content') else "抱歉，我现在无法处理您的请求。"
-            else:
-                content = "抱歉，我现在无法处理您的请求。"
+    async def chat(request: ChatRequest, raw_request: Request):
+        """普通聊天接口（非流式）：与 /chat/stream 共用同一流程，返回汇总后的回复；wait 为 false 时立即返回 job_id"""
+        if not global_session_pool:
+            raise HTTPException(status_code=500, detail="MCP会话未初始化")
+
+        message = request_message(request)
+        if not request.wait:
+            return chat_job_response(job_queue.submit(message, request.session_id))
+
+        result = await collect_agent_response(message, request.session_id, raw_request)
+        if result["status"] == "failed":
+            raise HTTPException(status_code=500, detail=result["error"])
+        return ChatResponse(
+            content=result["content"],
+            session_id=request.session_id,
+            timestamp=time.time(),
+            status=result["status"],
+        )
 
-            return ChatResponse(
-                content=content,
-                session_id=request.session_id,
-                timestamp=time.time()
-            )
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+    @app.get("/chat/jobs/{job_id}", response_model=ChatResponse)
+    async def get_chat_job(job_id: str):
+        """查询 wait=false 提交的 /chat 任务"""
+        job = job_queue.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"未知的任务: {job_id}")
+        return chat_job_response(job)
+
+    def find_job(job_id: str) -> Job:
+        job = job_queue.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"未知的任务: {job_id}")
+        return job
+
+    @app.post("/jobs")
+    async def submit_job(request: JobRequest):
+        """提交一个批量浏览任务，立即返回任务信息"""
+        job = job_queue.submit(request.message, request.session_id, request.priority)
+        return job.to_dict()
+
+    @app.get("/jobs")
+    async def list_jobs(status: str = None, limit: int = 100):
+        """最近提交的任务（不含结果正文），可按状态过滤"""
+        return {"jobs": job_queue.list(status, limit), "stats": job_queue.stats()}
+
+    @app.get("/jobs/{job_id}")
+    async def get_job(job_id: str):
+        """查询任务的状态、计时和结果"""
+        return find_job(job_id).to_dict()
+
+    @app.post("/jobs/{job_id}/cancel")
+    async def cancel_job(job_id: str):
+        """取消任务：排队中的任务不再执行，运行中的任务立即停止"""
+        find_job(job_id)
+        return job_queue.cancel(job_id).to_dict()
+
+    @app.get("/jobs/{job_id}/stream")
+    async def stream_job(job_id: str, request: Request):
+        """以 SSE 输出任务的执行过程（与 /chat/stream 相同的帧），最后发送一个 job 帧；中途订阅时先回放已有的输出"""
+        job = find_job(job_id)
+
+        async def event_stream():
+            writer = SSEWriter.from_config(job.session_id, config)
+            subscriber = asyncio.Queue()
+
+            async def watch():
+                while (await request.receive()).get("type") != "http.disconnect":
+                    pass
+                subscriber.put_nowait(StreamCancelled("disconnect"))
+
+            watcher = asyncio.create_task(watch())
+            job.subscribers.add(subscriber)
+            try:
+                if not job.done:
+                    for frame in list(job.frames):
+                        yield frame
+                    while True:
+                        writer.arm(subscriber)
+                        item = await subscriber.get()
+                        if item is JOB_DONE or isinstance(item, StreamCancelled):
+                            break
+                        if item is SSE_TICK:
+                            frame = writer.due()
+                            if frame:
+                                yield frame
+                            continue
+                        yield item
+                yield writer.event({'type': 'job', **job.to_dict(), 'timestamp': time.time()})
+            finally:
+                watcher.cancel()
+                writer.disarm()
+                job.subscribers.discard(subscriber)
+
+        return StreamingResponse(
+            event_stream(),
+            media_type="text/event-stream",
+            headers={
+                "Cache-Control": "no-cache",
+                "Connection": "keep-alive",
+                "X-Accel-Buffering": "no"
+            }
+        )
 
     @app.post("/chat/stream")
-    async def chat_stream(request: ChatRequest):
+    async def chat_stream(request: ChatRequest, raw_request: Request):
         """流式聊天接口"""
-        # 支持对话历史格式
-        if hasattr(request, 'messages') and request.messages:
-            # 如果收到的是对话历史，使用最后一条用户消息
-            last_user_message = None
-            for msg in reversed(request.messages):
-                if msg.get('role') == 'user':
-                    last_user_message = msg.get('content', '')
-                    break
-            message = last_user_message or request.message
-        else:
-            # 兼容旧格式
-            message = request.message
-            
         return StreamingResponse(
-            stream_agent_response(message, request.session_id),
+            stream_agent_response(request_message(request), request.session_id, raw_request),
             media_type="text/event-stream",
             headers={
                 "Cache-Control": "no-cache",
@@ -984,29 +5357,104 @@ async def main():
         )
 
     @app.post("/chat/stop")
-    async def stop_generation(request: ChatRequest):
-        """停止当前会话的生成"""
+    async def stop_generation(request: ControlRequest):
+        """停止当前会话的生成（立即停止，或等当前工具执行结束后停止）"""
+        if request.mode not in ("now", "after_tool"):
+            raise HTTPException(status_code=400, detail=f"未知的停止方式: {request.mode}")
         try:
             session_id = request.session_id
-            set_stop_flag(session_id, True)
-            print(f"[INFO] Stop flag set for session {session_id}")
+            control = get_session_control(session_id)
+            if request.mode == "after_tool":
+                control.stop_after_tool()
+            else:
+                control.stop("stop")
+            log.info(f"Stop requested for session {session_id} ({request.mode})")
 
             return {
                 "success": True,
                 "message": f"已请求停止会话 {session_id} 的生成",
                 "session_id": session_id,
+                "state": control.state,
                 "timestamp": time.time()
             }
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
 
+    @app.post("/chat/pause")
+    async def pause_generation(request: ControlRequest):
+        """暂停当前会话的生成：在下一次工具调用前或下一轮自动继续前暂停"""
+        control = get_session_control(request.session_id)
+        control.pause()
+        log.info(f"Pause requested for session {request.session_id}")
+        return {
+            "success": True,
+            "session_id": request.session_id,
+            "state": control.state,
+            "timestamp": time.time()
+        }
+
+    @app.post("/chat/resume")
+    async def resume_generation(request: ControlRequest):
+        """继续已暂停的生成"""
+        control = get_session_control(request.session_id)
+        control.resume()
+        log.info(f"Resume requested for session {request.session_id}")
+        return {
+            "success": True,
+            "session_id": request.session_id,
+            "state": control.state,
+            "timestamp": time.time()
+        }
+
+    @app.get("/chat/events")
+    async def chat_events(request: Request, session_id: str = None):
+        """订阅会话状态变化（SSE）：streaming、tool-running、checking、paused、idle；不指定 session_id 时订阅所有会话"""
+        async def event_stream():
+            writer = SSEWriter.from_config(session_id or "", config)
+            subscriber = session_events.subscribe(session_id)
+
+            async def watch():
+                while (await request.receive()).get("type") != "http.disconnect":
+                    pass
+                subscriber.put_nowait(StreamCancelled("disconnect"))
+
+            watcher = asyncio.create_task(watch())
+            try:
+                for event in session_events.snapshot(session_id):
+                    yield writer.event(event)
+                while True:
+                    writer.arm(subscriber)
+                    event = await subscriber.get()
+                    if isinstance(event, StreamCancelled):
+                        break
+                    if event is SSE_TICK:
+                        frame = writer.due()
+                        if frame:
+                            yield frame
+                        continue
+                    yield writer.event(event)
+            finally:
+                watcher.cancel()
+                writer.disarm()
+                session_events.unsubscribe(subscriber)
+
+        return StreamingResponse(
+            event_stream(),
+            media_type="text/event-stream",
+            headers={
+                "Cache-Control": "no-cache",
+                "Connection": "keep-alive",
+                "X-Accel-Buffering": "no"
+            }
+        )
+
     @app.post("/chat/clear")
     async def clear_history(request: ChatRequest):
         """清除会话历史"""
         try:
             session_id = request.session_id
             clear_session_history(session_id)
-            print(f"[INFO] Cleared history for session {session_id}")
+            log.info(f"Cleared history for session {session_id}")
 
             return {
                 "success": True,
@@ -1024,7 +5472,7 @@ async def main():
             history = get_session_history(session_id)
             # 转换为可序列化的格式
             history_data = []
-            for msg in history:
+            for msg in history.messages():
                 if isinstance(msg, SystemMessage):
                     history_data.append({"role": "system", "content": msg.content})
                 elif isinstance(msg, HumanMessage):
@@ -1035,6 +5483,7 @@ async def main():
             return {
                 "session_id": session_id,
                 "message_count": len(history_data),
+                "token_count": history.token_count,
                 "messages": history_data,
                 "timestamp": time.time()
             }
@@ -1048,9 +5497,97 @@ async def main():
             "status": "healthy",
             "service": "everBrowser API",
             "timestamp": time.time(),
-            "agent_ready": global_agent is not None,
-            "session_active": global_session is not None,
-            "mcp_tools_ready": global_session is not None and global_agent is not None
+            "agent_ready": global_session_pool is not None,
+            "session_active": global_session_pool is not None,
+            "mcp_tools_ready": global_session_pool is not None,
+            "browser_pool": global_session_pool.stats() if global_session_pool else None
+        }
+
+    # /metrics 中从各统计对象读取的指标
+    def labelled(entries, *names):
+        return [(dict(zip(names, key)), value) for *key, value in entries]
+
+    metrics.collect("everbrowser_tool_calls_total", "counter", "工具调用次数",
+                    lambda: labelled(((name, e["calls"]) for name, e in tool_stats.tools.items()), "tool"))
+    metrics.collect("everbrowser_tool_errors_total", "counter", "返回错误的工具调用次数",
+                    lambda: labelled(((name, e["errors"]) for name, e in tool_stats.tools.items()), "tool"))
+    metrics.collect("everbrowser_tool_timeouts_total", "counter", "超时的工具调用次数",
+                    lambda: labelled(((name, e["timeouts"]) for name, e in tool_stats.tools.items()), "tool"))
+    metrics.collect("everbrowser_retry_events_total", "counter", "超时、出错和重试的次数",
+                    lambda: labelled(((name, value) for name, value in retry_stats.counts.items()
+                                      if name != "backoff_seconds"), "event"))
+    metrics.collect("everbrowser_retry_backoff_seconds_total", "counter", "出错后退避等待的总秒数",
+                    lambda: retry_stats.counts["backoff_seconds"])
+    metrics.collect("everbrowser_prompt_tokens_total", "counter", "发送给模型的提示 token 数（后端报告）",
+                    lambda: labelled(((kind, e["prompt_tokens"]) for kind, e in prompt_cache_stats.snapshot()["calls"].items()), "kind"))
+    metrics.collect("everbrowser_cached_prompt_tokens_total", "counter", "命中前缀缓存的提示 token 数",
+                    lambda: labelled(((kind, e["cached_tokens"]) for kind, e in prompt_cache_stats.snapshot()["calls"].items()), "kind"))
+    metrics.collect("everbrowser_active_sessions", "gauge", "正在生成的会话数（按状态）",
+                    lambda: labelled(session_events.stats()["active"].items(), "state"))
+    metrics.collect("everbrowser_hot_sessions", "gauge", "内存中的会话数",
+                    lambda: session_store.stats()["hot_sessions"])
+    metrics.collect("everbrowser_history_tokens_in_memory", "gauge", "内存中所有会话历史的 token 数",
+                    lambda: session_store.history_tokens())
+    metrics.collect("everbrowser_browser_sessions", "gauge", "浏览器会话池中的会话数（按状态）",
+                    lambda: labelled(((key, value) for key, value in global_session_pool.stats().items()
+                                      if key in ("size", "busy", "starting", "spare", "waiting", "breaker_open")), "state")
+                    if global_session_pool else None)
+    metrics.collect("everbrowser_browser_restarts_total", "counter", "熔断后重启的浏览器会话数",
+                    lambda: global_session_pool.restarts if global_session_pool else None)
+    metrics.collect("everbrowser_jobs", "gauge", "批量任务数（排队中 / 运行中）",
+                    lambda: labelled([("pending", job_queue.stats()["queue_depth"]), ("running", job_queue.stats()["running"])],
+                                     "status") if job_queue else None)
+    metrics.collect("everbrowser_jobs_finished_total", "counter", "已结束的批量任务数",
+                    lambda: labelled(((status, job_queue.stats()[status]) for status in ("completed", "failed", "cancelled")),
+                                     "status") if job_queue else None)
+    metrics.collect("everbrowser_sse_frames_total", "counter", "发送的 SSE 帧数", lambda: SSEWriter.totals["frames"])
+    metrics.collect("everbrowser_model_backend_requests_total", "counter", "发往各模型服务的调用次数",
+                    lambda: labelled(((b.name, b.requests) for b in model_router.backends), "backend") if model_router else None)
+    metrics.collect("everbrowser_model_backend_errors_total", "counter", "各模型服务失败（不含限流）的调用次数",
+                    lambda: labelled(((b.name, b.errors) for b in model_router.backends), "backend") if model_router else None)
+    metrics.collect("everbrowser_model_backend_rate_limited_total", "counter", "各模型服务返回限流的次数",
+                    lambda: labelled(((b.name, b.rate_limited) for b in model_router.backends), "backend") if model_router else None)
+    metrics.collect("everbrowser_model_backend_latency_seconds", "gauge", "各模型服务首 token 时间的滑动平均",
+                    lambda: labelled(((b.name, b.latency) for b in model_router.backends if b.latency is not None),
+                                     "backend") if model_router else None)
+    metrics.collect("everbrowser_model_failovers_total", "counter", "模型调用失败后换服务重试的次数",
+                    lambda: model_router.failovers if model_router else None)
+    metrics.collect("everbrowser_model_requests_total", "counter", "发送给模型服务的 HTTP 请求数（按是否新建连接）",
+                    lambda: labelled([("new", model_transport.connections.new_connections),
+                                      ("reused", model_transport.stats()["reused"])], "connection"))
+
+    @app.get("/metrics")
+    async def get_metrics():
+        """Prometheus 指标"""
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+    @app.get("/stats")
+    async def get_stats():
+        """运行统计接口"""
+        return {
+            "browser_pool": global_session_pool.stats() if global_session_pool else None,
+            "sessions": session_store.stats(),
+            "sse": dict(SSEWriter.totals),
+            "session_states": session_events.stats(),
+            "prompt_cache": prompt_cache_stats.snapshot(),
+            "tools": tool_stats.snapshot(),
+            "retries": retry_stats.snapshot(),
+            "jobs": job_queue.stats() if job_queue else None,
+            "tracing": tracer.stats(),
+            "logging": log_pipeline.stats(),
+            "recording": session_recorder.stats(),
+            "model_transport": model_transport.stats(),
+            "model_router": model_router.stats() if model_router else None,
+            "tool_output": tool_output_store.stats(),
+            "snapshot_diff": snapshot_diff_middleware.stats() if snapshot_diff_middleware else None,
+            "startup": startup_timer.snapshot(),
+            "browser": browser_supervisor.stats() if browser_supervisor else None,
+            "completion_check": {
+                "mode": completion_checker.mode,
+                "decision_mode": completion_checker.decision_mode,
+                "modes": completion_checker.stats.snapshot(),
+            },
+            "timestamp": time.time()
         }
 
     @app.get("/")
@@ -1065,12 +5602,20 @@ async def main():
                 "message": "everBrowser API Server",
                 "version": "1.0.0",
                 "endpoints": {
-                    "chat": "/chat - 普通聊天接口",
+                    "chat": "/chat - 普通聊天接口（支持上下文，wait=false 时返回 job_id）",
+                    "chat_jobs": "/chat/jobs/{job_id} - 查询 wait=false 提交的聊天任务",
+                    "jobs": "/jobs - 提交（POST）或列出（GET）批量任务",
+                    "job": "/jobs/{job_id} - 查询任务；/stream 输出执行过程，/cancel 取消任务",
                     "chat_stream": "/chat/stream - 流式聊天接口（支持上下文）",
-                    "chat_stop": "/chat/stop - 停止当前生成",
+                    "chat_stop": "/chat/stop - 停止当前生成（mode: now / after_tool）",
+                    "chat_pause": "/chat/pause - 暂停当前生成",
+                    "chat_resume": "/chat/resume - 继续已暂停的生成",
+                    "chat_events": "/chat/events - 订阅会话状态变化（SSE）",
                     "chat_clear": "/chat/clear - 清除会话历史",
                     "chat_history": "/chat/history/{session_id} - 查看会话历史",
                     "health": "/health - 健康检查接口",
+                    "stats": "/stats - 运行统计",
+                    "metrics": "/metrics - Prometheus 指标",
                     "chat_ui": "/ - 聊天界面",
                     "userscript": "/chat.user.js - Tampermonkey 用户脚本",
                     "docs": "/docs - Swagger API 文档"
@@ -1092,12 +5637,20 @@ async def main():
             "message": "everBrowser API Server",
             "version": "1.0.0",
             "endpoints": {
-                "chat": "/chat - 普通聊天接口",
+                "chat": "/chat - 普通聊天接口（支持上下文，wait=false 时返回 job_id）",
+                "chat_jobs": "/chat/jobs/{job_id} - 查询 wait=false 提交的聊天任务",
+                "jobs": "/jobs - 提交（POST）或列出（GET）批量任务",
+                "job": "/jobs/{job_id} - 查询任务；/stream 输出执行过程，/cancel 取消任务",
                 "chat_stream": "/chat/stream - 流式聊天接口（支持上下文）",
-                "chat_stop": "/chat/stop - 停止当前生成",
+                "chat_stop": "/chat/stop - 停止当前生成（mode: now / after_tool）",
+                "chat_pause": "/chat/pause - 暂停当前生成",
+                "chat_resume": "/chat/resume - 继续已暂停的生成",
+                "chat_events": "/chat/events - 订阅会话状态变化（SSE）",
                 "chat_clear": "/chat/clear - 清除会话历史",
                 "chat_history": "/chat/history/{session_id} - 查看会话历史",
                 "health": "/health - 健康检查接口",
+                "stats": "/stats - 运行统计",
+                "metrics": "/metrics - Prometheus 指标",
                 "userscript": "/chat.user.js - Tampermonkey 用户脚本",
                 "docs": "/docs - Swagger API 文档"
             }
@@ -1122,17 +5675,47 @@ async def main():
             raise HTTPException(status_code=404, detail="User script not found")
 
     try:
-        # 保持主线程运行
-        while True:
-            await asyncio.sleep(1)
-    except KeyboardInterrupt:
-        print("\n🛑 Shutting down everBrowser API Server...")
-        cleanup_lock_file()
-        server.should_exit = True
-        await server_task
+        # 保持运行，直到服务器退出（Ctrl+C）或浏览器被关闭
+        waiters = [server_task]
+        if browser_supervisor:
+            waiters.append(asyncio.create_task(browser_supervisor.exited.wait()))
+        if replay_player:
+            waiters.append(asyncio.create_task(replay_session(replay_player)))
+        await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        if browser_supervisor and browser_supervisor.exited.is_set():
+            log.info("🛑 Browser closed, exiting daemon...")
     finally:
+        log.info("🛑 Shutting down everBrowser API Server...")
+        server.should_exit = True
+        if browser_supervisor:
+            await browser_supervisor.stop()
+        if not server_task.done():
+            await server_task
+        if job_queue:
+            await job_queue.close()
+        await tracer.close()
+        await session_recorder.close()
+        if model_warmup is not None:
+            model_warmup.cancel()
+            await asyncio.gather(model_warmup, return_exceptions=True)
+        await model_transport.close()
+        if global_session_pool:
+            await global_session_pool.close()
+        if session_store:
+            session_store.close()
         cleanup_lock_file()
+        log_pipeline.stop()
     
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description="everBrowser 守护进程")
+    parser.add_argument("--headless", action="store_true", help="不显示界面、不安装 Playwright、不打开浏览器（用于测试）")
+    parser.add_argument("--config", default="config.json", help="配置文件路径")
+    parser.add_argument("--reinstall", action="store_true", help="忽略浏览器清单，强制安装或更新浏览器")
+    parser.add_argument("--replay", help="回放会话记录（.jsonl.gz），输出耗时汇总后退出")
+    parser.add_argument("--replay-speed", type=float, default=1.0, help="回放的时间倍速，0 表示不等待")
+    args = parser.parse_args()
+    asyncio.run(main(headless=args.headless, config_path=args.config, reinstall=args.reinstall,
+                     replay=args.replay, replay_speed=args.replay_speed))
\ No newline at end of file